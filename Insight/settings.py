@@ -79,6 +79,7 @@ CRISPY_TEMPLATE_PACK = "bootstrap5"
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',  # Add this for static files
+    'dashboard.middleware.PrimaryPinMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -86,15 +87,24 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'allauth.account.middleware.AccountMiddleware',
+    'dashboard.middleware.HTMLMinifyMiddleware',
 ]
 
 ROOT_URLCONF = 'Insight.urls'
 
+# Output of `manage.py extract_inline_assets`: templates with their inline
+# CSS/JS moved into static files. Only used outside DEBUG so template edits
+# show up immediately during development. Rebuild it on every deploy; the
+# dashboard.E001 system check fails while a built template is out of date.
+ASSET_BUILD_DIR = BASE_DIR / 'build'
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
-        'DIRS': [ BASE_DIR / 'templates' ],
-        'APP_DIRS': True,
+        'DIRS': [
+            *([ASSET_BUILD_DIR / 'templates'] if not DEBUG else []),
+            BASE_DIR / 'templates',
+        ],
         'OPTIONS': {
             'context_processors': [
                 'django.template.context_processors.debug',
@@ -102,13 +112,63 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
             ],
+            # Always keep compiled templates in memory
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
         },
     },
 ]
 
+# Strip indentation from rendered HTML (dashboard.middleware.HTMLMinifyMiddleware)
+HTML_MINIFY = os.environ.get('HTML_MINIFY', str(not DEBUG)).lower() == 'true'
+
 WSGI_APPLICATION = 'Insight.wsgi.application'
 
 
+# Cache
+# The default cache holds state every worker must agree on (per-user
+# summaries and entitlements, media name lookups, replica pins), so it must
+# be shared between processes: Redis when REDIS_URL is set (needs the redis
+# package), otherwise files on this host, which every gunicorn worker sees.
+# Never use the process-local LocMemCache here.
+#
+# The file cache is the weaker of the two for the version and generation
+# counters (dashboard.fragments, dashboard.entitlements, dashboard.scheduling):
+# * its incr() is a read followed by a write, not atomic, so two workers
+#   bumping at once may both write the same value.  Every bump still changes
+#   the value, which is all readers compare, but the count itself can lag;
+# * past MAX_ENTRIES it culls a random third of its files, counters
+#   included.  A culled scheduling token is replaced by a new one and forces
+#   a rebuild; a culled entitlement generation only widens the race its check
+#   guards; a culled card fragment version restarts at 1 and can bring back
+#   cards cached under that version until they expire.
+# Production with more than one worker should set REDIS_URL: INCR is atomic
+# and keys without a timeout are not evicted under the default policy.
+
+if 'REDIS_URL' in os.environ:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get('CACHE_DIR', BASE_DIR / 'cache'),
+            # incr() re-sets the value with this timeout; the version counters
+            # bumped with it must not expire, and every other set() passes its own
+            'TIMEOUT': None,
+            'OPTIONS': {'MAX_ENTRIES': 50000},
+        }
+    }
+
+
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
@@ -129,6 +189,23 @@ else:
         }
     }
 
+# Read replicas, as comma-separated database URLs, used by the views marked
+# with dashboard.routers.read_from_replica. Locally two SQLite files work:
+# REPLICA_DATABASE_URLS=sqlite:////path/to/replica.sqlite3
+REPLICA_DATABASE_URLS = [url.strip() for url in os.environ.get('REPLICA_DATABASE_URLS', '').split(',') if url.strip()]
+for _number, _url in enumerate(REPLICA_DATABASE_URLS, start=1):
+    DATABASES[f'replica_{_number}'] = {
+        **dj_database_url.parse(_url, conn_max_age=600, ssl_require=not _url.startswith('sqlite')),
+        'TEST': {'MIRROR': 'default'},
+    }
+REPLICA_DATABASES = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['dashboard.routers.ReplicaRouter']
+
+# Seconds a user keeps reading from the primary after writing, to cover replication lag
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 15))
+# Seconds an unreachable replica is left out before it is tried again
+REPLICA_RETRY_SECONDS = int(os.environ.get('REPLICA_RETRY_SECONDS', 30))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -171,6 +248,8 @@ STATICFILES_DIRS = [
     BASE_DIR / 'static' / 'js',
     BASE_DIR / 'static' / 'images',
 ]
+if (ASSET_BUILD_DIR / 'static').is_dir():
+    STATICFILES_DIRS.append(ASSET_BUILD_DIR / 'static')
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 
 # WhiteNoise configuration for static files
@@ -179,6 +258,15 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 # Media files
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+# Uploads are stored once per distinct content under MEDIA_ROOT/blobs/ (dashboard.storage)
+DEFAULT_FILE_STORAGE = 'dashboard.storage.ContentAddressedStorage'
+# How dashboard.serving hands protected media to the front-end server: '' streams it
+# from Django, 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache/lighttpd)
+MEDIA_OFFLOAD = os.environ.get('MEDIA_OFFLOAD', '')
+# nginx `internal` location aliasing MEDIA_ROOT, for X-Accel-Redirect
+MEDIA_ACCEL_PREFIX = os.environ.get('MEDIA_ACCEL_PREFIX', '/protected-media/')
+# Rendered analysis PDFs, reused until the analysis changes (dashboard.reports)
+REPORT_CACHE_DIR = Path(os.environ.get('REPORT_CACHE_DIR', BASE_DIR / 'report_cache'))
 
 # Authentication Backends
 AUTHENTICATION_BACKENDS = [
@@ -192,6 +280,18 @@ SITE_ID = 1
 # Email Configuration
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+# Threads generating resized image derivatives after uploads (dashboard.images); 0 runs them inline
+IMAGE_DERIVATIVE_WORKERS = int(os.environ.get('IMAGE_DERIVATIVE_WORKERS', 2))
+
+# Consultation reminder delivery (dashboard.reminders), one backend per reminder type
+REMINDER_BACKENDS = {
+    'email': 'dashboard.reminders.EmailBackend',
+    'sms': 'dashboard.reminders.ConsoleBackend',
+    'push': 'dashboard.reminders.ConsoleBackend',
+}
+# Used by dashboard.reminders.FileBackend
+REMINDER_FILE_PATH = BASE_DIR / 'reminders.log'
+
 # Allauth Settings
 ACCOUNT_EMAIL_REQUIRED = True
 ACCOUNT_EMAIL_VERIFICATION = 'optional'
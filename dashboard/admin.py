@@ -1,15 +1,125 @@
-from django.contrib import admin
+import csv
+import datetime
+
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils import timezone
 from django.utils.html import format_html
-from django.db.models import Count, Sum, Avg
+from django.db import transaction as db_transaction
+from django.db.models import BooleanField, Count, ExpressionWrapper, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
 from .models import (
     UserProfile, UserWallet, Transaction, MpesaTransaction,
     Analyst, CryptoAnalysis, PurchasedAnalysis, 
     AnalysisRating, Category, Consultation, ConsultationPackage,
     SiteSetting, MarketInsight, ChartAnnotation, TechnicalIndicatorData,
-    AnalysisInsight, AnalysisMetric, ConsultationAttachment, ConsultationReminder
+    AnalysisInsight, AnalysisMetric, ConsultationAttachment, ConsultationReminder,
+    UserStats, AnalysisNeighbors, AnalystRanking, DailyRollup, CryptoAnalysisQuerySet,
+    TRANSACTION_TYPES,
 )
+from .exports import EXPORT_FORMATS
+from .forms import ContentImportForm
+from .imports import ContentImportError, import_bundle
+from .rollups import GROUPINGS, report as rollup_report
+
+def _is_changelist(request):
+    match = getattr(request, 'resolver_match', None)
+    return bool(match and (match.url_name or '').endswith('_changelist'))
+
+
+def _related_count(queryset, field):
+    """Correlated COUNT of ``queryset`` rows whose ``field`` points at the outer row"""
+    subquery = queryset.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(total=Count('pk')).values('total')
+    return Coalesce(Subquery(subquery, output_field=IntegerField()), Value(0))
+
+
+class ChangelistQuerysetMixin:
+    """
+    Trim the changelist query.  ``changelist_defer`` columns are not loaded,
+    and the CryptoAnalysis rows joined through ``changelist_analysis_paths``
+    leave their report bodies behind.  Display methods read annotations added
+    in ``get_queryset`` rather than querying per row.
+    """
+    changelist_defer = ()
+    changelist_analysis_paths = ()
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if _is_changelist(request):
+            queryset = self.get_changelist_queryset(queryset)
+        return queryset
+
+    def get_changelist_queryset(self, queryset):
+        deferred = list(self.changelist_defer)
+        for path in self.changelist_analysis_paths:
+            deferred += CryptoAnalysisQuerySet.deferred_fields('card', prefix=f'{path}__')
+        return queryset.defer(*deferred) if deferred else queryset
+
+
+class StreamingExportMixin:
+    """
+    Admin actions streaming the selected rows (or, with "select all", the
+    whole filtered changelist) as CSV or dxcol without loading them into memory.
+    """
+    actions = ['export_csv', 'export_dxcol']
+
+    def stream_export(self, queryset, export_format):
+        stream, content_type, extension = EXPORT_FORMATS[export_format]
+        response = StreamingHttpResponse(stream(queryset.order_by('pk')), content_type=content_type)
+        filename = f"{queryset.model._meta.model_name}_{timezone.now():%Y%m%d_%H%M%S}.{extension}"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+    @admin.action(description='Export selected rows as CSV')
+    def export_csv(self, request, queryset):
+        return self.stream_export(queryset, 'csv')
+
+    @admin.action(description='Export selected rows as columnar binary (dxcol)')
+    def export_dxcol(self, request, queryset):
+        return self.stream_export(queryset, 'dxcol')
+
+
+class ProjectedChangelistMixin(ChangelistQuerysetMixin):
+    """Load only the listing projection's columns on the changelist page"""
+    changelist_projection = 'card'
+    changelist_keep = ()
+
+    def get_changelist_queryset(self, queryset):
+        queryset = super().get_changelist_queryset(queryset)
+        return queryset.projection(self.changelist_projection, keep=self.changelist_keep)
+
+
+class UserStatsRebuildMixin:
+    """
+    Rebuild the owner's UserStats after an admin add, change or delete.
+    UserStats.record() is only applied by the views, so a hand edit here
+    would otherwise leave the totals off until the next rebuild_user_stats.
+    """
+
+    def rebuild_user_stats(self, user_ids):
+        user_ids = sorted({user_id for user_id in user_ids if user_id is not None})
+        if user_ids:
+            db_transaction.on_commit(lambda: UserStats.rebuild(user_ids=user_ids))
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # A reassigned row also leaves the previous owner's totals
+        self.rebuild_user_stats([obj.user_id, form.initial.get('user') if change else None])
+
+    def delete_model(self, request, obj):
+        user_id = obj.user_id
+        super().delete_model(request, obj)
+        self.rebuild_user_stats([user_id])
+
+    def delete_queryset(self, request, queryset):
+        user_ids = list(queryset.values_list('user_id', flat=True).distinct())
+        super().delete_queryset(request, queryset)
+        self.rebuild_user_stats(user_ids)
+
 
 class UserProfileInline(admin.StackedInline):
     model = UserProfile
@@ -29,6 +139,12 @@ class UserAdmin(BaseUserAdmin):
     inlines = (UserProfileInline, UserWalletInline)
     list_display = ['username', 'email', 'first_name', 'last_name', 'is_staff', 'date_joined', 'get_balance', 'get_purchases_count']
     list_filter = ['is_staff', 'is_superuser', 'is_active', 'date_joined']
+    list_select_related = ['userwallet']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            purchases_total=_related_count(PurchasedAnalysis.objects, 'user'),
+        )
     
     def get_balance(self, obj):
         try:
@@ -39,8 +155,9 @@ class UserAdmin(BaseUserAdmin):
     get_balance.short_description = 'Balance'
     
     def get_purchases_count(self, obj):
-        return obj.purchasedanalysis_set.count()
+        return obj.purchases_total
     get_purchases_count.short_description = 'Purchases'
+    get_purchases_count.admin_order_field = 'purchases_total'
 
 # Re-register UserAdmin
 admin.site.unregister(User)
@@ -49,19 +166,21 @@ admin.site.register(User, UserAdmin)
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
     list_display = ['user', 'phone_number', 'date_of_birth', 'created_at', 'profile_picture_preview']
+    list_select_related = ['user']
     search_fields = ['user__username', 'user__email', 'phone_number']
     list_filter = ['created_at', 'date_of_birth']
     readonly_fields = ['created_at', 'updated_at', 'profile_picture_preview']
     
     def profile_picture_preview(self, obj):
         if obj.profile_picture:
-            return format_html('<img src="{}" width="50" height="50" style="border-radius: 50%;" />', obj.profile_picture.url)
+            return format_html('<img src="{}" width="50" height="50" style="border-radius: 50%;" />', obj.profile_picture_thumbnail_url)
         return "No Image"
     profile_picture_preview.short_description = 'Profile Picture'
 
 @admin.register(UserWallet)
 class UserWalletAdmin(admin.ModelAdmin):
     list_display = ['user', 'balance_display', 'preferred_payment_method', 'mpesa_verified', 'paypal_verified', 'created_at']
+    list_select_related = ['user']
     search_fields = ['user__username', 'user__email', 'wallet_id']
     list_filter = ['preferred_payment_method', 'mpesa_verified', 'paypal_verified', 'created_at']
     readonly_fields = ['wallet_id', 'created_at', 'updated_at']
@@ -72,8 +191,10 @@ class UserWalletAdmin(admin.ModelAdmin):
     balance_display.short_description = 'Balance'
 
 @admin.register(Transaction)
-class TransactionAdmin(admin.ModelAdmin):
+class TransactionAdmin(UserStatsRebuildMixin, StreamingExportMixin, ChangelistQuerysetMixin, admin.ModelAdmin):
     list_display = ['transaction_id_short', 'user', 'amount_display', 'transaction_type', 'payment_method', 'status_badge', 'created_at']
+    list_select_related = ['user']
+    changelist_defer = ('description',)
     list_filter = ['transaction_type', 'payment_method', 'status', 'created_at']
     search_fields = ['user__username', 'transaction_id', 'mpesa_code', 'paypal_transaction_id', 'description']
     readonly_fields = ['transaction_id', 'created_at', 'updated_at']
@@ -102,11 +223,13 @@ class TransactionAdmin(admin.ModelAdmin):
     status_badge.short_description = 'Status'
 
 @admin.register(MpesaTransaction)
-class MpesaTransactionAdmin(admin.ModelAdmin):
+class MpesaTransactionAdmin(StreamingExportMixin, ChangelistQuerysetMixin, admin.ModelAdmin):
     list_display = [
         'user', 'transaction_type_badge', 'amount_display', 'phone_number', 
         'status_badge', 'mpesa_receipt_number_short', 'transaction_date', 'created_at'
     ]
+    list_select_related = ['user']
+    changelist_defer = ('result_desc',)
     list_filter = ['transaction_type', 'status', 'created_at', 'transaction_date']
     search_fields = [
         'user__username', 'phone_number', 'mpesa_receipt_number', 
@@ -157,8 +280,10 @@ class MpesaTransactionAdmin(admin.ModelAdmin):
     result_info.short_description = 'Result'
 
 @admin.register(Analyst)
-class AnalystAdmin(admin.ModelAdmin):
+class AnalystAdmin(ChangelistQuerysetMixin, admin.ModelAdmin):
     list_display = ['user', 'analyst_name', 'experience_years', 'verified', 'total_sales', 'rating_stars', 'joined_date']
+    list_select_related = ['user']
+    changelist_defer = ('bio',)
     list_filter = ['verified', 'experience_years', 'joined_date']
     search_fields = ['user__username', 'user__first_name', 'user__last_name', 'specialization']
     readonly_fields = ['joined_date', 'total_sales', 'rating']
@@ -174,7 +299,8 @@ class AnalystAdmin(admin.ModelAdmin):
     rating_stars.short_description = 'Rating'
 
 @admin.register(MarketInsight)
-class MarketInsightAdmin(admin.ModelAdmin):
+class MarketInsightAdmin(ProjectedChangelistMixin, admin.ModelAdmin):
+    change_list_template = 'admin/dashboard/cryptoanalysis/change_list.html'
     list_display = [
         'title', 'insight_type_badge', 'cryptocurrency', 
         'urgency_badge', 'impact_level_badge', 'is_verified', 
@@ -231,7 +357,7 @@ class MarketInsightAdmin(admin.ModelAdmin):
     impact_level_badge.short_description = 'Impact'
 
 @admin.register(CryptoAnalysis)
-class CryptoAnalysisAdmin(admin.ModelAdmin):
+class CryptoAnalysisAdmin(ProjectedChangelistMixin, admin.ModelAdmin):
     list_display = [
         'cryptocurrency', 'symbol', 'analyst', 'analysis_type', 
         'price_display', 'risk_level_badge', 'recommendation_badge', 
@@ -242,6 +368,45 @@ class CryptoAnalysisAdmin(admin.ModelAdmin):
     readonly_fields = ['sales_count', 'views_count', 'rating', 'created_at', 'updated_at', 'chart_data_preview']
     list_editable = ['is_active', 'is_featured']
     filter_horizontal = []
+    list_select_related = ['analyst__user']
+    change_list_template = 'admin/dashboard/cryptoanalysis/change_list.html'
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_chart_flag()
+
+    def get_urls(self):
+        return [
+            path('import/', self.admin_site.admin_view(self.import_view), name='dashboard_content_import'),
+        ] + super().get_urls()
+
+    def import_view(self, request):
+        """Upload a bundle of analyses and insights (see dashboard.imports)"""
+        if not self.has_add_permission(request):
+            return HttpResponseRedirect(reverse('admin:dashboard_cryptoanalysis_changelist'))
+        form = ContentImportForm(request.POST or None, request.FILES or None)
+        errors = []
+        if request.method == 'POST' and form.is_valid():
+            upload = form.cleaned_data['bundle']
+            try:
+                result = import_bundle(upload.file, upload.name, dry_run=form.cleaned_data['dry_run'])
+            except ContentImportError as exc:
+                errors = exc.errors
+                self.message_user(request, f"{upload.name} was rejected: {exc}", messages.ERROR)
+            else:
+                verb = "Validated" if form.cleaned_data['dry_run'] else "Imported"
+                self.message_user(request, (
+                    f"{verb} {result.analyses} analyses and {result.insights} insights from {upload.name} "
+                    f"in {result.elapsed:.2f}s ({result.rate:,.0f} records/s)"
+                ), messages.SUCCESS)
+                return HttpResponseRedirect(reverse('admin:dashboard_cryptoanalysis_changelist'))
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Import analyses and insights',
+            'form': form,
+            'errors': errors,
+        }
+        return TemplateResponse(request, 'admin/dashboard/cryptoanalysis/import.html', context)
     
     def price_display(self, obj):
         if obj.discount_percentage > 0:
@@ -284,6 +449,7 @@ class CryptoAnalysisAdmin(admin.ModelAdmin):
         return obj.has_interactive_charts
     has_charts.boolean = True
     has_charts.short_description = 'Charts'
+    has_charts.admin_order_field = 'has_charts_flag'
     
     def chart_data_preview(self, obj):
         if obj.chart_data:
@@ -293,8 +459,10 @@ class CryptoAnalysisAdmin(admin.ModelAdmin):
     chart_data_preview.short_description = 'Chart Data'
 
 @admin.register(ChartAnnotation)
-class ChartAnnotationAdmin(admin.ModelAdmin):
+class ChartAnnotationAdmin(ChangelistQuerysetMixin, admin.ModelAdmin):
     list_display = ['analysis', 'type_badge', 'price_level', 'description_short', 'created_at']
+    list_select_related = ['analysis']
+    changelist_analysis_paths = ('analysis',)
     list_filter = ['type', 'created_at']
     search_fields = ['analysis__cryptocurrency', 'description']
     readonly_fields = ['created_at']
@@ -322,8 +490,11 @@ class ChartAnnotationAdmin(admin.ModelAdmin):
     description_short.short_description = 'Description'
 
 @admin.register(TechnicalIndicatorData)
-class TechnicalIndicatorDataAdmin(admin.ModelAdmin):
+class TechnicalIndicatorDataAdmin(ChangelistQuerysetMixin, admin.ModelAdmin):
     list_display = ['analysis', 'indicator_type_badge', 'parameters_display', 'created_at']
+    list_select_related = ['analysis']
+    changelist_defer = ('data',)
+    changelist_analysis_paths = ('analysis',)
     list_filter = ['indicator_type', 'created_at']
     search_fields = ['analysis__cryptocurrency']
     readonly_fields = ['created_at']
@@ -352,8 +523,11 @@ class TechnicalIndicatorDataAdmin(admin.ModelAdmin):
     parameters_display.short_description = 'Parameters'
 
 @admin.register(AnalysisInsight)
-class AnalysisInsightAdmin(admin.ModelAdmin):
+class AnalysisInsightAdmin(ChangelistQuerysetMixin, admin.ModelAdmin):
     list_display = ['analysis', 'title', 'importance_badge', 'category_badge', 'created_at']
+    list_select_related = ['analysis']
+    changelist_defer = ('description',)
+    changelist_analysis_paths = ('analysis',)
     list_filter = ['importance', 'category', 'created_at']
     search_fields = ['analysis__cryptocurrency', 'title', 'description']
     readonly_fields = ['created_at']
@@ -388,8 +562,10 @@ class AnalysisInsightAdmin(admin.ModelAdmin):
     category_badge.short_description = 'Category'
 
 @admin.register(AnalysisMetric)
-class AnalysisMetricAdmin(admin.ModelAdmin):
+class AnalysisMetricAdmin(ChangelistQuerysetMixin, admin.ModelAdmin):
     list_display = ['analysis', 'name', 'current_value', 'previous_value', 'change', 'trend_badge']
+    list_select_related = ['analysis']
+    changelist_analysis_paths = ('analysis',)
     list_filter = ['trend']
     search_fields = ['analysis__cryptocurrency', 'name']
     
@@ -412,9 +588,11 @@ class AnalysisMetricAdmin(admin.ModelAdmin):
     trend_badge.short_description = 'Trend'
 
 @admin.register(PurchasedAnalysis)
-class PurchasedAnalysisAdmin(admin.ModelAdmin):
+class PurchasedAnalysisAdmin(UserStatsRebuildMixin, ChangelistQuerysetMixin, admin.ModelAdmin):
     list_display = ['user', 'analysis', 'purchase_price_display', 'purchased_at', 'access_expires', 'is_expired_badge', 'rating_given_stars']
-    list_filter = ['purchased_at', 'access_expires']
+    list_select_related = ['user', 'analysis']
+    changelist_analysis_paths = ('analysis',)
+    list_filter = ['access_expired', 'purchased_at', 'access_expires']
     search_fields = ['user__username', 'analysis__cryptocurrency', 'analysis__symbol']
     readonly_fields = ['purchased_at']
     list_per_page = 25
@@ -424,10 +602,11 @@ class PurchasedAnalysisAdmin(admin.ModelAdmin):
     purchase_price_display.short_description = 'Price'
     
     def is_expired_badge(self, obj):
-        if obj.is_expired:
+        if obj.access_expired:
             return format_html('<span style="color: red;">Expired</span>')
         return format_html('<span style="color: green;">Active</span>')
     is_expired_badge.short_description = 'Status'
+    is_expired_badge.admin_order_field = 'access_expired'
     
     def rating_given_stars(self, obj):
         if obj.rating_given:
@@ -437,11 +616,19 @@ class PurchasedAnalysisAdmin(admin.ModelAdmin):
     rating_given_stars.short_description = 'Rating'
 
 @admin.register(AnalysisRating)
-class AnalysisRatingAdmin(admin.ModelAdmin):
+class AnalysisRatingAdmin(ChangelistQuerysetMixin, admin.ModelAdmin):
     list_display = ['analysis', 'user', 'rating_stars', 'created_at', 'has_review']
     list_filter = ['rating', 'created_at']
     search_fields = ['analysis__cryptocurrency', 'user__username', 'review']
     readonly_fields = ['created_at']
+    list_select_related = ['analysis', 'user']
+    changelist_defer = ('review',)
+    changelist_analysis_paths = ('analysis',)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            has_review_flag=ExpressionWrapper(Q(review__isnull=False) & ~Q(review=''), output_field=BooleanField()),
+        )
     
     def rating_stars(self, obj):
         stars = '★' * obj.rating + '☆' * (5 - obj.rating)
@@ -449,25 +636,26 @@ class AnalysisRatingAdmin(admin.ModelAdmin):
     rating_stars.short_description = 'Rating'
     
     def has_review(self, obj):
-        return bool(obj.review)
+        return obj.has_review_flag
     has_review.boolean = True
     has_review.short_description = 'Has Review'
+    has_review.admin_order_field = 'has_review_flag'
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
-    list_display = ['name', 'analyses_count', 'is_active']
+    # Categories are not linked to analyses, so there is no per-category count to show
+    list_display = ['name', 'is_active']
     list_filter = ['is_active']
     search_fields = ['name', 'description']
     list_editable = ['is_active']
-    
-    def analyses_count(self, obj):
-        return obj.cryptoanalysis_set.count()
-    analyses_count.short_description = 'Analyses'
 
 @admin.register(Consultation)
-class ConsultationAdmin(admin.ModelAdmin):
-    list_display = ['user', 'title', 'level_badge', 'price_display', 'scheduled_date', 'status_badge', 'created_at']
+class ConsultationAdmin(UserStatsRebuildMixin, ChangelistQuerysetMixin, admin.ModelAdmin):
+    list_display = ['user', 'title', 'analyst', 'level_badge', 'price_display', 'scheduled_date', 'status_badge', 'created_at']
+    list_select_related = ['user', 'analyst__user']
+    changelist_defer = ('description', 'notes', 'analyst__bio', 'analyst__consultation_hours')
     list_filter = ['level', 'status', 'scheduled_date', 'created_at']
+    raw_id_fields = ['analyst']
     search_fields = ['user__username', 'title', 'description', 'notes']
     readonly_fields = ['created_at', 'updated_at']
     
@@ -503,12 +691,13 @@ class ConsultationAdmin(admin.ModelAdmin):
     status_badge.short_description = 'Status'
 
 @admin.register(ConsultationPackage)
-class ConsultationPackageAdmin(admin.ModelAdmin):
+class ConsultationPackageAdmin(ChangelistQuerysetMixin, admin.ModelAdmin):
     list_display = ['title', 'level_badge', 'price_display', 'duration_display', 'is_active', 'created_at']
     list_filter = ['level', 'is_active', 'created_at']
     search_fields = ['title', 'description']
     list_editable = ['is_active']
     readonly_fields = ['created_at', 'updated_at', 'features_preview']
+    changelist_defer = ('description', 'features')
     
     def level_badge(self, obj):
         colors = {
@@ -540,8 +729,10 @@ class ConsultationPackageAdmin(admin.ModelAdmin):
     features_preview.short_description = 'Features Preview'
 
 @admin.register(ConsultationAttachment)
-class ConsultationAttachmentAdmin(admin.ModelAdmin):
+class ConsultationAttachmentAdmin(ChangelistQuerysetMixin, admin.ModelAdmin):
     list_display = ['consultation', 'file_name', 'file_type', 'uploaded_by', 'uploaded_at']
+    list_select_related = ['consultation__user', 'uploaded_by']
+    changelist_defer = ('description', 'consultation__description', 'consultation__notes')
     list_filter = ['file_type', 'uploaded_at']
     search_fields = ['consultation__title', 'file_name', 'description']
     readonly_fields = ['uploaded_at']
@@ -553,11 +744,13 @@ class ConsultationAttachmentAdmin(admin.ModelAdmin):
     file_preview.short_description = 'File'
 
 @admin.register(ConsultationReminder)
-class ConsultationReminderAdmin(admin.ModelAdmin):
-    list_display = ['consultation', 'reminder_type_badge', 'scheduled_time', 'is_sent_badge', 'sent_time']
+class ConsultationReminderAdmin(ChangelistQuerysetMixin, admin.ModelAdmin):
+    list_display = ['consultation', 'reminder_type_badge', 'scheduled_time', 'is_sent_badge', 'sent_time', 'attempts']
+    list_select_related = ['consultation__user']
+    changelist_defer = ('consultation__description', 'consultation__notes')
     list_filter = ['reminder_type', 'is_sent', 'scheduled_time']
     search_fields = ['consultation__title', 'consultation__user__username']
-    readonly_fields = ['created_at']
+    readonly_fields = ['attempts', 'last_error', 'created_at']
     
     def reminder_type_badge(self, obj):
         colors = {
@@ -575,9 +768,103 @@ class ConsultationReminderAdmin(admin.ModelAdmin):
     def is_sent_badge(self, obj):
         if obj.is_sent:
             return format_html('<span style="color: green;">✓ Sent</span>')
+        if obj.last_error:
+            return format_html('<span style="color: red;" title="{}">Retrying</span>', obj.last_error)
         return format_html('<span style="color: orange;">Pending</span>')
     is_sent_badge.short_description = 'Status'
 
+@admin.register(UserStats)
+class UserStatsAdmin(admin.ModelAdmin):
+    list_display = ['user', 'purchase_count', 'total_spent', 'total_deposited', 'total_withdrawn', 'consultations_booked', 'updated_at']
+    search_fields = ['user__username', 'user__email']
+    list_select_related = ['user']
+    readonly_fields = ['user'] + UserStats.STAT_FIELDS + ['updated_at']
+
+@admin.register(AnalysisNeighbors)
+class AnalysisNeighborsAdmin(ChangelistQuerysetMixin, admin.ModelAdmin):
+    list_display = ['analysis', 'buyer_count', 'neighbor_ids', 'updated_at']
+    search_fields = ['analysis__cryptocurrency', 'analysis__symbol', 'analysis__title']
+    list_select_related = ['analysis']
+    readonly_fields = ['analysis', 'neighbor_ids', 'co_purchase_counts', 'buyer_count', 'updated_at']
+    changelist_defer = ('co_purchase_counts',)
+    changelist_analysis_paths = ('analysis',)
+
+@admin.register(AnalystRanking)
+class AnalystRankingAdmin(admin.ModelAdmin):
+    list_display = ['analyst', 'total_sales', 'revenue', 'rating', 'updated_at']
+    list_select_related = ['analyst__user']
+    ordering = ['-total_sales']
+    readonly_fields = ['analyst', 'total_sales', 'revenue', 'rating', 'updated_at']
+
+@admin.register(DailyRollup)
+class DailyRollupAdmin(ChangelistQuerysetMixin, admin.ModelAdmin):
+    list_display = ['date', 'transaction_type', 'payment_method', 'analysis', 'analyst', 'count', 'amount']
+    list_filter = ['transaction_type', 'payment_method']
+    date_hierarchy = 'date'
+    list_select_related = ['analysis', 'analyst__user']
+    readonly_fields = ['date', 'transaction_type', 'payment_method', 'analysis', 'analyst', 'count', 'amount', 'updated_at']
+    change_list_template = 'admin/dashboard/dailyrollup/change_list.html'
+    changelist_analysis_paths = ('analysis',)
+    report_days = 30
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_urls(self):
+        return [
+            path('report/', self.admin_site.admin_view(self.report_view), name='dashboard_dailyrollup_report'),
+        ] + super().get_urls()
+
+    def _report_params(self, request):
+        today = timezone.localdate()
+        try:
+            start = datetime.date.fromisoformat(request.GET.get('start', ''))
+        except ValueError:
+            start = today - datetime.timedelta(days=self.report_days - 1)
+        try:
+            end = datetime.date.fromisoformat(request.GET.get('end', ''))
+        except ValueError:
+            end = today
+        group = request.GET.get('group') if request.GET.get('group') in GROUPINGS else 'date'
+        return {
+            'start': start,
+            'end': end,
+            'group': group,
+            'transaction_types': [value for value in request.GET.getlist('type') if value],
+            'payment_methods': [value for value in request.GET.getlist('method') if value],
+        }
+
+    def report_view(self, request):
+        params = self._report_params(request)
+        rows = list(rollup_report(**params))
+        labels = [str(row[GROUPINGS[params['group']][-1]]) for row in rows]
+
+        if request.GET.get('format') == 'csv':
+            response = HttpResponse(content_type='text/csv')
+            response['Content-Disposition'] = (
+                f'attachment; filename="revenue_{params["group"]}_{params["start"]}_{params["end"]}.csv"'
+            )
+            writer = csv.writer(response)
+            writer.writerow([params['group'], 'count', 'amount'])
+            for label, row in zip(labels, rows):
+                writer.writerow([label, row['count'], f"{row['amount']:.2f}"])
+            return response
+
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Revenue report',
+            'rows': list(zip(labels, rows)),
+            'chart': {'labels': labels, 'amounts': [float(row['amount']) for row in rows],
+                      'counts': [row['count'] for row in rows]},
+            'groupings': list(GROUPINGS),
+            'transaction_type_choices': TRANSACTION_TYPES,
+            'total_amount': sum(row['amount'] for row in rows),
+            'total_count': sum(row['count'] for row in rows),
+            **params,
+        }
+        return TemplateResponse(request, 'admin/dashboard/dailyrollup/report.html', context)
+
 @admin.register(SiteSetting)
 class SiteSettingAdmin(admin.ModelAdmin):
     list_display = ['name', 'is_active', 'hero_video_preview', 'created_at']
@@ -593,7 +880,7 @@ class SiteSettingAdmin(admin.ModelAdmin):
                 '<source src="{}" type="video/mp4">'
                 'Your browser does not support the video tag.'
                 '</video>',
-                obj.hero_video.url
+                reverse('hero_video', args=[obj.pk])
             )
         return "No Video"
     hero_video_preview.short_description = 'Hero Video Preview'
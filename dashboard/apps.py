@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class DashboardConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'dashboard'
+
+    def ready(self):
+        # Connect cache invalidation receivers and register system checks
+        from . import (  # noqa: F401
+            checks, entitlements, fragments, images, rankings, ratings, recommendations, reports, rollups, routers, scheduling,
+            summary,
+        )
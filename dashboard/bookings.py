@@ -0,0 +1,81 @@
+"""
+Consultation booking service.
+
+Saving a Consultation one at a time fires the post_save receivers in
+dashboard.models, which generate the meeting details with a second write
+and insert the two reminders separately.  ``create_consultations`` prepares
+the meeting details before the insert and writes a whole batch of
+consultations and their reminders with one ``bulk_create`` each, so booking
+a single session, a weekly series or a corporate block of many sessions
+takes the same number of queries.  Consultations it has prepared are marked
+so the receivers leave them alone; they remain the fallback for
+consultations created any other way.
+
+``book_sessions`` claims an analyst for every session through
+dashboard.scheduling before creating them, in the same transaction.
+"""
+from datetime import timedelta
+
+from django.db import connection, transaction as db_transaction
+
+from .models import Consultation, ConsultationReminder
+from .scheduling import claim_analyst, invalidate_bookings
+from .summary import invalidate_user_summary
+
+
+def create_consultations(consultations):
+    """
+    Insert unsaved consultations with their meeting details and reminders.
+    Returns the consultations, now with primary keys.
+    """
+    for consultation in consultations:
+        consultation.set_ends_at()
+        if consultation.status == 'scheduled':
+            consultation.assign_meeting_details()
+        consultation._booking_prepared = True
+
+    with db_transaction.atomic():
+        if connection.features.can_return_rows_from_bulk_insert:
+            Consultation.objects.bulk_create(consultations)
+        else:
+            # The reminders need the ids, which this backend cannot return from a bulk insert
+            for consultation in consultations:
+                consultation.save()
+        ConsultationReminder.objects.bulk_create([
+            reminder
+            for consultation in consultations if consultation.status == 'scheduled'
+            for reminder in consultation.build_reminders()
+        ])
+
+    # bulk_create sends no post_save, so do what its receivers would
+    for user_id in {consultation.user_id for consultation in consultations}:
+        invalidate_user_summary(user_id)
+    if any(consultation.analyst_id for consultation in consultations):
+        invalidate_bookings()
+    return consultations
+
+
+def book_sessions(starts, duration, analyst_id=None, **fields):
+    """
+    Book a ``duration`` minute session at each time in ``starts``, all with
+    one analyst: ``analyst_id`` or the first free for every session.
+    ``fields`` are set on each Consultation.  Raises SlotUnavailable, booking
+    nothing, if no analyst can take them all.
+    """
+    starts = sorted(starts)
+    with db_transaction.atomic():
+        analyst_id = claim_analyst(starts, duration, analyst_id)
+        return create_consultations([
+            Consultation(analyst_id=analyst_id, scheduled_date=start, duration_minutes=duration, **fields)
+            for start in starts
+        ])
+
+
+def book_series(first_start, sessions, duration, every=timedelta(weeks=1), analyst_id=None, **fields):
+    """Book ``sessions`` recurring sessions, ``every`` apart from ``first_start``"""
+    return book_sessions([first_start + every * number for number in range(sessions)], duration, analyst_id, **fields)
+
+
+def allocate_slot(start, duration, analyst_id=None, **fields):
+    """Book one session at ``start``; see book_sessions"""
+    return book_sessions([start], duration, analyst_id, **fields)[0]
@@ -0,0 +1,72 @@
+from pathlib import Path
+
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+
+def _build_template_dir():
+    build_dir = getattr(settings, 'ASSET_BUILD_DIR', None)
+    if build_dir is None:
+        return None
+    template_dir = Path(build_dir) / 'templates'
+    for engine in settings.TEMPLATES:
+        if template_dir in map(Path, engine.get('DIRS', [])):
+            return template_dir
+    return None
+
+
+@register(Tags.templates)
+def check_asset_build(app_configs, **kwargs):
+    """
+    Templates in ASSET_BUILD_DIR shadow the ones they were built from, so a
+    build older than its source would keep serving the old page.  Fail until
+    ``manage.py extract_inline_assets`` is run again.
+    """
+    template_dir = _build_template_dir()
+    if template_dir is None or not template_dir.is_dir():
+        return []
+    source_dir = Path(settings.BASE_DIR) / 'templates'
+    errors = []
+    for built in sorted(template_dir.rglob('*.html')):
+        relative = built.relative_to(template_dir)
+        source = source_dir / relative
+        if not source.exists():
+            problem = f"Built template {relative} has no source in {source_dir}."
+        elif source.stat().st_mtime > built.stat().st_mtime:
+            problem = f"Built template {relative} is older than its source and would hide the change."
+        else:
+            continue
+        errors.append(Error(
+            problem,
+            hint="Run `manage.py extract_inline_assets --clean` and collectstatic as part of the deploy.",
+            obj=str(built),
+            id='dashboard.E001',
+        ))
+    return errors
+
+
+# Cache backends that keep each worker's entries to itself
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register(Tags.caches)
+def check_replica_pins(app_configs, **kwargs):
+    """
+    A write pins its user to the primary through the default cache
+    (dashboard.routers.pin_user); other workers only see the pin if the
+    cache is shared.
+    """
+    if not getattr(settings, 'REPLICA_DATABASES', None):
+        return []
+    backend = settings.CACHES.get('default', {}).get('BACKEND', '')
+    if backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [Error(
+        f"Read replicas are configured but the default cache ({backend}) is not shared between workers, "
+        "so a user's reads can go to a replica that has not caught up with their writes.",
+        hint="Use a shared cache for 'default' (REDIS_URL, or the file cache on a single host).",
+        id='dashboard.E002',
+    )]
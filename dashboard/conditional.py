@@ -0,0 +1,70 @@
+"""
+Conditional GET support (ETag / Last-Modified) for analysis and insight pages.
+
+Validators are built from the object's ``(id, updated_at)`` read with a
+single-column query, the user's entitlement generation (bumped on every
+purchase change) and, for HTML pages, the wallet's ``updated_at`` because
+the header shows the balance.  A matching ``If-None-Match`` or
+``If-Modified-Since`` lets ``django.views.decorators.http.condition`` return
+304 before the view loads the full row.
+"""
+import hashlib
+
+from django.views.decorators.http import condition
+
+from .entitlements import entitlement_generation
+from .models import CryptoAnalysis, MarketInsight, UserWallet
+
+# Attribute used to share validators between the etag and last-modified hooks
+_REQUEST_ATTR = '_conditional_validators'
+
+
+def _validators(request, model, object_id, include_wallet):
+    cached = getattr(request, _REQUEST_ATTR, None)
+    if cached is not None:
+        return cached
+
+    etag = last_modified = None
+    updated_at = model.objects.filter(pk=object_id, is_active=True).values_list('updated_at', flat=True).first()
+    # Pending flash messages are rendered into the page, so always send a body
+    if updated_at is not None and not len(getattr(request, '_messages', ())):
+        user = request.user
+        parts = [
+            model._meta.model_name, object_id, updated_at.timestamp(), user.pk,
+            entitlement_generation(user.pk),
+            # e.g. a sparse fieldset changes the representation
+            request.META.get('QUERY_STRING', ''),
+        ]
+        last_modified = updated_at
+        if include_wallet:
+            wallet_updated = UserWallet.objects.filter(user=user).values_list('updated_at', flat=True).first()
+            if wallet_updated is None:
+                # Wallet is created by the view; nothing stable to validate against yet
+                updated_at = None
+            else:
+                parts.append(wallet_updated.timestamp())
+                last_modified = max(last_modified, wallet_updated)
+        if updated_at is not None:
+            etag = hashlib.md5(':'.join(str(part) for part in parts).encode()).hexdigest()
+        else:
+            last_modified = None
+
+    cached = (etag, last_modified)
+    setattr(request, _REQUEST_ATTR, cached)
+    return cached
+
+
+def conditional_on(model, url_kwarg, include_wallet=True):
+    """``condition`` decorator validating on ``model`` row ``url_kwarg`` for the current user"""
+    def etag(request, *args, **kwargs):
+        return _validators(request, model, kwargs[url_kwarg], include_wallet)[0]
+
+    def last_modified(request, *args, **kwargs):
+        return _validators(request, model, kwargs[url_kwarg], include_wallet)[1]
+
+    return condition(etag_func=etag, last_modified_func=last_modified)
+
+
+analysis_conditional = conditional_on(CryptoAnalysis, 'analysis_id')
+analysis_api_conditional = conditional_on(CryptoAnalysis, 'analysis_id', include_wallet=False)
+insight_conditional = conditional_on(MarketInsight, 'insight_id')
@@ -0,0 +1,153 @@
+"""
+Per-user entitlement cache for purchased analyses.
+
+Each user's owned analysis ids are kept in the default cache as the raw bytes
+of a sorted ``array('q')``, so membership checks are a binary search instead
+of a database ``exists()`` query or a linear scan over a Python list.  Any
+purchase change drops the entry once it commits, and the next read rebuilds
+it from PurchasedAnalysis.
+
+The cached set is only trusted to say yes: ``user_owns_analysis`` falls back
+to the database when the id is missing, so a purchase is honoured even
+before the entry is dropped, and the purchase views check the database with
+``has_purchased`` before taking payment.
+
+Every change also bumps a per-user generation counter.  A rebuild only
+keeps its result if the generation is unchanged, so a purchase committing
+while another request rebuilds the set cannot be lost.
+"""
+import json
+from array import array
+from bisect import bisect_left
+
+from django.core.cache import cache
+from django.db import transaction as db_transaction
+from django.db.models.signals import post_delete, post_save
+
+from .models import PurchasedAnalysis
+
+ENTITLEMENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Attribute used to memoize the decoded set on a user instance for one request
+_USER_ATTR = '_owned_analyses'
+
+
+def entitlement_cache_key(user_id):
+    return f"dashboard:owned_analyses:{user_id}"
+
+
+def _generation_cache_key(user_id):
+    return f"dashboard:owned_analyses_gen:{user_id}"
+
+
+def _bump_generation(user_id):
+    key = _generation_cache_key(user_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, None)
+
+
+def entitlement_generation(user_id):
+    """Counter bumped whenever the user's purchases change"""
+    return cache.get(_generation_cache_key(user_id), 0)
+
+
+class OwnedAnalyses:
+    """Sorted, compact set of analysis ids owned by one user"""
+    __slots__ = ('_ids',)
+
+    def __init__(self, ids=()):
+        self._ids = array('q', sorted(set(ids)))
+
+    @classmethod
+    def from_bytes(cls, data):
+        owned = cls()
+        owned._ids.frombytes(data)
+        return owned
+
+    def to_bytes(self):
+        return self._ids.tobytes()
+
+    def __contains__(self, analysis_id):
+        try:
+            analysis_id = int(analysis_id)
+        except (TypeError, ValueError):
+            return False
+        index = bisect_left(self._ids, analysis_id)
+        return index < len(self._ids) and self._ids[index] == analysis_id
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __str__(self):
+        # Rendered into inline scripts as a JSON array
+        return json.dumps(self._ids.tolist())
+
+
+def _load_owned_analyses(user_id):
+    key = entitlement_cache_key(user_id)
+    data = cache.get(key)
+    if data is not None:
+        return OwnedAnalyses.from_bytes(data)
+    generation = entitlement_generation(user_id)
+    owned = OwnedAnalyses(
+        PurchasedAnalysis.objects.filter(user_id=user_id).values_list('analysis_id', flat=True)
+    )
+    if entitlement_generation(user_id) == generation:
+        cache.set(key, owned.to_bytes(), ENTITLEMENT_CACHE_TIMEOUT)
+        # A change committing between the check and the set must not be masked
+        if entitlement_generation(user_id) != generation:
+            cache.delete(key)
+    return owned
+
+
+def get_owned_analyses(user):
+    """Return the user's OwnedAnalyses, memoized on the user instance"""
+    if not getattr(user, 'is_authenticated', False):
+        return OwnedAnalyses()
+    owned = getattr(user, _USER_ATTR, None)
+    if owned is None:
+        owned = _load_owned_analyses(user.pk)
+        setattr(user, _USER_ATTR, owned)
+    return owned
+
+
+def has_purchased(user, analysis_id):
+    """Database check used before taking payment, never answered from the cache"""
+    if not getattr(user, 'is_authenticated', False):
+        return False
+    return PurchasedAnalysis.objects.filter(user_id=user.pk, analysis_id=analysis_id).exists()
+
+
+def user_owns_analysis(user, analysis_id):
+    if analysis_id in get_owned_analyses(user):
+        return True
+    if not has_purchased(user, analysis_id):
+        return False
+    # The cached set is behind the database; rebuild it on the next read
+    invalidate_owned_analyses(user.pk)
+    setattr(user, _USER_ATTR, None)
+    return True
+
+
+def invalidate_owned_analyses(user_id):
+    _bump_generation(user_id)
+    cache.delete(entitlement_cache_key(user_id))
+
+
+def _purchase_saved(sender, instance, **kwargs):
+    user_id = instance.user_id
+    db_transaction.on_commit(lambda: invalidate_owned_analyses(user_id))
+
+
+def _purchase_deleted(sender, instance, **kwargs):
+    invalidate_owned_analyses(instance.user_id)
+    db_transaction.on_commit(lambda: invalidate_owned_analyses(instance.user_id))
+
+
+post_save.connect(_purchase_saved, sender=PurchasedAnalysis, dispatch_uid='entitlements_purchase_saved')
+post_delete.connect(_purchase_deleted, sender=PurchasedAnalysis, dispatch_uid='entitlements_purchase_deleted')
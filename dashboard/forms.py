@@ -23,4 +23,9 @@ class DepositForm(forms.Form):
 
 class WithdrawalForm(forms.Form):
     amount = forms.DecimalField(max_digits=10, decimal_places=2, min_value=1)
-    payment_method = forms.ChoiceField(choices=UserWallet.PAYMENT_METHODS)
\ No newline at end of file
+    payment_method = forms.ChoiceField(choices=UserWallet.PAYMENT_METHODS)
+
+
+class ContentImportForm(forms.Form):
+    bundle = forms.FileField(help_text="JSON-lines (.jsonl) or zip bundle of analyses and insights")
+    dry_run = forms.BooleanField(required=False, help_text="Validate only; nothing is saved")
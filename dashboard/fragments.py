@@ -0,0 +1,85 @@
+"""
+Versioned template fragment caching for analysis and insight cards.
+
+Card markup is the same for every user, so each card body is cached with
+``{% cache %}`` under a token built from the object id, its ``updated_at``
+and a per-kind version counter.  Per-user parts of a card (owned / not owned,
+KES prices) stay outside the cached block.
+
+Saving or deleting an object drops the fragment rendered for the state it
+was loaded with, so stale entries do not linger until they time out.  The
+per-kind version is bumped after migrations, which may change what the
+cards render; ``invalidate_card_fragments`` does the same on demand.
+"""
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.db.models.signals import post_delete, post_init, post_migrate, post_save
+
+from .models import CryptoAnalysis, MarketInsight
+
+CARD_FRAGMENT_TIMEOUT = 60 * 60 * 24
+
+# Fragment names rendered for each kind of card
+CARD_FRAGMENTS = {
+    'analysis': ('analysis_card',),
+    'insight': ('insight_card', 'insight_card_compact'),
+}
+
+CARD_MODELS = {
+    CryptoAnalysis: 'analysis',
+    MarketInsight: 'insight',
+}
+
+# Attribute holding the updated_at value an instance was loaded with
+_LOADED_ATTR = '_card_loaded_updated_at'
+
+
+def _version_cache_key(kind):
+    return f"dashboard:card_fragment_version:{kind}"
+
+
+def card_fragment_version(kind):
+    return cache.get_or_set(_version_cache_key(kind), 1, None)
+
+
+def invalidate_card_fragments(kind):
+    """Orphan every cached card of ``kind`` by bumping its version"""
+    key = _version_cache_key(kind)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 2, None)
+
+
+def card_fragment_token(kind, pk, updated_at, version=None):
+    """Value the card templates pass to ``{% cache %}`` as their vary-on key"""
+    if version is None:
+        version = card_fragment_version(kind)
+    stamp = updated_at.timestamp() if updated_at else 0
+    return f"{pk}:{stamp}:{version}"
+
+
+def _remember_loaded_state(sender, instance, **kwargs):
+    setattr(instance, _LOADED_ATTR, instance.__dict__.get('updated_at'))
+
+
+def _drop_loaded_fragment(sender, instance, **kwargs):
+    loaded = getattr(instance, _LOADED_ATTR, None)
+    if instance.pk and loaded is not None:
+        kind = CARD_MODELS[sender]
+        token = card_fragment_token(kind, instance.pk, loaded)
+        cache.delete_many([make_template_fragment_key(name, [token]) for name in CARD_FRAGMENTS[kind]])
+    setattr(instance, _LOADED_ATTR, instance.__dict__.get('updated_at'))
+
+
+def _invalidate_after_migrate(sender, **kwargs):
+    for kind in CARD_FRAGMENTS:
+        invalidate_card_fragments(kind)
+
+
+for _model in CARD_MODELS:
+    post_init.connect(_remember_loaded_state, sender=_model, dispatch_uid=f'card_fragment_init_{_model.__name__}')
+    post_save.connect(_drop_loaded_fragment, sender=_model, dispatch_uid=f'card_fragment_save_{_model.__name__}')
+    post_delete.connect(_drop_loaded_fragment, sender=_model, dispatch_uid=f'card_fragment_delete_{_model.__name__}')
+
+post_migrate.connect(_invalidate_after_migrate, dispatch_uid='card_fragment_migrate')
@@ -0,0 +1,261 @@
+"""
+Resized WebP and JPEG/PNG derivatives of uploaded images.
+
+Each image field listed in IMAGE_SPECS gets a sibling ``<field>_variants``
+JSON column recording the derivatives made from its current file::
+
+    {"source": "profile_pics/user_3/profile_picture_3.jpg", "widths": [64, 128], "fallback": "jpg"}
+
+Derivatives are stored next to the original under deterministic names,
+``<name without extension>.<width>w.<webp|jpg|png>``, for every spec width
+up to the original's own width.  ``source`` ties the record to the file it
+was made from, so a replaced image falls back to its original until its own
+derivatives exist.
+
+A new upload is processed after the save commits, on a small thread pool
+(IMAGE_DERIVATIVE_WORKERS threads; 0 processes inline).  The
+``regenerate_images`` command rebuilds derivatives in bulk on a process
+pool.  Templates use the ``{% responsive_image %}`` tag from
+``dashboard_images`` to render a ``<picture>`` with srcsets.
+"""
+import io
+import logging
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction as db_transaction
+from django.db.models.signals import post_init, post_save
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .models import CryptoAnalysis, UserProfile
+
+logger = logging.getLogger(__name__)
+
+ImageSpec = namedtuple('ImageSpec', ['widths', 'square'])
+
+# (model, image field name) -> derivative widths and whether to crop square
+IMAGE_SPECS = {
+    (UserProfile, 'profile_picture'): ImageSpec(widths=(64, 128, 256), square=True),
+    (CryptoAnalysis, 'chart_image'): ImageSpec(widths=(480, 960, 1600), square=False),
+}
+
+WEBP_QUALITY = 80
+JPEG_QUALITY = 82
+
+# Attribute holding the image names an instance was loaded with
+_LOADED_ATTR = '_image_loaded_names'
+
+_executor = None
+
+
+def variants_field(field_name):
+    return f'{field_name}_variants'
+
+
+def derivative_name(name, width, extension):
+    root, _ = os.path.splitext(name)
+    return f'{root}.{width}w.{extension}'
+
+
+def derivative_names(name, variants):
+    """Storage names of every derivative described by ``variants``"""
+    return [
+        derivative_name(name, width, extension)
+        for width in variants.get('widths', [])
+        for extension in ('webp', variants.get('fallback', 'jpg'))
+    ]
+
+
+def possible_derivative_names(name, spec):
+    """Every name ``spec`` could have given a derivative of ``name``"""
+    return [
+        derivative_name(name, width, extension)
+        for width in spec.widths for extension in ('webp', 'jpg', 'png')
+    ]
+
+
+def render_derivatives(data, spec):
+    """
+    Resize the image bytes ``data`` for ``spec``; returns ``(fallback
+    extension, {(width, extension): bytes})``.
+    """
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)
+        has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+    fallback = 'png' if has_alpha else 'jpg'
+
+    size = min(image.size) if spec.square else image.width
+    widths = [width for width in spec.widths if width <= size] or [min(spec.widths[0], size)]
+    rendered = {}
+    for width in widths:
+        if spec.square:
+            resized = ImageOps.fit(image, (width, width), Image.LANCZOS)
+        else:
+            resized = image.resize((width, max(round(image.height * width / image.width), 1)), Image.LANCZOS)
+        webp = io.BytesIO()
+        resized.save(webp, 'WEBP', quality=WEBP_QUALITY, method=4)
+        rendered[(width, 'webp')] = webp.getvalue()
+        plain = io.BytesIO()
+        if has_alpha:
+            resized.save(plain, 'PNG', optimize=True)
+        else:
+            resized.save(plain, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+        rendered[(width, fallback)] = plain.getvalue()
+    return fallback, rendered
+
+
+def generate_derivatives(model_label, pk, field_name, replaced=None, storage=None):
+    """
+    Build the derivatives of one instance's image and record them, deleting
+    those of the image it ``replaced``.  Returns the number of files
+    written, or 0 if the image is missing, unreadable or was replaced
+    meanwhile.
+    """
+    storage = storage or default_storage
+    model = apps.get_model(model_label)
+    spec = IMAGE_SPECS[(model, field_name)]
+    row = model.objects.filter(pk=pk).values(field_name, variants_field(field_name)).first()
+    if not row or not row[field_name]:
+        return 0
+    name, previous = row[field_name], row[variants_field(field_name)] or {}
+
+    try:
+        with storage.open(name, 'rb') as handle:
+            fallback, rendered = render_derivatives(handle.read(), spec)
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError) as exc:
+        logger.warning("Cannot make derivatives of %s: %s", name, exc)
+        return 0
+
+    for (width, extension), data in rendered.items():
+        target = derivative_name(name, width, extension)
+        if storage.exists(target):
+            storage.delete(target)
+        storage.save(target, ContentFile(data))
+    variants = {'source': name, 'widths': sorted({width for width, _ in rendered}), 'fallback': fallback}
+
+    # Only record them if the image was not replaced while we worked
+    updated = model.objects.filter(pk=pk, **{field_name: name}).update(**{variants_field(field_name): variants})
+    # The record can be lost to a stale instance saved over it, so also try every name of the replaced image
+    stale = set(derivative_names(previous['source'], previous)) if previous.get('source') else set()
+    if replaced and replaced != name:
+        stale |= {old for old in possible_derivative_names(replaced, spec) if storage.exists(old)}
+    if not updated:
+        stale |= set(derivative_names(name, variants))
+    else:
+        stale -= set(derivative_names(name, variants))
+    for old in stale:
+        storage.delete(old)
+    return len(rendered) if updated else 0
+
+
+def _run_job(model_label, pk, field_name, replaced):
+    try:
+        generate_derivatives(model_label, pk, field_name, replaced)
+    except Exception:
+        logger.exception("Image derivatives failed for %s %s.%s", model_label, pk, field_name)
+    finally:
+        close_old_connections()
+
+
+def generate_batch(jobs):
+    """
+    Run ``generate_derivatives`` for each ``(model label, pk, field name)``
+    in ``jobs``; returns ``(images done, files written)``.  Used by the
+    regenerate_images worker processes.
+    """
+    images = files = 0
+    try:
+        for model_label, pk, field_name in jobs:
+            written = generate_derivatives(model_label, pk, field_name)
+            images, files = images + bool(written), files + written
+    finally:
+        close_old_connections()
+    return images, files
+
+
+def schedule_derivatives(model_label, pk, field_name, replaced=None):
+    """Generate derivatives in the background once the current transaction commits"""
+    global _executor
+    workers = getattr(settings, 'IMAGE_DERIVATIVE_WORKERS', 2)
+    if not workers:
+        db_transaction.on_commit(lambda: generate_derivatives(model_label, pk, field_name, replaced))
+        return
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-derivatives')
+    db_transaction.on_commit(lambda: _executor.submit(_run_job, model_label, pk, field_name, replaced))
+
+
+# Reading
+
+def _variants_for(fieldfile):
+    if not fieldfile:
+        return None
+    variants = getattr(fieldfile.instance, variants_field(fieldfile.field.name), None) or {}
+    if variants.get('source') != fieldfile.name or not variants.get('widths'):
+        return None
+    return variants
+
+
+def srcset(fieldfile, extension=None):
+    """``srcset`` value listing the derivatives of ``fieldfile``, or '' if there are none yet"""
+    variants = _variants_for(fieldfile)
+    if variants is None:
+        return ''
+    extension = extension or variants['fallback']
+    storage = fieldfile.storage
+    return ', '.join(
+        f"{storage.url(derivative_name(fieldfile.name, width, extension))} {width}w"
+        for width in variants['widths']
+    )
+
+
+def variant_url(fieldfile, width, extension=None):
+    """URL of the smallest derivative at least ``width`` wide, or the original"""
+    if not fieldfile:
+        return ''
+    variants = _variants_for(fieldfile)
+    if variants is None:
+        return fieldfile.url
+    chosen = next((w for w in variants['widths'] if w >= width), variants['widths'][-1])
+    return fieldfile.storage.url(derivative_name(fieldfile.name, chosen, extension or variants['fallback']))
+
+
+# Upload hooks
+
+def _image_fields(model):
+    return [field_name for spec_model, field_name in IMAGE_SPECS if spec_model is model]
+
+
+def _loaded_name(value):
+    return (getattr(value, 'name', value) or None) if value is not None else None
+
+
+def _remember_loaded_names(sender, instance, **kwargs):
+    # Deferred image fields are not in __dict__ and are left out
+    setattr(instance, _LOADED_ATTR, {
+        field_name: _loaded_name(instance.__dict__[field_name])
+        for field_name in _image_fields(sender) if field_name in instance.__dict__
+    })
+
+
+def _image_saved(sender, instance, created, **kwargs):
+    loaded = getattr(instance, _LOADED_ATTR, {})
+    for field_name in _image_fields(sender):
+        if field_name not in instance.__dict__:
+            continue
+        name = _loaded_name(instance.__dict__[field_name])
+        if name and (created or field_name not in loaded or name != loaded[field_name]):
+            schedule_derivatives(sender._meta.label, instance.pk, field_name, loaded.get(field_name))
+        loaded[field_name] = name
+    setattr(instance, _LOADED_ATTR, loaded)
+
+
+for _model in {model for model, _ in IMAGE_SPECS}:
+    post_init.connect(_remember_loaded_names, sender=_model, dispatch_uid=f'images_loaded_{_model.__name__}')
+    post_save.connect(_image_saved, sender=_model, dispatch_uid=f'images_saved_{_model.__name__}')
@@ -0,0 +1,239 @@
+"""
+Bulk import of analyses, market insights and their chart data.
+
+A bundle is a JSON-lines file, or a zip of ``.jsonl`` members read in name
+order, with one record per line::
+
+    {"type": "analysis", "analyst": "<username>", "title": ..., ...,
+     "chart_annotations": [...], "indicators": [...], "metrics": [...], "insights": [...]}
+    {"type": "insight", "verified_by": "<username or null>", "title": ..., ...}
+
+Records are validated with ``full_clean`` as they are read and written with
+``bulk_create`` in batches, parents first and then their children, all in
+one transaction per bundle.  Any invalid record rolls the whole bundle back
+and the collected errors are raised together as ContentImportError.
+Analysts are resolved by username from a map loaded once per bundle.
+"""
+import io
+import json
+import time
+import zipfile
+from dataclasses import dataclass, field
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction as db_transaction
+
+from .models import (
+    AnalysisInsight, AnalysisMetric, Analyst, ChartAnnotation, CryptoAnalysis, MarketInsight,
+    TechnicalIndicatorData,
+)
+from .rankings import ensure_analysis_rows
+
+IMPORT_BATCH_SIZE = 500
+
+# Stop collecting errors after this many; the bundle is rejected either way
+MAX_REPORTED_ERRORS = 50
+
+# Record key -> child model of CryptoAnalysis
+ANALYSIS_CHILDREN = {
+    'chart_annotations': ChartAnnotation,
+    'indicators': TechnicalIndicatorData,
+    'metrics': AnalysisMetric,
+    'insights': AnalysisInsight,
+}
+
+# Fields set by the pipeline or maintained by the app, never taken from a bundle
+PROTECTED_FIELDS = {
+    'id', 'analyst', 'analysis', 'verified_by', 'created_at', 'updated_at', 'rating', 'rating_sum',
+    'rating_count', 'sales_count', 'views_count', 'total_revenue',
+}
+
+
+class ContentImportError(ValueError):
+    """A bundle failed validation; ``errors`` lists ``(location, message)`` pairs"""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(f"{len(errors)} invalid record(s) in bundle")
+
+
+@dataclass
+class ImportResult:
+    analyses: int = 0
+    insights: int = 0
+    children: dict = field(default_factory=dict)
+    elapsed: float = 0.0
+
+    @property
+    def records(self):
+        return self.analyses + self.insights
+
+    @property
+    def rate(self):
+        return self.records / self.elapsed if self.elapsed else 0.0
+
+
+def _editable_fields(model):
+    return {
+        f.name for f in model._meta.concrete_fields
+        if f.editable and f.name not in PROTECTED_FIELDS
+    }
+
+
+def iter_bundle_lines(fileobj, name=''):
+    """Yield ``(location, line)`` for every non-blank line of a .jsonl or .zip bundle"""
+    if name.lower().endswith('.zip') or zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        with zipfile.ZipFile(fileobj) as archive:
+            for member in sorted(archive.namelist()):
+                if member.endswith('/') or not member.lower().endswith(('.jsonl', '.json')):
+                    continue
+                with archive.open(member) as handle:
+                    yield from _numbered_lines(io.TextIOWrapper(handle, encoding='utf-8'), member)
+        return
+    fileobj.seek(0)
+    text = io.TextIOWrapper(fileobj, encoding='utf-8')
+    try:
+        yield from _numbered_lines(text, name or 'bundle')
+    finally:
+        # Leave the caller's file open
+        text.detach()
+
+
+def _numbered_lines(text, label):
+    for number, line in enumerate(text, 1):
+        if line.strip():
+            yield f"{label}:{number}", line
+
+
+class _Importer:
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.analysts = dict(Analyst.objects.values_list('user__username', 'pk'))
+        self.fields = {model: _editable_fields(model) for model in (CryptoAnalysis, MarketInsight, *ANALYSIS_CHILDREN.values())}
+        self.errors = []
+        self.result = ImportResult(children={key: 0 for key in ANALYSIS_CHILDREN})
+        self.pending_analyses = []
+        self.pending_insights = []
+
+    def error(self, location, message):
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((location, message))
+
+    def build(self, model, data, location, **related):
+        if not isinstance(data, dict):
+            self.error(location, f"{model.__name__} must be a JSON object")
+            return None
+        unknown = set(data) - self.fields[model]
+        if unknown:
+            self.error(location, f"unknown {model.__name__} field(s): {', '.join(sorted(unknown))}")
+            return None
+        instance = model(**data, **related)
+        try:
+            instance.full_clean(exclude=['analysis', 'analyst', 'verified_by'], validate_unique=False)
+        except ValidationError as exc:
+            self.error(location, '; '.join(f"{name}: {' '.join(messages)}" for name, messages in exc.message_dict.items()))
+            return None
+        return instance
+
+    def analyst_id(self, username, location, required):
+        if username is None and not required:
+            return None
+        analyst_id = self.analysts.get(username)
+        if analyst_id is None:
+            self.error(location, f"unknown analyst {username!r}")
+        return analyst_id
+
+    def add(self, location, line):
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            self.error(location, f"invalid JSON: {exc}")
+            return
+        if not isinstance(record, dict):
+            self.error(location, "record must be a JSON object")
+            return
+
+        kind = record.pop('type', None)
+        if kind == 'analysis':
+            analyst_id = self.analyst_id(record.pop('analyst', None), location, required=True)
+            children = {key: record.pop(key, None) or [] for key in ANALYSIS_CHILDREN}
+            analysis = self.build(CryptoAnalysis, record, location, analyst_id=analyst_id)
+            built_children = []
+            for key, items in children.items():
+                if not isinstance(items, list):
+                    self.error(location, f"{key} must be a list")
+                    continue
+                for index, item in enumerate(items):
+                    child = self.build(ANALYSIS_CHILDREN[key], item, f"{location} {key}[{index}]")
+                    if child is not None:
+                        built_children.append((key, child))
+            if analysis is not None and analyst_id is not None and not self.errors:
+                self.pending_analyses.append((analysis, built_children))
+        elif kind == 'insight':
+            verified_by_id = self.analyst_id(record.pop('verified_by', None), location, required=False)
+            insight = self.build(MarketInsight, record, location, verified_by_id=verified_by_id)
+            if insight is not None and not self.errors:
+                self.pending_insights.append(insight)
+        else:
+            self.error(location, f"unknown record type {kind!r}")
+
+        if len(self.pending_analyses) >= self.batch_size:
+            self.flush_analyses()
+        if len(self.pending_insights) >= self.batch_size:
+            self.flush_insights()
+
+    def flush_analyses(self):
+        if self.errors or not self.pending_analyses:
+            self.pending_analyses = []
+            return
+        analyses = [analysis for analysis, _ in self.pending_analyses]
+        if connection.features.can_return_rows_from_bulk_insert:
+            CryptoAnalysis.objects.bulk_create(analyses)
+        else:
+            # Children need the parent ids, which this backend cannot return from a bulk insert
+            for analysis in analyses:
+                analysis.save()
+        ensure_analysis_rows(*[analysis.pk for analysis in analyses])
+
+        children = {key: [] for key in ANALYSIS_CHILDREN}
+        for analysis, built in self.pending_analyses:
+            for key, child in built:
+                child.analysis = analysis
+                children[key].append(child)
+        for key, items in children.items():
+            ANALYSIS_CHILDREN[key].objects.bulk_create(items, batch_size=self.batch_size)
+            self.result.children[key] += len(items)
+        self.result.analyses += len(analyses)
+        self.pending_analyses = []
+
+    def flush_insights(self):
+        if not self.errors and self.pending_insights:
+            MarketInsight.objects.bulk_create(self.pending_insights)
+            self.result.insights += len(self.pending_insights)
+        self.pending_insights = []
+
+
+def import_bundle(fileobj, name='', batch_size=IMPORT_BATCH_SIZE, dry_run=False):
+    """
+    Validate and import one bundle from the binary file ``fileobj``.
+
+    Returns an ImportResult; raises ContentImportError, leaving the database
+    untouched, if any record is invalid.  ``dry_run`` validates and writes
+    inside the transaction but rolls it back.
+    """
+    started = time.monotonic()
+    with db_transaction.atomic():
+        importer = _Importer(batch_size)
+        for location, line in iter_bundle_lines(fileobj, name):
+            importer.add(location, line)
+            if len(importer.errors) >= MAX_REPORTED_ERRORS:
+                break
+        importer.flush_analyses()
+        importer.flush_insights()
+        if importer.errors:
+            raise ContentImportError(importer.errors)
+        if dry_run:
+            db_transaction.set_rollback(True)
+    importer.result.elapsed = time.monotonic() - started
+    return importer.result
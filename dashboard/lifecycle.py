@@ -0,0 +1,53 @@
+"""
+Periodic lifecycle transitions for consultations and purchases.
+
+``sweep`` moves consultations whose session ended more than SESSION_GRACE
+ago out of the active states: ``scheduled`` sessions nobody started become
+``no_show`` and ``in_progress`` ones become ``completed``.  It also flags
+purchases whose ``access_expires`` has passed as ``access_expired``.  Each
+transition is a single UPDATE over the ``(status, ends_at)`` and
+``(access_expired, access_expires)`` indexes, so list pages and counts can
+filter on the stored state in SQL instead of evaluating properties per row.
+Run it periodically with the ``sweep_lifecycle`` command.
+"""
+from collections import namedtuple
+from datetime import timedelta
+
+from django.db import transaction as db_transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Consultation, PurchasedAnalysis
+from .scheduling import invalidate_bookings
+from .summary import invalidate_user_summary
+
+# Matches the join window of Consultation.can_join_meeting
+SESSION_GRACE = timedelta(minutes=30)
+
+SweepResult = namedtuple('SweepResult', ['no_shows', 'completed', 'expired'])
+
+
+def sweep(now=None, grace=SESSION_GRACE):
+    """Apply every overdue transition; returns the SweepResult counts"""
+    now = now or timezone.now()
+    overdue = Consultation.objects.filter(ends_at__lt=now - grace)
+    with db_transaction.atomic():
+        user_ids = set(
+            overdue.filter(status__in=('scheduled', 'in_progress'))
+            .order_by().values_list('user_id', flat=True).distinct()
+        )
+        no_shows = overdue.filter(status='scheduled').update(status='no_show', updated_at=now)
+        completed = overdue.filter(status='in_progress').update(
+            status='completed', session_ended=Coalesce(F('session_ended'), F('ends_at')), updated_at=now,
+        )
+        expired = PurchasedAnalysis.objects.filter(
+            access_expired=False, access_expires__lte=now,
+        ).update(access_expired=True)
+
+        # update() sends no post_save, so do what its receivers would
+        for user_id in user_ids:
+            invalidate_user_summary(user_id)
+        if no_shows or completed:
+            invalidate_bookings()
+    return SweepResult(no_shows, completed, expired)
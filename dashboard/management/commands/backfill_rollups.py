@@ -0,0 +1,43 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard.rollups import backfill_rollups
+
+
+def _date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f"Invalid date {value!r}, expected YYYY-MM-DD")
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the daily revenue rollups from completed transactions, one chunk of days at a time. "
+        "Without --start/--end the whole history is rebuilt and total_revenue is reset from it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=_date, help='First day to rebuild (YYYY-MM-DD)')
+        parser.add_argument('--end', type=_date, help='Last day to rebuild (YYYY-MM-DD)')
+        parser.add_argument('--chunk-days', type=int, default=31,
+                            help='Days aggregated and replaced per transaction')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of rows written per batch')
+
+    def handle(self, *args, **options):
+        if options['start'] and options['end'] and options['start'] > options['end']:
+            raise CommandError("--start must not be after --end")
+        started = time.monotonic()
+        days, rows = backfill_rollups(
+            start=options['start'],
+            end=options['end'],
+            chunk_days=max(options['chunk_days'], 1),
+            batch_size=options['batch_size'],
+        )
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {rows} rollup rows covering {days} days in {elapsed:.2f}s"
+        ))
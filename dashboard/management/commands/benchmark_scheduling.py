@@ -0,0 +1,79 @@
+import datetime
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from dashboard.scheduling import (
+    WEEKDAYS, AvailabilityIndex, availability_windows, parse_consultation_hours,
+)
+
+
+def _random_hours(rng):
+    start = rng.randrange(6, 14)
+    length = rng.randrange(3, 9)
+    days = rng.sample(WEEKDAYS, rng.randrange(3, 7))
+    windows = [[f"{start:02d}:00", f"{min(start + length, 24):02d}:00"]]
+    return {'timezone': rng.choice(['UTC', 'Africa/Nairobi', 'Europe/London']), 'weekly': {day: windows for day in days}}
+
+
+class Command(BaseCommand):
+    help = (
+        "Time free-slot queries against the scheduling index. By default builds a synthetic index "
+        "in memory; --from-database times the index built from the real analysts and consultations."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--analysts', type=int, default=5000, help='Synthetic analysts')
+        parser.add_argument('--bookings', type=int, default=20, help='Synthetic bookings per analyst')
+        parser.add_argument('--queries', type=int, default=2000, help='Queries timed')
+        parser.add_argument('--count', type=int, default=10, help='Slots asked for per query')
+        parser.add_argument('--duration', type=int, default=60, help='Consultation length in minutes')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--from-database', action='store_true', help='Benchmark the real data instead')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        duration = options['duration']
+
+        started = time.monotonic()
+        if options['from_database']:
+            index = AvailabilityIndex.build()
+        else:
+            index = self.synthetic_index(rng, options['analysts'], options['bookings'], duration)
+        index.slots_for(duration)
+        built = time.monotonic() - started
+        self.stdout.write(
+            f"Index: {len(index.windows)} analysts, {len(index.booked)} bookings, "
+            f"{len(index.slots_for(duration))} slots of {duration} minutes, built in {built:.2f}s"
+        )
+
+        now = timezone.now()
+        horizon = index.horizon_days * 24 * 60
+        timings = []
+        for _ in range(options['queries']):
+            after = now + datetime.timedelta(minutes=rng.randrange(horizon))
+            query_started = time.perf_counter()
+            index.free_slots(duration, options['count'], after)
+            timings.append((time.perf_counter() - query_started) * 1000)
+        timings.sort()
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(timings)} queries for {options['count']} slots: "
+            f"median {statistics.median(timings):.3f}ms, p99 {timings[int(len(timings) * 0.99) - 1]:.3f}ms, "
+            f"max {timings[-1]:.3f}ms"
+        ))
+
+    def synthetic_index(self, rng, analysts, bookings, duration):
+        index = AvailabilityIndex(timezone.localdate())
+        pk = 0
+        for analyst_id in range(1, analysts + 1):
+            windows = availability_windows(parse_consultation_hours(_random_hours(rng)), index.first_day, index.horizon_days)
+            index.windows[analyst_id] = windows
+            for window_start, window_end in rng.sample(windows, min(bookings, len(windows))):
+                start = window_start + rng.randrange(0, max(window_end - window_start - duration, 1), 30)
+                pk += 1
+                index.book(pk, analyst_id, start, start + duration)
+        index.synced_at = timezone.now()
+        return index
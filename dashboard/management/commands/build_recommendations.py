@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from dashboard.recommendations import build_recommendations
+
+
+class Command(BaseCommand):
+    help = "Rebuild the co-purchase recommendation table (AnalysisNeighbors) from purchase history"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of rows written per batch')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        written = build_recommendations(batch_size=options['batch_size'])
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt recommendations for {written} analyses in {elapsed:.2f}s"
+        ))
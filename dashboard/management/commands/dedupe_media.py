@@ -0,0 +1,40 @@
+import os
+import time
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard.storage import BLOB_DIR, ContentAddressedStorage
+
+
+class Command(BaseCommand):
+    help = (
+        "Move media files stored before the content-addressed storage into blobs, "
+        "keeping one copy of each distinct content"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='', help='Only adopt files under this media directory')
+
+    def handle(self, *args, **options):
+        if not isinstance(default_storage, ContentAddressedStorage):
+            raise CommandError("DEFAULT_FILE_STORAGE is not dashboard.storage.ContentAddressedStorage")
+        started = time.monotonic()
+        adopted = saved = 0
+        for name in self.legacy_files(options['path'].strip('/')):
+            saved += default_storage.adopt(name)
+            adopted += 1
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Adopted {adopted} files into blobs, freeing {saved / 1024:.1f}KB of duplicates, in {elapsed:.2f}s"
+        ))
+
+    def legacy_files(self, path):
+        root = default_storage.location
+        for directory, subdirectories, files in os.walk(os.path.join(root, path)):
+            relative = os.path.relpath(directory, root).replace(os.sep, '/')
+            if relative == '.':
+                relative = ''
+                subdirectories[:] = [name for name in subdirectories if name != BLOB_DIR]
+            for filename in sorted(files):
+                yield f'{relative}/{filename}' if relative else filename
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from dashboard.reminders import MAX_SLEEP, REMINDER_BATCH_SIZE, ReminderDispatcher
+
+
+class Command(BaseCommand):
+    help = (
+        "Send due consultation reminders through the REMINDER_BACKENDS. Runs until interrupted, "
+        "sleeping until the next reminder is due; --once sends what is due now and exits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Send the reminders due now and exit')
+        parser.add_argument('--batch-size', type=int, default=REMINDER_BATCH_SIZE,
+                            help='Number of reminders claimed and sent per batch')
+        parser.add_argument('--max-sleep', type=float, default=MAX_SLEEP,
+                            help='Longest pause in seconds before checking for new reminders')
+
+    def handle(self, *args, **options):
+        dispatcher = ReminderDispatcher(batch_size=options['batch_size'], max_sleep=options['max_sleep'])
+        if options['once']:
+            started = time.monotonic()
+            sent, failed = dispatcher.dispatch_due()
+            elapsed = time.monotonic() - started
+            self.stdout.write(self.style.SUCCESS(
+                f"Sent {sent} reminders ({failed} failed) in {elapsed:.2f}s"
+            ))
+            return
+
+        self.stdout.write("Dispatching reminders, press Ctrl-C to stop")
+        try:
+            dispatcher.run()
+        except KeyboardInterrupt:
+            self.stdout.write("Stopped")
@@ -0,0 +1,60 @@
+import datetime
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard.exports import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, ExportThroughput
+from dashboard.models import MpesaTransaction, Transaction
+
+MODELS = {
+    'transactions': Transaction,
+    'mpesa': MpesaTransaction,
+}
+
+
+def _date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f"Invalid date {value!r}, expected YYYY-MM-DD")
+
+
+class Command(BaseCommand):
+    help = "Stream Transaction or MpesaTransaction rows to a CSV or dxcol file in bounded memory"
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=sorted(MODELS))
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='csv')
+        parser.add_argument('--output', default='-', help="File to write, or '-' for stdout")
+        parser.add_argument('--since', type=_date, help='Only rows created on or after this day')
+        parser.add_argument('--until', type=_date, help='Only rows created on or before this day')
+        parser.add_argument('--status', action='append', help='Only rows with this status (repeatable)')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE,
+                            help='Rows fetched and written per chunk')
+
+    def handle(self, *args, **options):
+        queryset = MODELS[options['model']].objects.order_by('pk')
+        if options['since']:
+            queryset = queryset.filter(created_at__date__gte=options['since'])
+        if options['until']:
+            queryset = queryset.filter(created_at__date__lte=options['until'])
+        if options['status']:
+            queryset = queryset.filter(status__in=options['status'])
+
+        stream, _, _ = EXPORT_FORMATS[options['format']]
+        stats = ExportThroughput(queryset.model.__name__)
+        to_stdout = options['output'] == '-'
+        output = sys.stdout.buffer if to_stdout else open(options['output'], 'wb')
+        try:
+            for data in stream(queryset, chunk_size=max(options['chunk_size'], 1), stats=stats):
+                output.write(data)
+        finally:
+            if not to_stdout:
+                output.close()
+
+        elapsed = stats.elapsed
+        rate = stats.rows / elapsed if elapsed else 0
+        report = self.stderr if to_stdout else self.stdout
+        report.write(self.style.SUCCESS(
+            f"Exported {stats.rows} rows ({stats.bytes / 1e6:.1f} MB) in {elapsed:.2f}s, {rate:,.0f} rows/s"
+        ))
@@ -0,0 +1,112 @@
+import hashlib
+import re
+import shutil
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.template import TemplateSyntaxError, engines
+
+# Inline blocks with no attributes other than a plain type; anything using
+# template syntax needs the request context and stays inline
+INLINE_BLOCK_RE = re.compile(
+    r'<(?P<tag>style|script)(?P<attrs>(?:\s+type="(?:text/css|text/javascript|application/javascript)")?)\s*>'
+    r'(?P<body>.*?)</(?P=tag)>',
+    re.IGNORECASE | re.DOTALL,
+)
+TEMPLATE_SYNTAX_RE = re.compile(r'{[{%#]')
+EXTENDS_RE = re.compile(r'^\s*{%\s*extends\s[^%]*%}\s*\n?')
+LOAD_STATIC_RE = re.compile(r'{%\s*load\s[^%]*\bstatic\b[^%]*%}')
+
+# Blocks smaller than this are cheaper inline than as an extra request
+MIN_EXTRACT_BYTES = 512
+
+
+class Command(BaseCommand):
+    help = (
+        "Move template-free inline <style>/<script> blocks into static files and write "
+        "the rewritten templates to ASSET_BUILD_DIR. Run collectstatic afterwards so the "
+        "extracted files get hashed, compressed names. Part of every deploy: outside DEBUG "
+        "the system checks fail while a built template is older than its source."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default=str(settings.BASE_DIR / 'templates'),
+                            help='Template directory to process')
+        parser.add_argument('--min-bytes', type=int, default=MIN_EXTRACT_BYTES,
+                            help='Leave blocks smaller than this inline')
+        parser.add_argument('--clean', action='store_true',
+                            help='Remove the previous build before writing')
+
+    def handle(self, *args, **options):
+        source = Path(options['source'])
+        if not source.is_dir():
+            raise CommandError(f"Template directory {source} does not exist")
+
+        build_dir = Path(settings.ASSET_BUILD_DIR)
+        template_out = build_dir / 'templates'
+        static_out = build_dir / 'static'
+        if options['clean'] and build_dir.exists():
+            shutil.rmtree(build_dir)
+
+        saved = files = 0
+        for path in sorted(source.rglob('*.html')):
+            relative = path.relative_to(source)
+            text = path.read_text(encoding='utf-8')
+            rewritten, assets = self._extract(text, relative, options['min_bytes'])
+            out_path = template_out / relative
+            if not assets:
+                # An earlier build of this template would shadow the source
+                out_path.unlink(missing_ok=True)
+                continue
+
+            for name, body in assets:
+                target = static_out / name
+                target.parent.mkdir(parents=True, exist_ok=True)
+                target.write_text(body, encoding='utf-8')
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            out_path.write_text(rewritten, encoding='utf-8')
+
+            files += 1
+            saved += len(text.encode('utf-8')) - len(rewritten.encode('utf-8'))
+            self.stdout.write(f"{relative}: extracted {len(assets)} block(s)")
+
+        self._check_templates(template_out)
+        self.stdout.write(self.style.SUCCESS(
+            f"Rewrote {files} templates into {template_out} ({saved / 1024:.1f} KB moved to static files)"
+        ))
+
+    def _extract(self, text, relative, min_bytes):
+        assets = []
+        stem = str(relative.with_suffix('')).replace('/', '_').replace('\\', '_')
+
+        def replace(match):
+            body = match.group('body')
+            if TEMPLATE_SYNTAX_RE.search(body) or len(body.encode('utf-8')) < min_bytes:
+                return match.group(0)
+            extension = 'css' if match.group('tag').lower() == 'style' else 'js'
+            digest = hashlib.md5(body.encode('utf-8')).hexdigest()[:8]
+            name = f"build/{stem}.{digest}.{extension}"
+            assets.append((name, body.strip() + '\n'))
+            if extension == 'css':
+                return f'<link rel="stylesheet" href="{{% static \'{name}\' %}}">'
+            return f'<script src="{{% static \'{name}\' %}}"></script>'
+
+        rewritten = INLINE_BLOCK_RE.sub(replace, text)
+        if assets and not LOAD_STATIC_RE.search(rewritten):
+            # {% load %} has to follow {% extends %} when the template has one
+            extends = EXTENDS_RE.match(rewritten)
+            at = extends.end() if extends else 0
+            rewritten = f"{rewritten[:at]}{{% load static %}}\n{rewritten[at:]}"
+        return rewritten, assets
+
+    def _check_templates(self, template_out):
+        """Compile every rewritten template so syntax errors fail the build"""
+        if not template_out.is_dir():
+            return
+        engine = engines['django'].engine
+        for path in template_out.rglob('*.html'):
+            try:
+                engine.from_string(path.read_text(encoding='utf-8'))
+            except TemplateSyntaxError as exc:
+                raise CommandError(f"{path.relative_to(template_out)}: {exc}")
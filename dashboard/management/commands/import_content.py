@@ -0,0 +1,41 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard.imports import IMPORT_BATCH_SIZE, ContentImportError, import_bundle
+
+
+class Command(BaseCommand):
+    help = "Import analyses, market insights and their chart data from JSON-lines or zip bundles"
+
+    def add_arguments(self, parser):
+        parser.add_argument('bundles', nargs='+', help='.jsonl or .zip bundle files, one transaction each')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE,
+                            help='Records written per bulk insert')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Validate and write, then roll back')
+
+    def handle(self, *args, **options):
+        failed = 0
+        for bundle in options['bundles']:
+            path = Path(bundle)
+            if not path.is_file():
+                raise CommandError(f"Bundle {path} does not exist")
+            try:
+                with path.open('rb') as handle:
+                    result = import_bundle(handle, path.name, batch_size=max(options['batch_size'], 1),
+                                           dry_run=options['dry_run'])
+            except ContentImportError as exc:
+                failed += 1
+                self.stderr.write(self.style.ERROR(f"{path.name}: {exc}"))
+                for location, message in exc.errors:
+                    self.stderr.write(f"  {location}: {message}")
+                continue
+            children = ', '.join(f"{count} {key}" for key, count in result.children.items())
+            verb = "Validated" if options['dry_run'] else "Imported"
+            self.stdout.write(self.style.SUCCESS(
+                f"{path.name}: {verb} {result.analyses} analyses ({children}) and {result.insights} insights "
+                f"in {result.elapsed:.2f}s, {result.rate:,.0f} records/s"
+            ))
+        if failed:
+            raise CommandError(f"{failed} bundle(s) rejected")
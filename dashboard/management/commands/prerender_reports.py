@@ -0,0 +1,45 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from dashboard.models import CryptoAnalysis
+from dashboard.reports import cached_report, render_to_cache
+
+
+def _init_worker():
+    # Spawned workers start without Django; forked ones already have it
+    django.setup()
+
+
+class Command(BaseCommand):
+    help = "Render the PDF reports of featured analyses into the report cache ahead of their downloads"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Render every active analysis, not only featured ones')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Worker processes rendering reports; 0 renders in this process')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        analyses = CryptoAnalysis.objects.filter(is_active=True).only('id', 'updated_at')
+        if not options['all']:
+            analyses = analyses.filter(is_featured=True)
+        pending = [analysis.pk for analysis in analyses.order_by('pk') if not cached_report(analysis)]
+
+        if options['workers'] <= 0:
+            sizes = [render_to_cache(pk) for pk in pending]
+        else:
+            # Children must not share the parent's database connections
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options['workers'], initializer=_init_worker) as pool:
+                sizes = [future.result() for future in as_completed([pool.submit(render_to_cache, pk) for pk in pending])]
+        rendered, written = sum(1 for size in sizes if size), sum(sizes)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Rendered {rendered} reports ({written / 1024:.0f}KB), {analyses.count() - len(pending)} already cached, "
+            f"in {elapsed:.2f}s"
+        ))
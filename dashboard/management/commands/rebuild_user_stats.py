@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from dashboard.models import UserStats
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the denormalized UserStats rows from purchase, transaction and consultation history. "
+        "Run it periodically (e.g. nightly) to repair drift from writes outside the views and admin."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='user_ids',
+                            help='Only rebuild the given user id (may be repeated)')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of users aggregated and written per batch')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        written = UserStats.rebuild(user_ids=options['user_ids'], batch_size=options['batch_size'])
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt stats for {written} users in {elapsed:.2f}s"
+        ))
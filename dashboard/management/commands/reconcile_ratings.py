@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from dashboard.ratings import reconcile_ratings
+
+
+class Command(BaseCommand):
+    help = "Recompute analysis and analyst rating totals from AnalysisRating, fixing any drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of rows updated per batch')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        analyses, analysts = reconcile_ratings(batch_size=options['batch_size'])
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Fixed rating totals for {analyses} analyses and {analysts} analysts in {elapsed:.2f}s"
+        ))
@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from dashboard.rankings import refresh_rankings
+
+
+class Command(BaseCommand):
+    help = "Recompute the materialized analysis and analyst rankings (ages purchases out of the 7/30 day windows)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of rows written per batch')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        analyses, analysts = refresh_rankings(batch_size=options['batch_size'])
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Refreshed rankings for {analyses} analyses and {analysts} analysts in {elapsed:.2f}s"
+        ))
@@ -0,0 +1,66 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from dashboard.images import IMAGE_SPECS, generate_batch, variants_field
+
+
+def _init_worker():
+    # Spawned workers start without Django; forked ones already have it
+    django.setup()
+
+
+class Command(BaseCommand):
+    help = "Regenerate the resized WebP/JPEG derivatives of uploaded profile pictures and analysis charts"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', choices=sorted(model._meta.model_name for model, _ in IMAGE_SPECS),
+                            help='Only regenerate images of this model')
+        parser.add_argument('--missing-only', action='store_true',
+                            help='Skip images whose derivatives are already recorded')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Worker processes resizing images; 0 runs in this process')
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Images handed to a worker at a time')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        started = time.monotonic()
+        jobs = list(self.jobs(options['model'], options['missing_only']))
+        batches = [jobs[i:i + options['batch_size']] for i in range(0, len(jobs), options['batch_size'])]
+
+        images = files = 0
+        if options['workers'] <= 0:
+            for batch in batches:
+                done, written = generate_batch(batch)
+                images, files = images + done, files + written
+        else:
+            # Children must not share the parent's database connections
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options['workers'], initializer=_init_worker) as pool:
+                for future in as_completed([pool.submit(generate_batch, batch) for batch in batches]):
+                    done, written = future.result()
+                    images, files = images + done, files + written
+
+        elapsed = time.monotonic() - started
+        rate = images / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Regenerated {images} of {len(jobs)} images ({files} files) in {elapsed:.2f}s, {rate:.1f} images/s"
+        ))
+
+    def jobs(self, model_name, missing_only):
+        for model, field_name in IMAGE_SPECS:
+            if model_name and model._meta.model_name != model_name:
+                continue
+            rows = (
+                model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})
+                .order_by('pk').values_list('pk', field_name, variants_field(field_name))
+            )
+            for pk, name, variants in rows.iterator():
+                if missing_only and (variants or {}).get('source') == name:
+                    continue
+                yield model._meta.label, pk, field_name
@@ -0,0 +1,39 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from dashboard.lifecycle import SESSION_GRACE, sweep
+from dashboard.uploads import discard_stale_uploads
+
+
+class Command(BaseCommand):
+    help = (
+        "Mark overdue consultations as no-show or completed, flag expired analysis access and "
+        "discard abandoned attachment uploads. "
+        "Run it periodically, or pass --every to keep sweeping."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-minutes', type=int, default=int(SESSION_GRACE.total_seconds() // 60),
+                            help='Minutes after a session ends before it is closed')
+        parser.add_argument('--every', type=float,
+                            help='Sweep again every this many seconds until interrupted')
+
+    def handle(self, *args, **options):
+        grace = timedelta(minutes=options['grace_minutes'])
+        try:
+            while True:
+                started = time.monotonic()
+                result = sweep(grace=grace)
+                discarded = discard_stale_uploads()
+                elapsed = time.monotonic() - started
+                self.stdout.write(self.style.SUCCESS(
+                    f"{result.no_shows} no-shows, {result.completed} completed consultations, "
+                    f"{result.expired} expired purchases, {discarded} abandoned uploads in {elapsed:.2f}s"
+                ))
+                if not options['every']:
+                    return
+                time.sleep(options['every'])
+        except KeyboardInterrupt:
+            self.stdout.write("Stopped")
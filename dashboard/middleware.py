@@ -0,0 +1,71 @@
+import re
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from .routers import PIN_COOKIE, replica_aliases, request_state
+
+# Content of these elements is whitespace-sensitive and passed through as is
+PRESERVED_RE = re.compile(r'(<(pre|textarea|script|style)\b.*?</\2\s*>)', re.IGNORECASE | re.DOTALL)
+# Indentation and blank lines; a single newline is kept so inline spacing is unchanged
+LINE_WHITESPACE_RE = re.compile(r'[ \t]*\n\s*')
+
+
+def minify_html(html):
+    """Strip indentation and blank lines outside whitespace-sensitive elements"""
+    parts = PRESERVED_RE.split(html)
+    # split() yields text, full match, tag name, text, ...
+    output = []
+    for index in range(0, len(parts), 3):
+        output.append(LINE_WHITESPACE_RE.sub('\n', parts[index]))
+        if index + 1 < len(parts):
+            output.append(parts[index + 1])
+    return ''.join(output)
+
+
+class HTMLMinifyMiddleware:
+    """Collapse whitespace in rendered HTML responses when HTML_MINIFY is on"""
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'HTML_MINIFY', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if (
+            response.streaming
+            or response.status_code != 200
+            or 'text/html' not in response.get('Content-Type', '')
+            or response.has_header('Content-Encoding')
+        ):
+            return response
+
+        charset = response.charset
+        response.content = minify_html(response.content.decode(charset)).encode(charset)
+        if response.has_header('Content-Length'):
+            response['Content-Length'] = str(len(response.content))
+        return response
+
+
+class PrimaryPinMiddleware:
+    """
+    Track the writes of each request for dashboard.routers and pin the
+    browser to the primary database for REPLICA_PIN_SECONDS after one.
+    Placed before SessionMiddleware so session writes count too.
+    """
+
+    def __init__(self, get_response):
+        if not replica_aliases():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with request_state(pinned=PIN_COOKIE in request.COOKIES) as state:
+            response = self.get_response(request)
+        if state.wrote:
+            response.set_cookie(
+                PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS, httponly=True, samesite='Lax',
+                secure=settings.SESSION_COOKIE_SECURE,
+            )
+        return response
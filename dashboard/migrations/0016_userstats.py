@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-19 01:33
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dashboard', '0015_cryptoanalysis_total_revenue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('purchase_count', models.IntegerField(default=0)),
+                ('total_spent', models.DecimalField(decimal_places=2, default=0.0, max_digits=15)),
+                ('total_deposited', models.DecimalField(decimal_places=2, default=0.0, max_digits=15)),
+                ('total_withdrawn', models.DecimalField(decimal_places=2, default=0.0, max_digits=15)),
+                ('total_refunded', models.DecimalField(decimal_places=2, default=0.0, max_digits=15)),
+                ('consultations_booked', models.IntegerField(default=0)),
+                ('consultations_cancelled', models.IntegerField(default=0)),
+                ('consultation_spend', models.DecimalField(decimal_places=2, default=0.0, max_digits=15)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'User Statistics',
+                'verbose_name_plural': 'User Statistics',
+            },
+        ),
+    ]
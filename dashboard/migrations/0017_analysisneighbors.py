@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-19 01:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0016_userstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisNeighbors',
+            fields=[
+                ('analysis', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='neighbors', serialize=False, to='dashboard.cryptoanalysis')),
+                ('neighbor_ids', models.JSONField(blank=True, default=list)),
+                ('co_purchase_counts', models.JSONField(blank=True, default=dict)),
+                ('buyer_count', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Analysis Neighbors',
+                'verbose_name_plural': 'Analysis Neighbors',
+            },
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 4.2.30 on 2026-10-19 01:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def seed_ranking_rows(apps, schema_editor):
+    """Create empty ranking rows; run `manage.py refresh_rankings` to fill them"""
+    CryptoAnalysis = apps.get_model('dashboard', 'CryptoAnalysis')
+    Analyst = apps.get_model('dashboard', 'Analyst')
+    AnalysisRanking = apps.get_model('dashboard', 'AnalysisRanking')
+    AnalystRanking = apps.get_model('dashboard', 'AnalystRanking')
+    AnalysisRanking.objects.bulk_create(
+        [
+            AnalysisRanking(analysis_id=analysis_id, window=window)
+            for analysis_id in CryptoAnalysis.objects.values_list('pk', flat=True)
+            for window in ('7d', '30d', 'all')
+        ],
+        batch_size=500,
+    )
+    AnalystRanking.objects.bulk_create(
+        [AnalystRanking(analyst_id=analyst_id) for analyst_id in Analyst.objects.values_list('pk', flat=True)],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0017_analysisneighbors'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalystRanking',
+            fields=[
+                ('analyst', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='ranking', serialize=False, to='dashboard.analyst')),
+                ('total_sales', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0.0, max_digits=15)),
+                ('rating', models.DecimalField(decimal_places=2, default=0.0, max_digits=3)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-total_sales', '-analyst'], name='analyst_ranking_sales_idx'), models.Index(fields=['-rating', '-analyst'], name='analyst_ranking_rating_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='AnalysisRanking',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('window', models.CharField(choices=[('7d', 'Last 7 days'), ('30d', 'Last 30 days'), ('all', 'All time')], max_length=3)),
+                ('sales_count', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0.0, max_digits=15)),
+                ('rating', models.DecimalField(decimal_places=2, default=0.0, max_digits=3)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('analysis', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rankings', to='dashboard.cryptoanalysis')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['window', '-sales_count', '-analysis'], name='ranking_sales_idx'), models.Index(fields=['window', '-revenue', '-analysis'], name='ranking_revenue_idx'), models.Index(fields=['window', '-rating', '-analysis'], name='ranking_rating_idx')],
+                'unique_together': {('analysis', 'window')},
+            },
+        ),
+        migrations.RunPython(seed_ranking_rows, migrations.RunPython.noop),
+    ]
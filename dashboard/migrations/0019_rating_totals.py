@@ -0,0 +1,71 @@
+# Generated by Django 4.2.30 on 2026-10-19 01:52
+
+from django.db import migrations, models
+from django.db.models import Case, Count, F, FloatField, Sum, Value, When
+from django.db.models.functions import Cast, Round
+
+
+def backfill_rating_totals(apps, schema_editor):
+    """Seed the running totals, and the mean kept next to them, from existing ratings"""
+    AnalysisRating = apps.get_model('dashboard', 'AnalysisRating')
+    groups = (
+        ('CryptoAnalysis', 'analysis'),
+        ('Analyst', 'analysis__analyst'),
+        ('UserStats', 'user'),
+    )
+    for model_name, group in groups:
+        model = apps.get_model('dashboard', model_name)
+        totals = AnalysisRating.objects.values_list(group).annotate(total=Sum('rating'), count=Count('pk')).order_by()
+        for pk, total, count in totals:
+            if model_name == 'UserStats':
+                model.objects.filter(user_id=pk).update(ratings_given=count, rating_given_total=total)
+            else:
+                model.objects.filter(pk=pk).update(rating_sum=total, rating_count=count)
+        if model_name != 'UserStats':
+            # Same expression as dashboard.ratings; rows without ratings get the default
+            model.objects.update(rating=Case(
+                When(rating_count__gt=0, then=Round(Cast(F('rating_sum'), FloatField()) / F('rating_count'), 2)),
+                default=Value(0.0),
+                output_field=FloatField(),
+            ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0018_rankings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analyst',
+            name='rating_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='analyst',
+            name='rating_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cryptoanalysis',
+            name='rating_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cryptoanalysis',
+            name='rating_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userstats',
+            name='rating_given_total',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userstats',
+            name='ratings_given',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_rating_totals, migrations.RunPython.noop),
+    ]
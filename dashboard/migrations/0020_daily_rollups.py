@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-19 01:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0019_rating_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('transaction_type', models.CharField(choices=[('deposit', 'Deposit'), ('withdrawal', 'Withdrawal'), ('purchase', 'Purchase'), ('refund', 'Refund'), ('commission', 'Commission')], max_length=20)),
+                ('payment_method', models.CharField(choices=[('mpesa', 'M-Pesa'), ('paypal', 'PayPal'), ('bank', 'Bank Transfer'), ('crypto', 'Cryptocurrency'), ('wallet', 'Wallet Balance')], max_length=20)),
+                ('count', models.IntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=0.0, max_digits=15)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('analysis', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='daily_rollups', to='dashboard.cryptoanalysis')),
+                ('analyst', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='daily_rollups', to='dashboard.analyst')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['date', 'transaction_type', 'payment_method'], name='rollup_date_idx'), models.Index(fields=['analysis', 'date'], name='rollup_analysis_idx'), models.Index(fields=['analyst', 'date'], name='rollup_analyst_idx')],
+            },
+        ),
+    ]
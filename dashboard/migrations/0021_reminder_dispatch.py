@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-19 02:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0020_daily_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='consultationreminder',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='consultationreminder',
+            name='last_error',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='consultationreminder',
+            index=models.Index(fields=['is_sent', 'scheduled_time'], name='reminder_due_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-19 02:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0021_reminder_dispatch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='consultation',
+            name='analyst',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='consultations', to='dashboard.analyst'),
+        ),
+        migrations.AddIndex(
+            model_name='consultation',
+            index=models.Index(fields=['analyst', 'scheduled_date'], name='consultation_analyst_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.30 on 2026-10-19 02:21
+
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_lifecycle_fields(apps, schema_editor):
+    """Store ends_at for existing consultations and flag purchases already past expiry"""
+    Consultation = apps.get_model('dashboard', 'Consultation')
+    batch = []
+    for consultation in Consultation.objects.only('pk', 'scheduled_date', 'duration_minutes').iterator(chunk_size=1000):
+        consultation.ends_at = consultation.scheduled_date + timedelta(minutes=consultation.duration_minutes or 0)
+        batch.append(consultation)
+        if len(batch) >= 1000:
+            Consultation.objects.bulk_update(batch, ['ends_at'])
+            batch = []
+    Consultation.objects.bulk_update(batch, ['ends_at'])
+
+    PurchasedAnalysis = apps.get_model('dashboard', 'PurchasedAnalysis')
+    PurchasedAnalysis.objects.filter(access_expires__lte=timezone.now()).update(access_expired=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0022_consultation_analyst'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='consultation',
+            name='ends_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='purchasedanalysis',
+            name='access_expired',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='consultation',
+            index=models.Index(fields=['status', 'ends_at'], name='consultation_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchasedanalysis',
+            index=models.Index(fields=['access_expired', 'access_expires'], name='purchase_expiry_idx'),
+        ),
+        migrations.RunPython(backfill_lifecycle_fields, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-19 02:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0023_lifecycle_sweep'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cryptoanalysis',
+            name='chart_image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='profile_picture_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
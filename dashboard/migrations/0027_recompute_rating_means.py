@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-19 03:10
+
+from django.db import migrations
+from django.db.models import Case, F, FloatField, Value, When
+from django.db.models.functions import Cast, Round
+
+
+def recompute_rating_means(apps, schema_editor):
+    """Databases that ran 0019 before it set the mean still carry the old ``rating``; derive it from the totals"""
+    for model_name in ('CryptoAnalysis', 'Analyst'):
+        apps.get_model('dashboard', model_name).objects.update(rating=Case(
+            When(rating_count__gt=0, then=Round(Cast(F('rating_sum'), FloatField()) / F('rating_count'), 2)),
+            default=Value(0.0),
+            output_field=FloatField(),
+        ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0026_attachment_uploads'),
+    ]
+
+    operations = [
+        migrations.RunPython(recompute_rating_means, migrations.RunPython.noop),
+    ]
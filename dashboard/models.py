@@ -1,7 +1,11 @@
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.fields.json import KeyTransform
+from django.db.models import Exists, ExpressionWrapper, OuterRef, Q
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.urls import reverse
 import os
 import uuid
 from decimal import Decimal
@@ -25,6 +29,8 @@ class UserProfile(models.Model):
         blank=True, 
         null=True
     )
+    # Resized copies of profile_picture (see dashboard.images)
+    profile_picture_variants = models.JSONField(default=dict, blank=True, editable=False)
     date_of_birth = models.DateField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -32,6 +38,17 @@ class UserProfile(models.Model):
     def __str__(self):
         return f"{self.user.username}'s Profile"
 
+    @property
+    def profile_picture_thumbnail_url(self):
+        """Smallest resized profile picture, or the original until it is resized"""
+        from .images import variant_url
+        return variant_url(self.profile_picture, 64)
+
+    @property
+    def profile_picture_srcset(self):
+        from .images import srcset
+        return srcset(self.profile_picture)
+
 
 class UserWallet(models.Model):
     PAYMENT_METHODS = [
@@ -153,6 +170,9 @@ class Analyst(models.Model):
     verified = models.BooleanField(default=False)
     total_sales = models.IntegerField(default=0)
     rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.00)
+    # Running totals over ratings of all the analyst's analyses (see dashboard.ratings)
+    rating_sum = models.IntegerField(default=0)
+    rating_count = models.IntegerField(default=0)
     joined_date = models.DateTimeField(auto_now_add=True)
     is_verified = models.BooleanField(default=False)
     # Consultation availability
@@ -162,6 +182,13 @@ class Analyst(models.Model):
     def __str__(self):
         return f"Analyst: {self.user.username}"
     
+    def clean(self):
+        from .scheduling import parse_consultation_hours
+        try:
+            parse_consultation_hours(self.consultation_hours)
+        except ValidationError as exc:
+            raise ValidationError({'consultation_hours': exc.messages})
+    
     @property
     def analyst_name(self):
         return f"{self.user.first_name} {self.user.last_name}".strip() or self.user.username
@@ -173,6 +200,49 @@ class Analyst(models.Model):
         return self.user.username[:2].upper()
 
 
+class CryptoAnalysisQuerySet(models.QuerySet):
+    """Named column projections for CryptoAnalysis listings and APIs"""
+    # Large text and JSON columns only needed on the full analysis page
+    HEAVY_FIELDS = (
+        'full_content', 'preview_content', 'executive_summary',
+        'chart_data', 'chart_config', 'technical_indicators_json',
+        'support_levels', 'resistance_levels', 'chart_patterns', 'price_targets',
+        'fundamental_analysis', 'trading_strategy', 'risk_management_note',
+        'bullish_recommendation', 'bearish_recommendation',
+    )
+    PROJECTIONS = {
+        'card': HEAVY_FIELDS,
+        'api': HEAVY_FIELDS,
+        'detail': (),
+    }
+
+    @classmethod
+    def deferred_fields(cls, name, prefix=''):
+        """Column names deferred by projection ``name``, optionally as a relation path"""
+        return [f'{prefix}{field}' for field in cls.PROJECTIONS[name]]
+
+    def projection(self, name, keep=()):
+        """Restrict the loaded columns to those needed by projection ``name``"""
+        deferred = [field for field in self.deferred_fields(name) if field not in keep]
+        if not deferred:
+            return self.select_related('analyst', 'analyst__user')
+        queryset = self.defer(*deferred)
+        if 'trading_strategy' in deferred:
+            # features_list only needs one key of the strategy blob
+            queryset = queryset.annotate(features_json=KeyTransform('features', 'trading_strategy'))
+        return queryset
+
+    def with_chart_flag(self):
+        """Annotate ``has_charts_flag`` so has_interactive_charts needs no per-row queries"""
+        has_chart_data = Q(chart_data__isnull=False) & ~Q(chart_data={})
+        return self.annotate(has_charts_flag=ExpressionWrapper(
+            has_chart_data
+            | Q(Exists(ChartAnnotation.objects.filter(analysis=OuterRef('pk'))))
+            | Q(Exists(TechnicalIndicatorData.objects.filter(analysis=OuterRef('pk')))),
+            output_field=models.BooleanField(),
+        ))
+
+
 class CryptoAnalysis(models.Model):
     ANALYSIS_TYPES = [
         ('technical', 'Technical Analysis'),
@@ -265,6 +335,9 @@ class CryptoAnalysis(models.Model):
     
     # Metadata
     rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.00)
+    # Running totals behind ``rating`` (see dashboard.ratings)
+    rating_sum = models.IntegerField(default=0)
+    rating_count = models.IntegerField(default=0)
     sales_count = models.IntegerField(default=0)
     views_count = models.IntegerField(default=0)
     
@@ -274,13 +347,27 @@ class CryptoAnalysis(models.Model):
     
     # Chart Image (fallback)
     chart_image = models.ImageField(upload_to='analysis_charts/', blank=True, null=True)
+    # Resized copies of chart_image (see dashboard.images)
+    chart_image_variants = models.JSONField(default=dict, blank=True, editable=False)
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     published_at = models.DateTimeField(blank=True, null=True)
     
+    objects = CryptoAnalysisQuerySet.as_manager()
+    
     def __str__(self):
         return f"{self.cryptocurrency} ({self.symbol}) - {self.analysis_type}"
+
+    @property
+    def chart_image_srcset(self):
+        from .images import srcset
+        return srcset(self.chart_image)
+
+    @property
+    def chart_image_webp_srcset(self):
+        from .images import srcset
+        return srcset(self.chart_image, 'webp')
     
     @property
     def final_price(self):
@@ -304,6 +391,10 @@ class CryptoAnalysis(models.Model):
             "Support and resistance levels",
             "Interactive charts with annotations"
         ]
+        if 'features_json' in self.__dict__:
+            # Loaded through a projection that deferred trading_strategy
+            features = self.features_json
+            return default_features if features is None else features
         return self.trading_strategy.get('features', default_features) if self.trading_strategy else default_features
     
     @property
@@ -320,6 +411,8 @@ class CryptoAnalysis(models.Model):
     @property
     def has_interactive_charts(self):
         """Check if analysis has interactive chart data"""
+        if 'has_charts_flag' in self.__dict__:
+            return self.has_charts_flag
         return bool(self.chart_data) or self.chart_annotations.exists() or self.indicator_data.exists()
     
     def get_default_chart_data(self):
@@ -355,6 +448,23 @@ class CryptoAnalysis(models.Model):
         ordering = ['-created_at']
 
 
+class MarketInsightQuerySet(models.QuerySet):
+    """Named column projections for MarketInsight listings and APIs"""
+    HEAVY_FIELDS = ('full_content', 'potential_impact')
+    PROJECTIONS = {
+        'card': HEAVY_FIELDS,
+        'api': HEAVY_FIELDS,
+        'detail': (),
+    }
+
+    def projection(self, name, keep=()):
+        """Restrict the loaded columns to those needed by projection ``name``"""
+        deferred = [field for field in self.PROJECTIONS[name] if field not in keep]
+        if not deferred:
+            return self.select_related('verified_by', 'verified_by__user')
+        return self.defer(*deferred)
+
+
 class MarketInsight(models.Model):
     """Model for market insights and trends"""
     INSIGHT_TYPES = [
@@ -405,6 +515,8 @@ class MarketInsight(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    objects = MarketInsightQuerySet.as_manager()
+    
     def __str__(self):
         return f"{self.title} - {self.get_insight_type_display()}"
     
@@ -541,18 +653,36 @@ class AnalysisMetric(models.Model):
         ordering = ['name']
 
 
+class PurchasedAnalysisQuerySet(models.QuerySet):
+    def with_analysis(self, projection='card', analyst=False):
+        """Join the purchased analysis, deferring the projection's heavy columns"""
+        related = ['analysis']
+        if analyst:
+            related += ['analysis__analyst', 'analysis__analyst__user']
+        return self.select_related(*related).defer(
+            *CryptoAnalysisQuerySet.deferred_fields(projection, prefix='analysis__')
+        )
+
+
 class PurchasedAnalysis(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     analysis = models.ForeignKey(CryptoAnalysis, on_delete=models.CASCADE)
     purchase_price = models.DecimalField(max_digits=10, decimal_places=2)
     purchased_at = models.DateTimeField(auto_now_add=True)
     access_expires = models.DateTimeField(blank=True, null=True)
+    # Set once access_expires passes, by save() or the sweep_lifecycle command
+    access_expired = models.BooleanField(default=False)
     rating_given = models.IntegerField(blank=True, null=True)
     review = models.TextField(blank=True, null=True)
     
+    objects = PurchasedAnalysisQuerySet.as_manager()
+    
     class Meta:
         unique_together = ['user', 'analysis']
         ordering = ['-purchased_at']
+        indexes = [
+            models.Index(fields=['access_expired', 'access_expires'], name='purchase_expiry_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username} - {self.analysis.cryptocurrency}"
@@ -567,6 +697,10 @@ class PurchasedAnalysis(models.Model):
         # Set access expiry to 30 days from purchase if not set
         if not self.access_expires:
             self.access_expires = timezone.now() + timedelta(days=30)
+        self.access_expired = self.is_expired
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'access_expires' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'access_expired'}
         super().save(*args, **kwargs)
 
 
@@ -584,6 +718,94 @@ class AnalysisRating(models.Model):
         return f"{self.rating}/5 - {self.analysis.cryptocurrency}"
 
 
+class AnalysisNeighbors(models.Model):
+    """Precomputed top-k recommendations for one analysis (see dashboard.recommendations)"""
+    analysis = models.OneToOneField(
+        CryptoAnalysis, on_delete=models.CASCADE, primary_key=True, related_name='neighbors'
+    )
+    # Ranked ids of the most similar analyses
+    neighbor_ids = models.JSONField(default=list, blank=True)
+    # Sparse co-purchase counts keyed by the other analysis id, kept for incremental refresh
+    co_purchase_counts = models.JSONField(default=dict, blank=True)
+    buyer_count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Analysis Neighbors'
+        verbose_name_plural = 'Analysis Neighbors'
+
+    def __str__(self):
+        return f"Neighbors of analysis {self.analysis_id}"
+
+
+class AnalysisRanking(models.Model):
+    """Materialized sales/revenue/rating figures for one analysis over one window (see dashboard.rankings)"""
+    WINDOWS = [
+        ('7d', 'Last 7 days'),
+        ('30d', 'Last 30 days'),
+        ('all', 'All time'),
+    ]
+    WINDOW_DAYS = {'7d': 7, '30d': 30, 'all': None}
+
+    analysis = models.ForeignKey(CryptoAnalysis, on_delete=models.CASCADE, related_name='rankings')
+    window = models.CharField(max_length=3, choices=WINDOWS)
+    sales_count = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=15, decimal_places=2, default=0.00)
+    rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.00)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['analysis', 'window']
+        indexes = [
+            models.Index(fields=['window', '-sales_count', '-analysis'], name='ranking_sales_idx'),
+            models.Index(fields=['window', '-revenue', '-analysis'], name='ranking_revenue_idx'),
+            models.Index(fields=['window', '-rating', '-analysis'], name='ranking_rating_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.analysis_id} ({self.window}): {self.sales_count} sales"
+
+
+class AnalystRanking(models.Model):
+    """Materialized leaderboard figures for one analyst"""
+    analyst = models.OneToOneField(Analyst, on_delete=models.CASCADE, primary_key=True, related_name='ranking')
+    total_sales = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=15, decimal_places=2, default=0.00)
+    rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.00)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-total_sales', '-analyst'], name='analyst_ranking_sales_idx'),
+            models.Index(fields=['-rating', '-analyst'], name='analyst_ranking_rating_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.analyst_id}: {self.total_sales} sales"
+
+
+class DailyRollup(models.Model):
+    """Completed-transaction count and amount for one day and dimension combination (see dashboard.rollups)"""
+    date = models.DateField()
+    transaction_type = models.CharField(max_length=20, choices=TRANSACTION_TYPES)
+    payment_method = models.CharField(max_length=20, choices=UserWallet.PAYMENT_METHODS)
+    analysis = models.ForeignKey(CryptoAnalysis, on_delete=models.SET_NULL, null=True, blank=True, related_name='daily_rollups')
+    analyst = models.ForeignKey(Analyst, on_delete=models.SET_NULL, null=True, blank=True, related_name='daily_rollups')
+    count = models.IntegerField(default=0)
+    amount = models.DecimalField(max_digits=15, decimal_places=2, default=0.00)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['date', 'transaction_type', 'payment_method'], name='rollup_date_idx'),
+            models.Index(fields=['analysis', 'date'], name='rollup_analysis_idx'),
+            models.Index(fields=['analyst', 'date'], name='rollup_analyst_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} {self.transaction_type}/{self.payment_method}: {self.count} (${self.amount})"
+
+
 class Category(models.Model):
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True, null=True)
@@ -631,6 +853,10 @@ class ConsultationPackage(models.Model):
         return dict(self.LEVEL_CHOICES).get(self.level, self.level)
 
 
+# Reminders sent this long before a consultation starts
+CONSULTATION_REMINDER_OFFSETS = (timedelta(hours=24), timedelta(hours=1))
+
+
 class Consultation(models.Model):
     STATUS_CHOICES = [
         ('scheduled', 'Scheduled'),
@@ -664,12 +890,17 @@ class Consultation(models.Model):
     ]
     
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Set when booked through dashboard.scheduling; older bookings have none
+    analyst = models.ForeignKey('Analyst', on_delete=models.SET_NULL, null=True, blank=True,
+                                related_name='consultations')
     title = models.CharField(max_length=200)
     level = models.CharField(max_length=20, choices=LEVEL_CHOICES, default='beginner')
     description = models.TextField(blank=True, null=True)
     price = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     duration_minutes = models.IntegerField(default=60)
     scheduled_date = models.DateTimeField()
+    # scheduled_date + duration_minutes, stored so overdue sessions can be found in SQL
+    ends_at = models.DateTimeField(blank=True, null=True)
     
     # Video Consultation Fields
     meeting_platform = models.CharField(max_length=20, choices=MEETING_PLATFORMS, default='jitsi')
@@ -707,10 +938,24 @@ class Consultation(models.Model):
     
     class Meta:
         ordering = ['-scheduled_date']
+        indexes = [
+            models.Index(fields=['analyst', 'scheduled_date'], name='consultation_analyst_idx'),
+            models.Index(fields=['status', 'ends_at'], name='consultation_due_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username} - {self.title} - {self.scheduled_date}"
     
+    def set_ends_at(self):
+        self.ends_at = self.scheduled_date + timedelta(minutes=self.duration_minutes or 0)
+    
+    def save(self, *args, **kwargs):
+        self.set_ends_at()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'scheduled_date', 'duration_minutes'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'ends_at'}
+        super().save(*args, **kwargs)
+    
     @property
     def is_upcoming(self):
         return self.status == 'scheduled' and self.scheduled_date > timezone.now()
@@ -765,30 +1010,42 @@ class Consultation(models.Model):
         else:
             return 'Scheduled'
     
+    def assign_meeting_details(self):
+        """Fill in the meeting ID, password and links without saving; returns whether anything was set"""
+        if self.meeting_id:
+            return False
+        # Random rather than pk-based so the details can be set before the row is inserted
+        self.meeting_id = f"CONS{uuid.uuid4().hex[:10].upper()}"
+        
+        # Generate secure password
+        self.meeting_password = ''.join(random.choices(string.ascii_letters + string.digits, k=8))
+        
+        # Generate meeting link based on platform
+        if self.meeting_platform == 'jitsi':
+            self.meeting_link = f"https://meet.jit.si/ConsApp{self.meeting_id}"
+            self.join_url = self.meeting_link
+        elif self.meeting_platform == 'zoom':
+            # This would integrate with Zoom API in a real implementation
+            self.meeting_link = f"https://zoom.us/j/{self.meeting_id}"
+            self.join_url = self.meeting_link
+        elif self.meeting_platform == 'google_meet':
+            # Google Meet links are generated differently
+            self.meeting_link = f"https://meet.google.com/{self.meeting_id}"
+            self.join_url = self.meeting_link
+        return True
+    
     def generate_meeting_details(self):
         """Generate meeting details for video consultation"""
-        if not self.meeting_id:
-            # Generate unique meeting ID
-            self.meeting_id = f"CONS{self.id:06d}{random.randint(1000, 9999)}"
-            
-            # Generate secure password
-            self.meeting_password = ''.join(random.choices(string.ascii_letters + string.digits, k=8))
-            
-            # Generate meeting link based on platform
-            if self.meeting_platform == 'jitsi':
-                self.meeting_link = f"https://meet.jit.si/ConsApp{self.meeting_id}"
-                self.join_url = self.meeting_link
-            elif self.meeting_platform == 'zoom':
-                # This would integrate with Zoom API in a real implementation
-                self.meeting_link = f"https://zoom.us/j/{self.meeting_id}"
-                self.join_url = self.meeting_link
-            elif self.meeting_platform == 'google_meet':
-                # Google Meet links are generated differently
-                self.meeting_link = f"https://meet.google.com/{self.meeting_id}"
-                self.join_url = self.meeting_link
-            
+        if self.assign_meeting_details():
             self.save()
     
+    def build_reminders(self):
+        """Unsaved ConsultationReminders for a newly scheduled consultation"""
+        return [
+            ConsultationReminder(consultation=self, reminder_type='email', scheduled_time=self.scheduled_date - offset)
+            for offset in CONSULTATION_REMINDER_OFFSETS
+        ]
+    
     def start_session(self):
         """Mark session as started"""
         if self.status == 'scheduled':
@@ -809,33 +1066,42 @@ class Consultation(models.Model):
     
     def cancel_consultation(self, refund=False):
         """Cancel consultation with optional refund"""
-        self.status = 'cancelled'
-        
-        if refund and self.payment_status == 'paid':
-            # Process refund logic here
-            self.payment_status = 'refunded'
-            
-            # Refund to user's wallet if paid with wallet
-            if self.payment_method == 'wallet':
-                try:
-                    user_wallet = UserWallet.objects.get(user=self.user)
-                    user_wallet.balance += self.price
-                    user_wallet.save()
-                    
-                    # Create refund transaction
-                    Transaction.objects.create(
-                        user=self.user,
-                        amount=self.price,
-                        transaction_type='refund',
-                        payment_method='wallet',
-                        status='completed',
-                        description=f"Refund for cancelled consultation: {self.title}",
-                        consultation=self
-                    )
-                except UserWallet.DoesNotExist:
-                    pass
-        
-        self.save()
+        from django.db import transaction as db_transaction
+
+        if self.status == 'cancelled':
+            return
+
+        with db_transaction.atomic():
+            self.status = 'cancelled'
+            refunded = Decimal('0.00')
+
+            if refund and self.payment_status == 'paid':
+                # Process refund logic here
+                self.payment_status = 'refunded'
+
+                # Refund to user's wallet if paid with wallet
+                if self.payment_method == 'wallet':
+                    try:
+                        user_wallet = UserWallet.objects.get(user=self.user)
+                        user_wallet.balance += self.price
+                        user_wallet.save()
+
+                        # Create refund transaction
+                        Transaction.objects.create(
+                            user=self.user,
+                            amount=self.price,
+                            transaction_type='refund',
+                            payment_method='wallet',
+                            status='completed',
+                            description=f"Refund for cancelled consultation: {self.title}",
+                            consultation=self
+                        )
+                        refunded = self.price
+                    except UserWallet.DoesNotExist:
+                        pass
+
+            self.save()
+            UserStats.record(self.user_id, consultations_cancelled=1, total_refunded=refunded)
     
     def get_level_display(self):
         return dict(self.LEVEL_CHOICES).get(self.level, self.level)
@@ -857,6 +1123,45 @@ class ConsultationAttachment(models.Model):
     def __str__(self):
         return f"{self.file_name} - {self.consultation.title}"
 
+    def get_absolute_url(self):
+        return reverse('consultation_attachment', args=[self.pk])
+
+
+class AttachmentUpload(models.Model):
+    """A resumable, chunked upload of a ConsultationAttachment (see dashboard.uploads)"""
+    upload_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    consultation = models.ForeignKey(Consultation, on_delete=models.CASCADE, related_name='attachment_uploads')
+    uploaded_by = models.ForeignKey(User, on_delete=models.CASCADE)
+    file_name = models.CharField(max_length=255)
+    file_type = models.CharField(max_length=50)
+    description = models.TextField(blank=True, null=True)
+    size = models.PositiveBigIntegerField()
+    chunk_size = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.file_name} ({self.upload_id})"
+
+    @property
+    def total_chunks(self):
+        return -(-self.size // self.chunk_size)
+
+    def chunk_length(self, index):
+        """Bytes in chunk ``index``; only the last one may be short"""
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+
+class AttachmentUploadChunk(models.Model):
+    """A chunk of an AttachmentUpload written to its staging file and verified"""
+    upload = models.ForeignKey(AttachmentUpload, on_delete=models.CASCADE, related_name='chunks')
+    index = models.PositiveIntegerField()
+    sha256 = models.CharField(max_length=64)
+    received_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['upload', 'index']
+
 
 class ConsultationReminder(models.Model):
     """Track consultation reminders"""
@@ -869,10 +1174,164 @@ class ConsultationReminder(models.Model):
     scheduled_time = models.DateTimeField()
     sent_time = models.DateTimeField(blank=True, null=True)
     is_sent = models.BooleanField(default=False)
+    # Failed deliveries, retried with backoff by dashboard.reminders
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.CharField(max_length=255, blank=True, default='')
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
         ordering = ['scheduled_time']
+        indexes = [
+            models.Index(fields=['is_sent', 'scheduled_time'], name='reminder_due_idx'),
+        ]
+
+
+class UserStats(models.Model):
+    """
+    Denormalized per-user totals, maintained alongside each ledger event.
+
+    The views apply each event with record(), and the ledger admins rebuild
+    the owner's row after an edit.  Writes made any other way (the shell,
+    scripts, raw SQL) are not tracked, so ``rebuild_user_stats`` is also run
+    as a periodic task (e.g. nightly from cron) to repair any drift.
+    """
+    STAT_FIELDS = [
+        'purchase_count', 'total_spent', 'total_deposited', 'total_withdrawn',
+        'total_refunded', 'consultations_booked', 'consultations_cancelled',
+        'consultation_spend', 'ratings_given', 'rating_given_total',
+    ]
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='stats')
+
+    # Analysis purchases
+    purchase_count = models.IntegerField(default=0)
+    total_spent = models.DecimalField(max_digits=15, decimal_places=2, default=0.00)
+
+    # Wallet movements (withdrawals are counted while pending, as the funds are held)
+    total_deposited = models.DecimalField(max_digits=15, decimal_places=2, default=0.00)
+    total_withdrawn = models.DecimalField(max_digits=15, decimal_places=2, default=0.00)
+    total_refunded = models.DecimalField(max_digits=15, decimal_places=2, default=0.00)
+
+    # Consultations
+    consultations_booked = models.IntegerField(default=0)
+    consultations_cancelled = models.IntegerField(default=0)
+    consultation_spend = models.DecimalField(max_digits=15, decimal_places=2, default=0.00)
+
+    # Analysis ratings written by the user
+    ratings_given = models.IntegerField(default=0)
+    rating_given_total = models.IntegerField(default=0)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'User Statistics'
+        verbose_name_plural = 'User Statistics'
+
+    def __str__(self):
+        return f"{self.user.username}'s Stats"
+
+    @property
+    def average_rating_given(self):
+        if not self.ratings_given:
+            return None
+        return Decimal(self.rating_given_total) / self.ratings_given
+
+    @classmethod
+    def for_user(cls, user):
+        """Return the user's stats row, building it from history if missing"""
+        user_id = getattr(user, 'pk', user)
+        stats = cls.objects.filter(user_id=user_id).first()
+        if stats is None:
+            cls.rebuild(user_ids=[user_id])
+            stats = cls.objects.get(user_id=user_id)
+        return stats
+
+    @classmethod
+    def record(cls, user, create=True, **deltas):
+        """
+        Apply ``deltas`` (field name -> increment) to the user's stats row.
+
+        Call this inside the same atomic block as the ledger write and after
+        the history rows for the event have been saved: a missing row is
+        rebuilt from history, which then already includes the event.  With
+        ``create=False`` a missing row is left missing, for paths (such as a
+        cascade from deleting the user) where the row may already be gone.
+        """
+        from django.db import transaction as db_transaction
+        from django.db.models import F
+
+        user_id = getattr(user, 'pk', user)
+        with db_transaction.atomic():
+            if not cls.objects.filter(user_id=user_id).exists():
+                if create:
+                    cls.rebuild(user_ids=[user_id])
+                return
+            updates = {field: F(field) + value for field, value in deltas.items()}
+            cls.objects.filter(user_id=user_id).update(updated_at=timezone.now(), **updates)
+
+    @classmethod
+    def rebuild(cls, user_ids=None, batch_size=1000):
+        """Recompute stats rows from history in batches; returns rows written"""
+        from django.db.models import Count, Q, Sum
+
+        users = User.objects.order_by('pk')
+        if user_ids is not None:
+            users = users.filter(pk__in=user_ids)
+        all_ids = list(users.values_list('pk', flat=True))
+
+        written = 0
+        for start in range(0, len(all_ids), batch_size):
+            chunk = all_ids[start:start + batch_size]
+            rows = {user_id: cls(user_id=user_id) for user_id in chunk}
+
+            purchases = PurchasedAnalysis.objects.filter(user_id__in=chunk).values('user_id').annotate(
+                count=Count('pk'),
+                spent=Sum('purchase_price'),
+            ).order_by()
+            for item in purchases:
+                row = rows[item['user_id']]
+                row.purchase_count = item['count']
+                row.total_spent = item['spent'] or Decimal('0.00')
+
+            ledger = Transaction.objects.filter(user_id__in=chunk).values('user_id').annotate(
+                deposited=Sum('amount', filter=Q(transaction_type='deposit', status='completed')),
+                withdrawn=Sum('amount', filter=Q(transaction_type='withdrawal', status__in=['pending', 'completed'])),
+                refunded=Sum('amount', filter=Q(transaction_type='refund', status='completed')),
+            ).order_by()
+            for item in ledger:
+                row = rows[item['user_id']]
+                row.total_deposited = item['deposited'] or Decimal('0.00')
+                row.total_withdrawn = item['withdrawn'] or Decimal('0.00')
+                row.total_refunded = item['refunded'] or Decimal('0.00')
+
+            consultations = Consultation.objects.filter(user_id__in=chunk).values('user_id').annotate(
+                booked=Count('pk'),
+                cancelled=Count('pk', filter=Q(status='cancelled')),
+                spend=Sum('price'),
+            ).order_by()
+            for item in consultations:
+                row = rows[item['user_id']]
+                row.consultations_booked = item['booked']
+                row.consultations_cancelled = item['cancelled']
+                row.consultation_spend = item['spend'] or Decimal('0.00')
+
+            ratings = AnalysisRating.objects.filter(user_id__in=chunk).values('user_id').annotate(
+                count=Count('pk'),
+                total=Sum('rating'),
+            ).order_by()
+            for item in ratings:
+                row = rows[item['user_id']]
+                row.ratings_given = item['count']
+                row.rating_given_total = item['total'] or 0
+
+            cls.objects.bulk_create(
+                rows.values(),
+                update_conflicts=True,
+                unique_fields=['user'],
+                update_fields=cls.STAT_FIELDS,
+            )
+            written += len(rows)
+        return written
 
 
 class SiteSetting(models.Model):
@@ -885,6 +1344,29 @@ class SiteSetting(models.Model):
         return self.name
 
 
+class MediaBlob(models.Model):
+    """One stored copy of some file content, shared by every MediaFile with the same bytes"""
+    # blobs/<aa>/<bb>/<sha256><ext>, relative to MEDIA_ROOT
+    path = models.CharField(max_length=100, unique=True)
+    sha256 = models.CharField(max_length=64, db_index=True)
+    size = models.PositiveBigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.path
+
+
+class MediaFile(models.Model):
+    """A file name handed out by the media storage (see dashboard.storage) and its content"""
+    name = models.CharField(max_length=255, unique=True)
+    blob = models.ForeignKey(MediaBlob, on_delete=models.PROTECT, related_name='files')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+
 # Signal handlers
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -906,26 +1388,21 @@ def save_user_profile(sender, instance, **kwargs):
 @receiver(post_save, sender=Consultation)
 def generate_meeting_on_creation(sender, instance, created, **kwargs):
     """Automatically generate meeting details when consultation is created"""
-    if created and instance.status == 'scheduled':
-        instance.generate_meeting_details()
+    # dashboard.bookings sets the details before inserting; this covers other creations
+    if created and instance.status == 'scheduled' and not getattr(instance, '_booking_prepared', False):
+        if instance.assign_meeting_details():
+            Consultation.objects.filter(pk=instance.pk).update(
+                meeting_id=instance.meeting_id,
+                meeting_password=instance.meeting_password,
+                meeting_link=instance.meeting_link,
+                join_url=instance.join_url,
+            )
 
 @receiver(post_save, sender=Consultation)
 def create_consultation_reminders(sender, instance, created, **kwargs):
     """Create automatic reminders for consultations"""
-    if created and instance.status == 'scheduled':
-        # Create 24-hour reminder
-        ConsultationReminder.objects.create(
-            consultation=instance,
-            reminder_type='email',
-            scheduled_time=instance.scheduled_date - timedelta(hours=24)
-        )
-        
-        # Create 1-hour reminder
-        ConsultationReminder.objects.create(
-            consultation=instance,
-            reminder_type='email',
-            scheduled_time=instance.scheduled_date - timedelta(hours=1)
-        )
+    if created and instance.status == 'scheduled' and not getattr(instance, '_booking_prepared', False):
+        ConsultationReminder.objects.bulk_create(instance.build_reminders())
 
 
 class MpesaTransaction(models.Model):
@@ -0,0 +1,244 @@
+"""
+Materialized rankings behind the marketplace sort orders and the analyst
+leaderboard.
+
+AnalysisRanking keeps sales, revenue and average rating per analysis for
+each window (7 days, 30 days, all time); AnalystRanking keeps the same
+figures per analyst.  Purchases bump the counters with F() updates once they
+commit, and rating changes re-average the affected rows.  Windowed rows only
+grow between refreshes, so ``refresh_rankings`` (the ``refresh_rankings``
+command) should run periodically to age purchases and ratings out of the
+7 and 30 day windows.
+
+Sorted marketplace pages use keyset pagination on ``(sort value, id)``,
+which the ranking indexes serve directly, so a page costs the same however
+deep the reader scrolls.
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction as db_transaction
+from django.db.models import Avg, Count, F, Q, Sum
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+
+from .models import (
+    Analyst, AnalysisRanking, AnalysisRating, AnalystRanking, CryptoAnalysis, PurchasedAnalysis,
+)
+
+MARKETPLACE_PAGE_SIZE = 24
+
+# Windowed sorts order AnalysisRanking rows by ``field``; the others order analyses
+SortOrder = namedtuple('SortOrder', ['label', 'field', 'parse', 'windowed'])
+
+MARKETPLACE_SORTS = {
+    'newest': SortOrder('Newest', 'created_at', datetime.fromisoformat, False),
+    'best_selling': SortOrder('Best selling', 'sales_count', int, True),
+    'top_revenue': SortOrder('Top revenue', 'revenue', Decimal, True),
+    'top_rated': SortOrder('Top rated', 'rating', Decimal, True),
+    'top_analysts': SortOrder('Top analysts', 'analyst__ranking__total_sales', int, False),
+}
+DEFAULT_SORT = 'newest'
+DEFAULT_WINDOW = 'all'
+
+
+def _window_start(window, now):
+    days = AnalysisRanking.WINDOW_DAYS[window]
+    return now - timedelta(days=days) if days else None
+
+
+# Refresh
+
+def refresh_rankings(batch_size=500):
+    """Recompute every ranking row from purchase and rating history"""
+    now = timezone.now()
+    analysis_ids = list(CryptoAnalysis.objects.values_list('pk', flat=True))
+
+    rows = []
+    for window, _ in AnalysisRanking.WINDOWS:
+        start = _window_start(window, now)
+        purchases = PurchasedAnalysis.objects.all()
+        ratings = AnalysisRating.objects.all()
+        if start:
+            purchases = purchases.filter(purchased_at__gte=start)
+            ratings = ratings.filter(created_at__gte=start)
+        sales = {
+            row['analysis']: row
+            for row in purchases.values('analysis').annotate(count=Count('pk'), revenue=Sum('purchase_price')).order_by()
+        }
+        averages = dict(ratings.values_list('analysis').annotate(average=Avg('rating')).order_by())
+        for analysis_id in analysis_ids:
+            sold = sales.get(analysis_id, {})
+            rows.append(AnalysisRanking(
+                analysis_id=analysis_id,
+                window=window,
+                sales_count=sold.get('count', 0),
+                revenue=sold.get('revenue') or Decimal('0.00'),
+                rating=round(Decimal(averages.get(analysis_id) or 0), 2),
+            ))
+    AnalysisRanking.objects.bulk_create(
+        rows,
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=['analysis', 'window'],
+        update_fields=['sales_count', 'revenue', 'rating', 'updated_at'],
+    )
+
+    analyst_sales = {
+        row['analysis__analyst']: row
+        for row in PurchasedAnalysis.objects.values('analysis__analyst')
+        .annotate(count=Count('pk'), revenue=Sum('purchase_price')).order_by()
+    }
+    analyst_ratings = dict(
+        AnalysisRating.objects.values_list('analysis__analyst').annotate(average=Avg('rating')).order_by()
+    )
+    analyst_rows = [
+        AnalystRanking(
+            analyst_id=analyst_id,
+            total_sales=analyst_sales.get(analyst_id, {}).get('count', 0),
+            revenue=analyst_sales.get(analyst_id, {}).get('revenue') or Decimal('0.00'),
+            rating=round(Decimal(analyst_ratings.get(analyst_id) or 0), 2),
+        )
+        for analyst_id in Analyst.objects.values_list('pk', flat=True)
+    ]
+    AnalystRanking.objects.bulk_create(
+        analyst_rows,
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=['analyst'],
+        update_fields=['total_sales', 'revenue', 'rating', 'updated_at'],
+    )
+    return len(analysis_ids), len(analyst_rows)
+
+
+# Incremental updates
+
+def ensure_analysis_rows(*analysis_ids):
+    AnalysisRanking.objects.bulk_create(
+        [
+            AnalysisRanking(analysis_id=analysis_id, window=window)
+            for analysis_id in analysis_ids
+            for window, _ in AnalysisRanking.WINDOWS
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def ensure_analyst_row(analyst_id):
+    AnalystRanking.objects.get_or_create(analyst_id=analyst_id)
+
+
+def record_purchase(analysis_id, price):
+    """Count one committed purchase in every window and on the analyst's row"""
+    now = timezone.now()
+    analyst_id = CryptoAnalysis.objects.filter(pk=analysis_id).values_list('analyst_id', flat=True).first()
+    if analyst_id is None:
+        return
+    ensure_analysis_rows(analysis_id)
+    ensure_analyst_row(analyst_id)
+    AnalysisRanking.objects.filter(analysis_id=analysis_id).update(
+        sales_count=F('sales_count') + 1, revenue=F('revenue') + price, updated_at=now,
+    )
+    AnalystRanking.objects.filter(analyst_id=analyst_id).update(
+        total_sales=F('total_sales') + 1, revenue=F('revenue') + price, updated_at=now,
+    )
+
+
+def record_rating_change(analysis_id):
+    """Refresh the rating columns touched by a rating being saved or deleted"""
+    now = timezone.now()
+    analysis = CryptoAnalysis.objects.filter(pk=analysis_id).values('analyst_id', 'rating', 'analyst__rating').first()
+    if analysis is None:
+        return
+    # All-time means are maintained by dashboard.ratings; only the windows need averaging
+    windowed = [(window, _window_start(window, now)) for window, _ in AnalysisRanking.WINDOWS if AnalysisRanking.WINDOW_DAYS[window]]
+    averages = AnalysisRating.objects.filter(analysis_id=analysis_id).aggregate(**{
+        window: Avg('rating', filter=Q(created_at__gte=start)) for window, start in windowed
+    })
+    averages['all'] = analysis['rating']
+    ensure_analysis_rows(analysis_id)
+    for window, average in averages.items():
+        AnalysisRanking.objects.filter(analysis_id=analysis_id, window=window).update(
+            rating=round(Decimal(average or 0), 2), updated_at=now,
+        )
+
+    ensure_analyst_row(analysis['analyst_id'])
+    AnalystRanking.objects.filter(analyst_id=analysis['analyst_id']).update(
+        rating=analysis['analyst__rating'], updated_at=now,
+    )
+
+
+def _analysis_saved(sender, instance, created, **kwargs):
+    if created:
+        ensure_analysis_rows(instance.pk)
+
+
+def _analyst_saved(sender, instance, created, **kwargs):
+    if created:
+        ensure_analyst_row(instance.pk)
+
+
+def _purchase_saved(sender, instance, created, **kwargs):
+    if created:
+        analysis_id, price = instance.analysis_id, instance.purchase_price
+        db_transaction.on_commit(lambda: record_purchase(analysis_id, price))
+
+
+def _rating_changed(sender, instance, **kwargs):
+    analysis_id = instance.analysis_id
+    db_transaction.on_commit(lambda: record_rating_change(analysis_id))
+
+
+post_save.connect(_analysis_saved, sender=CryptoAnalysis, dispatch_uid='rankings_analysis_saved')
+post_save.connect(_analyst_saved, sender=Analyst, dispatch_uid='rankings_analyst_saved')
+post_save.connect(_purchase_saved, sender=PurchasedAnalysis, dispatch_uid='rankings_purchase_saved')
+post_save.connect(_rating_changed, sender=AnalysisRating, dispatch_uid='rankings_rating_saved')
+post_delete.connect(_rating_changed, sender=AnalysisRating, dispatch_uid='rankings_rating_deleted')
+
+
+# Marketplace sorting
+
+def _parse_cursor(cursor, order):
+    try:
+        value, last_id = cursor.rsplit('|', 1)
+        return order.parse(value), int(last_id)
+    except (ValueError, InvalidOperation):
+        return None
+
+
+def sorted_page(queryset, sort, window=DEFAULT_WINDOW, cursor=None, page_size=MARKETPLACE_PAGE_SIZE):
+    """Return ``(analyses, next_cursor)`` for one keyset-paginated marketplace page"""
+    order = MARKETPLACE_SORTS.get(sort) or MARKETPLACE_SORTS[DEFAULT_SORT]
+    if order.windowed:
+        if window not in AnalysisRanking.WINDOW_DAYS:
+            window = DEFAULT_WINDOW
+        # Walk the window's ranking index (every analysis has a row, see
+        # ensure_analysis_rows), then load just the page's analyses
+        rows, key = AnalysisRanking.objects.filter(window=window, analysis__in=queryset.values('pk')), 'analysis_id'
+    else:
+        rows, key = queryset, 'id'
+    position = _parse_cursor(cursor, order) if cursor else None
+    if position:
+        value, last_id = position
+        rows = rows.filter(Q(**{f'{order.field}__lt': value}) | Q(**{order.field: value, f'{key}__lt': last_id}))
+    rows = rows.order_by(f'-{order.field}', f'-{key}')
+
+    if order.windowed:
+        keys = list(rows.values_list(order.field, 'analysis_id')[:page_size + 1])
+        analyses = queryset.in_bulk([pk for _, pk in keys])
+        page = [(value, analyses[pk]) for value, pk in keys if pk in analyses]
+    else:
+        page = [(analysis.sort_value, analysis) for analysis in rows.annotate(sort_value=F(order.field))[:page_size + 1]]
+
+    next_cursor = None
+    if len(page) > page_size:
+        page = page[:page_size]
+        value, last = page[-1]
+        value = value.isoformat() if isinstance(value, datetime) else value
+        next_cursor = f"{value}|{last.pk}"
+    return [analysis for _, analysis in page], next_cursor
+
+
+def top_analysts(limit=5):
+    return AnalystRanking.objects.select_related('analyst__user').order_by('-total_sales', '-analyst')[:limit]
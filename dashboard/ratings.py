@@ -0,0 +1,117 @@
+"""
+Incremental rating aggregation.
+
+CryptoAnalysis and Analyst keep ``rating_sum`` / ``rating_count`` running
+totals next to their ``rating`` mean, and UserStats counts the ratings each
+user has written.  Every AnalysisRating create, update and delete applies
+its delta with a single F() UPDATE per row, so the mean is always available
+without scanning ratings.  ``reconcile_ratings`` (and the command of the
+same name) recomputes the totals from AnalysisRating to repair any drift.
+"""
+
+from django.db.models import Case, Count, DecimalField, F, FloatField, IntegerField, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Cast, Coalesce, Round
+from django.db.models.lookups import GreaterThan
+from django.db.models.signals import post_delete, post_init, post_save
+
+from .models import Analyst, AnalysisRating, CryptoAnalysis, UserStats
+
+# Attribute holding the (analysis_id, user_id, rating) an instance was loaded with
+_LOADED_ATTR = '_rating_loaded_state'
+
+
+def _mean(total, count):
+    """SQL for the stored ``rating``: total / count to 2 places, 0 without ratings"""
+    return Case(
+        When(GreaterThan(count, 0), then=Round(Cast(total, FloatField()) / count, 2)),
+        default=Value(0.0),
+        output_field=FloatField(),
+    )
+
+
+def _mean_update(sum_delta, count_delta):
+    """UPDATE kwargs applying a delta to rating_sum/rating_count and the mean"""
+    new_sum = F('rating_sum') + sum_delta
+    new_count = F('rating_count') + count_delta
+    # ``rating`` is listed first: MySQL evaluates SET clauses left to right
+    return {
+        'rating': _mean(new_sum, new_count),
+        'rating_sum': new_sum,
+        'rating_count': new_count,
+    }
+
+
+def apply_rating_delta(analysis_id, user_id, sum_delta, count_delta, create_stats=True):
+    """Fold one rating change into the analysis, analyst and user totals"""
+    if not sum_delta and not count_delta:
+        return
+    analyst_id = CryptoAnalysis.objects.filter(pk=analysis_id).values_list('analyst_id', flat=True).first()
+    CryptoAnalysis.objects.filter(pk=analysis_id).update(**_mean_update(sum_delta, count_delta))
+    if analyst_id is not None:
+        Analyst.objects.filter(pk=analyst_id).update(**_mean_update(sum_delta, count_delta))
+    UserStats.record(user_id, create=create_stats, ratings_given=count_delta, rating_given_total=sum_delta)
+
+
+def _loaded_state(instance):
+    if instance.pk is None:
+        return None
+    return (instance.analysis_id, instance.user_id, instance.__dict__.get('rating'))
+
+
+def _remember_loaded_state(sender, instance, **kwargs):
+    setattr(instance, _LOADED_ATTR, _loaded_state(instance))
+
+
+def _rating_saved(sender, instance, created, **kwargs):
+    previous = None if created else getattr(instance, _LOADED_ATTR, None)
+    if previous is None:
+        apply_rating_delta(instance.analysis_id, instance.user_id, instance.rating, 1)
+    elif previous[:2] == (instance.analysis_id, instance.user_id):
+        apply_rating_delta(instance.analysis_id, instance.user_id, instance.rating - previous[2], 0)
+    else:
+        # Moved to another analysis or user: retract the old rating, add the new one
+        apply_rating_delta(previous[0], previous[1], -previous[2], -1)
+        apply_rating_delta(instance.analysis_id, instance.user_id, instance.rating, 1)
+    setattr(instance, _LOADED_ATTR, _loaded_state(instance))
+
+
+def _rating_deleted(sender, instance, **kwargs):
+    analysis_id, user_id, rating = getattr(instance, _LOADED_ATTR, None) or _loaded_state(instance)
+    # Deleting the user cascades to their stats row before their ratings, so
+    # don't rebuild it; a missing row is rebuilt later without this rating anyway
+    apply_rating_delta(analysis_id, user_id, -rating, -1, create_stats=False)
+
+
+post_init.connect(_remember_loaded_state, sender=AnalysisRating, dispatch_uid='ratings_loaded')
+post_save.connect(_rating_saved, sender=AnalysisRating, dispatch_uid='ratings_saved')
+post_delete.connect(_rating_deleted, sender=AnalysisRating, dispatch_uid='ratings_deleted')
+
+
+def _reconcile(model, rating_filter, batch_size):
+    totals = AnalysisRating.objects.filter(**{rating_filter: OuterRef('pk')}).order_by().values(rating_filter)
+    drifted = model.objects.annotate(
+        actual_sum=Coalesce(Subquery(totals.annotate(total=Sum('rating')).values('total')), 0,
+                            output_field=IntegerField()),
+        actual_count=Coalesce(Subquery(totals.annotate(count=Count('pk')).values('count')), 0,
+                              output_field=IntegerField()),
+    ).annotate(
+        # Computed like the incremental updates so both round the same way
+        actual_rating=Cast(_mean(F('actual_sum'), F('actual_count')), DecimalField(max_digits=3, decimal_places=2)),
+    ).filter(
+        ~Q(rating_sum=F('actual_sum')) | ~Q(rating_count=F('actual_count')) | ~Q(rating=F('actual_rating'))
+    ).only('pk', 'rating', 'rating_sum', 'rating_count')
+
+    fixed = []
+    for obj in drifted.iterator(chunk_size=batch_size):
+        obj.rating_sum, obj.rating_count, obj.rating = obj.actual_sum, obj.actual_count, obj.actual_rating
+        fixed.append(obj)
+    model.objects.bulk_update(fixed, ['rating', 'rating_sum', 'rating_count'], batch_size=batch_size)
+    return len(fixed)
+
+
+def reconcile_ratings(batch_size=500):
+    """Recompute drifted analysis and analyst rating totals and means; returns (analyses, analysts) fixed"""
+    return (
+        _reconcile(CryptoAnalysis, 'analysis', batch_size),
+        _reconcile(Analyst, 'analysis__analyst', batch_size),
+    )
@@ -0,0 +1,208 @@
+"""
+Item-item recommendations for the "similar analyses" panel.
+
+Each analysis is scored against its candidates by blending co-purchase
+cosine similarity (``co(a, b) / sqrt(buyers(a) * buyers(b))``) with a small
+content score from shared symbol, analysis type and risk level.  Candidates
+are the analyses co-purchased with it plus those on the same symbol.  The
+top ``NEIGHBOR_COUNT`` ids are stored in AnalysisNeighbors together with the
+sparse co-purchase counts, so a new purchase only re-ranks the rows it
+touches instead of rebuilding the whole matrix.  ``build_recommendations``
+recomputes everything; run it periodically, since incremental updates do
+not re-rank rows whose scores shift only through a neighbour's buyer count.
+"""
+import logging
+import math
+from collections import Counter, defaultdict
+
+from django.core.cache import cache
+from django.db import transaction as db_transaction
+from django.db.models import Count, Q
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from .models import AnalysisNeighbors, CryptoAnalysis, PurchasedAnalysis
+
+logger = logging.getLogger(__name__)
+
+NEIGHBOR_COUNT = 6
+NEIGHBOR_CACHE_TIMEOUT = 60 * 60
+
+CO_PURCHASE_WEIGHT = 0.7
+CONTENT_WEIGHTS = {'symbol': 0.5, 'analysis_type': 0.3, 'risk_level': 0.2}
+CONTENT_FIELDS = ('id', 'is_active', *CONTENT_WEIGHTS)
+
+# Cap on one user's library when counting pairs during a full build
+MAX_LIBRARY_SIZE = 500
+
+
+def neighbors_cache_key(analysis_id):
+    return f"dashboard:analysis_neighbors:{analysis_id}"
+
+
+def get_similar_analysis_ids(analysis_id):
+    """Ranked ids of analyses similar to ``analysis_id`` (empty if not built yet)"""
+    key = neighbors_cache_key(analysis_id)
+    ids = cache.get(key)
+    if ids is None:
+        ids = AnalysisNeighbors.objects.filter(pk=analysis_id).values_list('neighbor_ids', flat=True).first() or []
+        cache.set(key, ids, NEIGHBOR_CACHE_TIMEOUT)
+    return ids
+
+
+def _content_similarity(a, b):
+    return sum(weight for field, weight in CONTENT_WEIGHTS.items() if a[field] and a[field] == b[field])
+
+
+def _rank(analysis_id, co_counts, buyer_counts, features, symbol_index):
+    """Return the top neighbour ids for one analysis"""
+    own = features.get(analysis_id)
+    if own is None:
+        return []
+    own_buyers = buyer_counts.get(analysis_id, 0)
+    candidates = set(co_counts) | symbol_index.get(own['symbol'], set())
+    candidates.discard(analysis_id)
+
+    scored = []
+    for other_id in candidates:
+        other = features.get(other_id)
+        if other is None or not other['is_active']:
+            continue
+        co = co_counts.get(other_id, 0)
+        denominator = math.sqrt(own_buyers * buyer_counts.get(other_id, 0))
+        cosine = co / denominator if denominator else 0.0
+        score = CO_PURCHASE_WEIGHT * cosine + (1 - CO_PURCHASE_WEIGHT) * _content_similarity(own, other)
+        if score > 0:
+            scored.append((-score, other_id))
+    scored.sort()
+    return [other_id for _, other_id in scored[:NEIGHBOR_COUNT]]
+
+
+def _load_features(queryset):
+    features = {row['id']: row for row in queryset.values(*CONTENT_FIELDS)}
+    symbol_index = defaultdict(set)
+    for row in features.values():
+        if row['symbol']:
+            symbol_index[row['symbol']].add(row['id'])
+    return features, symbol_index
+
+
+def _decode_counts(counts):
+    return {int(other_id): count for other_id, count in counts.items()}
+
+
+def _encode_counts(counts):
+    return {str(other_id): count for other_id, count in counts.items() if count}
+
+
+def build_recommendations(batch_size=500):
+    """Recompute every AnalysisNeighbors row from the full purchase history"""
+    co_counts = defaultdict(Counter)
+    buyer_counts = Counter()
+
+    def count_library(library):
+        library = library[-MAX_LIBRARY_SIZE:]
+        for index, a in enumerate(library):
+            for b in library[index + 1:]:
+                co_counts[a][b] += 1
+                co_counts[b][a] += 1
+
+    current_user, library = None, []
+    purchases = PurchasedAnalysis.objects.order_by('user_id', 'purchased_at').values_list('user_id', 'analysis_id')
+    for user_id, analysis_id in purchases.iterator(chunk_size=5000):
+        if user_id != current_user:
+            count_library(library)
+            current_user, library = user_id, []
+        library.append(analysis_id)
+        buyer_counts[analysis_id] += 1
+    count_library(library)
+
+    features, symbol_index = _load_features(CryptoAnalysis.objects.all())
+    rows = [
+        AnalysisNeighbors(
+            analysis_id=analysis_id,
+            neighbor_ids=_rank(analysis_id, co_counts[analysis_id], buyer_counts, features, symbol_index),
+            co_purchase_counts=_encode_counts(co_counts[analysis_id]),
+            buyer_count=buyer_counts[analysis_id],
+        )
+        for analysis_id in features
+    ]
+    for start in range(0, len(rows), batch_size):
+        AnalysisNeighbors.objects.bulk_create(
+            rows[start:start + batch_size],
+            update_conflicts=True,
+            unique_fields=['analysis'],
+            update_fields=['neighbor_ids', 'co_purchase_counts', 'buyer_count', 'updated_at'],
+        )
+    cache.delete_many([neighbors_cache_key(analysis_id) for analysis_id in features])
+    return len(rows)
+
+
+def record_purchase(user_id, analysis_id):
+    """Fold one new purchase into the stored counts and re-rank the touched rows"""
+    library = list(
+        PurchasedAnalysis.objects.filter(user_id=user_id)
+        .exclude(analysis_id=analysis_id)
+        .values_list('analysis_id', flat=True)
+    )
+    touched = [analysis_id, *library]
+
+    with db_transaction.atomic():
+        missing = set(touched) - set(AnalysisNeighbors.objects.filter(pk__in=touched).values_list('pk', flat=True))
+        if missing:
+            # Rows not built yet start from their current buyer count, this purchase included
+            buyers = dict(
+                PurchasedAnalysis.objects.filter(analysis_id__in=missing)
+                .values_list('analysis_id').annotate(count=Count('pk')).order_by()
+            )
+            AnalysisNeighbors.objects.bulk_create(
+                [AnalysisNeighbors(analysis_id=pk, buyer_count=buyers.get(pk, 0)) for pk in missing],
+                ignore_conflicts=True,
+            )
+        rows = AnalysisNeighbors.objects.select_for_update().in_bulk(touched)
+
+        counts = {pk: _decode_counts(row.co_purchase_counts) for pk, row in rows.items()}
+        if analysis_id not in missing:
+            rows[analysis_id].buyer_count += 1
+        for other_id in library:
+            counts[analysis_id][other_id] = counts[analysis_id].get(other_id, 0) + 1
+            counts[other_id][analysis_id] = counts[other_id].get(analysis_id, 0) + 1
+
+        related = set(touched)
+        for row_counts in counts.values():
+            related.update(row_counts)
+        symbols = CryptoAnalysis.objects.filter(pk__in=touched).exclude(symbol='').values('symbol')
+        features, symbol_index = _load_features(
+            CryptoAnalysis.objects.filter(Q(pk__in=related) | Q(symbol__in=symbols))
+        )
+        buyer_counts = dict(
+            AnalysisNeighbors.objects.filter(pk__in=features).values_list('pk', 'buyer_count')
+        )
+        buyer_counts.update({pk: row.buyer_count for pk, row in rows.items()})
+
+        now = timezone.now()
+        for pk, row in rows.items():
+            row.co_purchase_counts = _encode_counts(counts[pk])
+            row.neighbor_ids = _rank(pk, counts[pk], buyer_counts, features, symbol_index)
+            row.updated_at = now
+        AnalysisNeighbors.objects.bulk_update(
+            rows.values(), ['co_purchase_counts', 'neighbor_ids', 'buyer_count', 'updated_at']
+        )
+    cache.delete_many([neighbors_cache_key(pk) for pk in rows])
+
+
+def _record_purchase_safely(user_id, analysis_id):
+    # Recommendations are best effort; the nightly rebuild repairs any miss
+    try:
+        record_purchase(user_id, analysis_id)
+    except Exception:
+        logger.exception("Failed to update recommendations for analysis %s", analysis_id)
+
+
+def _purchase_saved(sender, instance, created, **kwargs):
+    if created:
+        user_id, analysis_id = instance.user_id, instance.analysis_id
+        db_transaction.on_commit(lambda: _record_purchase_safely(user_id, analysis_id))
+
+
+post_save.connect(_purchase_saved, sender=PurchasedAnalysis, dispatch_uid='recommendations_purchase_saved')
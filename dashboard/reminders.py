@@ -0,0 +1,265 @@
+"""
+Delivery of consultation reminders.
+
+Booking a consultation creates ConsultationReminder rows (see
+``create_consultation_reminders``); ReminderDispatcher sends them once their
+``scheduled_time`` passes.  Due reminders are claimed in batches with
+``SELECT ... FOR UPDATE SKIP LOCKED`` where the database supports it, so
+several dispatchers can run side by side without sending a reminder twice,
+and are read through the ``(is_sent, scheduled_time)`` index.  Each batch
+is handed to the backend configured for its type in ``REMINDER_BACKENDS``
+and marked sent with one ``bulk_update``.  A reminder whose backend fails is
+retried with exponential backoff up to MAX_ATTEMPTS times.
+
+Delivery is at least once: a batch is sent before its transaction commits,
+so a crash in between sends it again on the next run.
+
+Between batches the dispatcher keeps the upcoming due times in a min-heap
+and sleeps until the earliest one, waking at least every ``max_sleep``
+seconds to pick up reminders booked in the meantime.
+"""
+import heapq
+import json
+import logging
+import sys
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import mail
+from django.db import connection, transaction as db_transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Consultation, ConsultationReminder
+
+logger = logging.getLogger(__name__)
+
+REMINDER_BATCH_SIZE = 500
+
+MAX_ATTEMPTS = 5
+
+# Delay before the first retry, doubled for each later one
+RETRY_DELAY = timedelta(minutes=1)
+
+# Longest the dispatcher sleeps before checking for newly booked reminders
+MAX_SLEEP = 60
+
+
+def pending_reminders(now=None):
+    """Unsent reminders for consultations that are still ahead and scheduled"""
+    now = now or timezone.now()
+    return ConsultationReminder.objects.filter(
+        is_sent=False,
+        attempts__lt=MAX_ATTEMPTS,
+        consultation__status='scheduled',
+        consultation__scheduled_date__gt=now,
+    )
+
+
+def reminder_message(reminder):
+    """``(subject, body)`` for a reminder"""
+    consultation = reminder.consultation
+    when = timezone.localtime(consultation.scheduled_date).strftime('%d %b %Y %H:%M %Z')
+    subject = f"Reminder: {consultation.title} starts {when}"
+    lines = [
+        f"Hi {consultation.user.get_full_name() or consultation.user.username},",
+        "",
+        f"Your {consultation.duration_minutes} minute consultation \"{consultation.title}\" starts {when}.",
+    ]
+    if consultation.join_url or consultation.meeting_link:
+        lines.append(f"Join: {consultation.join_url or consultation.meeting_link}")
+    if consultation.meeting_password:
+        lines.append(f"Password: {consultation.meeting_password}")
+    return subject, '\n'.join(lines)
+
+
+def _recipient(reminder):
+    user = reminder.consultation.user
+    return user.email if reminder.reminder_type == 'email' else user.username
+
+
+# Backends
+
+class BaseReminderBackend:
+    """
+    Sends reminders of one type.  ``send_messages`` takes a list of
+    reminders and returns ``{reminder.pk: error}`` for those it could not
+    deliver; the rest count as sent.
+    """
+
+    def send_messages(self, reminders):
+        raise NotImplementedError
+
+
+class ConsoleBackend(BaseReminderBackend):
+    """Writes reminders to stdout (or ``stream``), for development"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def send_messages(self, reminders):
+        for reminder in reminders:
+            subject, body = reminder_message(reminder)
+            self.stream.write(
+                f"[{reminder.reminder_type}] to {_recipient(reminder)}: {subject}\n{body}\n{'-' * 79}\n"
+            )
+        self.stream.flush()
+        return {}
+
+
+class FileBackend(BaseReminderBackend):
+    """Appends reminders as JSON lines to ``path`` (REMINDER_FILE_PATH by default)"""
+
+    def __init__(self, path=None):
+        self.path = path or settings.REMINDER_FILE_PATH
+
+    def send_messages(self, reminders):
+        with open(self.path, 'a', encoding='utf-8') as handle:
+            for reminder in reminders:
+                subject, body = reminder_message(reminder)
+                handle.write(json.dumps({
+                    'id': reminder.pk,
+                    'type': reminder.reminder_type,
+                    'to': _recipient(reminder),
+                    'subject': subject,
+                    'body': body,
+                    'sent_at': timezone.now().isoformat(),
+                }) + '\n')
+        return {}
+
+
+class EmailBackend(BaseReminderBackend):
+    """Sends reminders through Django's EMAIL_BACKEND over one connection per batch"""
+
+    def send_messages(self, reminders):
+        failed = {}
+        messages = []
+        for reminder in reminders:
+            if not reminder.consultation.user.email:
+                failed[reminder.pk] = "user has no email address"
+                continue
+            subject, body = reminder_message(reminder)
+            messages.append(mail.EmailMessage(subject, body, to=[reminder.consultation.user.email]))
+        try:
+            mail.get_connection().send_messages(messages)
+        except Exception as exc:
+            logger.exception("Sending %s reminder emails failed", len(messages))
+            failed.update({reminder.pk: str(exc) for reminder in reminders if reminder.pk not in failed})
+        return failed
+
+
+def load_backends():
+    return {
+        reminder_type: import_string(path)()
+        for reminder_type, path in getattr(settings, 'REMINDER_BACKENDS', {}).items()
+    }
+
+
+# Dispatch
+
+def _lock_options():
+    features = connection.features
+    options = {}
+    if features.has_select_for_update_skip_locked:
+        options['skip_locked'] = True
+    if features.has_select_for_update_of:
+        # Lock the reminders only, not the joined consultations and users
+        options['of'] = ('self',)
+    return options
+
+
+class ReminderDispatcher:
+    def __init__(self, backends=None, batch_size=REMINDER_BATCH_SIZE, max_sleep=MAX_SLEEP):
+        self.backends = load_backends() if backends is None else backends
+        self.batch_size = batch_size
+        self.max_sleep = max_sleep
+        # (scheduled_time, reminder id) of upcoming reminders, earliest first
+        self.heap = []
+        self.queued = set()
+
+    def send_batch(self, now):
+        """Claim, send and mark one batch of due reminders; returns ``(sent, failed)``"""
+        with db_transaction.atomic():
+            reminders = list(
+                pending_reminders(now).filter(scheduled_time__lte=now)
+                .select_related('consultation__user')
+                .select_for_update(**_lock_options())
+                .order_by('scheduled_time')[:self.batch_size]
+            )
+            if not reminders:
+                return 0, 0
+
+            by_type = {}
+            for reminder in reminders:
+                by_type.setdefault(reminder.reminder_type, []).append(reminder)
+            failed = {}
+            for reminder_type, batch in by_type.items():
+                backend = self.backends.get(reminder_type)
+                if backend is None:
+                    failed.update({reminder.pk: f"no backend for {reminder_type!r}" for reminder in batch})
+                    continue
+                try:
+                    failed.update(backend.send_messages(batch))
+                except Exception as exc:
+                    logger.exception("Reminder backend for %r failed", reminder_type)
+                    failed.update({reminder.pk: str(exc) for reminder in batch})
+
+            sent_at = timezone.now()
+            for reminder in reminders:
+                if reminder.pk in failed:
+                    reminder.attempts += 1
+                    reminder.last_error = failed[reminder.pk][:255]
+                    reminder.scheduled_time = now + RETRY_DELAY * 2 ** (reminder.attempts - 1)
+                else:
+                    reminder.is_sent = True
+                    reminder.sent_time = sent_at
+            ConsultationReminder.objects.bulk_update(
+                reminders, ['is_sent', 'sent_time', 'attempts', 'last_error', 'scheduled_time'],
+            )
+            Consultation.objects.filter(
+                pk__in={reminder.consultation_id for reminder in reminders if reminder.is_sent},
+            ).update(reminder_sent=True)
+        return len(reminders) - len(failed), len(failed)
+
+    def dispatch_due(self, now=None):
+        """Send every reminder due at ``now``; returns ``(sent, failed)``"""
+        now = now or timezone.now()
+        started = time.monotonic()
+        sent = failed = 0
+        while True:
+            batch_sent, batch_failed = self.send_batch(now)
+            sent, failed = sent + batch_sent, failed + batch_failed
+            if batch_sent + batch_failed < self.batch_size:
+                break
+        while self.heap and self.heap[0][0] <= now:
+            self.queued.discard(heapq.heappop(self.heap)[1])
+        if sent or failed:
+            elapsed = time.monotonic() - started
+            logger.info("Sent %s reminders (%s failed) in %.2fs", sent, failed, elapsed)
+        return sent, failed
+
+    def refresh(self, now=None):
+        """Queue the due times of the next reminders into the heap"""
+        now = now or timezone.now()
+        upcoming = (
+            pending_reminders(now).filter(scheduled_time__gt=now)
+            .order_by('scheduled_time').values_list('scheduled_time', 'pk')[:self.batch_size]
+        )
+        for scheduled_time, pk in upcoming:
+            if pk not in self.queued:
+                self.queued.add(pk)
+                heapq.heappush(self.heap, (scheduled_time, pk))
+
+    def seconds_until_next(self, now=None):
+        now = now or timezone.now()
+        if not self.heap:
+            return self.max_sleep
+        return min(max((self.heap[0][0] - now).total_seconds(), 0), self.max_sleep)
+
+    def run(self, should_stop=lambda: False, sleep=time.sleep):
+        while not should_stop():
+            now = timezone.now()
+            self.dispatch_due(now)
+            self.refresh(now)
+            sleep(self.seconds_until_next())
@@ -0,0 +1,391 @@
+"""
+PDF reports of analyses for download_analysis.
+
+``render_report`` lays an analysis out on A4 pages (summary, chart image,
+content, metrics, insights and chart annotations) and yields the PDF as it
+goes: each page is written out as soon as it is full, and the page tree,
+cross-reference table and trailer, which only need byte offsets and object
+numbers, come last.  Text uses the standard Helvetica fonts, which viewers
+provide, so no font is embedded; the chart is embedded as a JPEG
+(preferring its resized derivative, see dashboard.images).
+
+Rendered reports are cached under REPORT_CACHE_DIR, keyed by the analysis
+id and ``updated_at``.  ``stream_report`` copies the bytes into the cache
+while they are sent, so the next download of the same version is a plain
+file response (``cached_report``).  Saving or deleting a metric, insight or
+annotation touches its analysis' ``updated_at``, so those changes give a new
+version too.  ``prerender_reports`` fills the cache in a process pool.
+"""
+import io
+import os
+import tempfile
+import zlib
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+from PIL import Image
+
+from .images import derivative_name
+from .models import AnalysisInsight, AnalysisMetric, ChartAnnotation, CryptoAnalysis
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842
+MARGIN = 50
+CONTENT_WIDTH = PAGE_WIDTH - 2 * MARGIN
+
+# Widest chart derivative embedded
+CHART_WIDTH = 960
+
+# Advance widths (1/1000 em) of the printable ASCII characters, from the Helvetica AFM files
+_HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+_HELVETICA_BOLD_WIDTHS = [
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+    975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+    333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+    611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584,
+]
+FONTS = {
+    'F1': ('Helvetica', _HELVETICA_WIDTHS),
+    'F2': ('Helvetica-Bold', _HELVETICA_BOLD_WIDTHS),
+}
+
+
+def text_width(text, font, size):
+    widths = FONTS[font][1]
+    return sum(widths[ord(char) - 32] if 32 <= ord(char) < 127 else 556 for char in text) * size / 1000
+
+
+def wrap(text, font, size, width):
+    """Break ``text`` into lines no wider than ``width`` points"""
+    lines = []
+    for paragraph in str(text).splitlines() or ['']:
+        line = ''
+        for word in paragraph.split():
+            candidate = f'{line} {word}' if line else word
+            if line and text_width(candidate, font, size) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return lines
+
+
+def _pdf_string(text):
+    data = str(text).encode('cp1252', errors='replace')
+    return b'(' + data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+
+class PDFWriter:
+    """Numbers objects and tracks their byte offsets for the cross-reference table"""
+
+    def __init__(self):
+        self.position = 0
+        self.offsets = {}
+        self.last_number = 0
+
+    def reserve(self):
+        self.last_number += 1
+        return self.last_number
+
+    def _emit(self, data):
+        self.position += len(data)
+        return data
+
+    def header(self):
+        return self._emit(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def object(self, number, body, stream=None):
+        self.offsets[number] = self.position
+        data = f'{number} 0 obj\n'.encode() + body
+        if stream is not None:
+            data += b'\nstream\n' + stream + b'\nendstream'
+        return self._emit(data + b'\nendobj\n')
+
+    def trailer(self, root, info):
+        xref_at = self.position
+        lines = [f'xref\n0 {self.last_number + 1}\n', '0000000000 65535 f \n']
+        lines += [f'{self.offsets[number]:010d} 00000 n \n' for number in range(1, self.last_number + 1)]
+        lines.append(
+            f'trailer\n<< /Size {self.last_number + 1} /Root {root} 0 R /Info {info} 0 R >>\n'
+            f'startxref\n{xref_at}\n%%EOF\n'
+        )
+        return self._emit(''.join(lines).encode())
+
+
+class PageLayout:
+    """Flows text and images down A4 pages; full pages wait in ``finished`` to be written"""
+
+    def __init__(self, footer):
+        self.footer = footer
+        self.finished = []
+        self.page_number = 0
+        self._new_page()
+
+    def _new_page(self):
+        self.page_number += 1
+        self.ops = []
+        self.images = {}
+        self.y = PAGE_HEIGHT - MARGIN
+
+    def _finish_page(self):
+        footer = f'{self.footer}  |  Page {self.page_number}'
+        self.ops.append(b'0.5 g BT /F1 8 Tf %d 30 Td %s Tj ET 0 g' % (MARGIN, _pdf_string(footer)))
+        self.finished.append((b'\n'.join(self.ops), self.images))
+
+    def ensure(self, height):
+        if self.y - height < MARGIN:
+            self._finish_page()
+            self._new_page()
+
+    def space(self, height):
+        self.y -= height
+
+    def text(self, text, font='F1', size=10, leading=None, indent=0, gray=0):
+        leading = leading or size * 1.4
+        for line in wrap(text, font, size, CONTENT_WIDTH - indent):
+            self.ensure(leading)
+            self.y -= leading
+            if line:
+                self.ops.append(b'%.2f g BT /%s %d Tf %.2f %.2f Td %s Tj ET 0 g' % (
+                    gray, font.encode(), size, MARGIN + indent, self.y, _pdf_string(line),
+                ))
+
+    def heading(self, text):
+        self.ensure(40)
+        self.space(10)
+        self.text(text, 'F2', 13)
+        self.ops.append(b'0.8 G 0.5 w %d %.2f m %d %.2f l S 0 G' % (MARGIN, self.y - 4, PAGE_WIDTH - MARGIN, self.y - 4))
+        self.space(8)
+
+    def image(self, name, number, width, height):
+        scale = min(CONTENT_WIDTH / width, (PAGE_HEIGHT - 2 * MARGIN) / 2 / height, 1)
+        shown_width, shown_height = width * scale, height * scale
+        self.ensure(shown_height + 10)
+        self.y -= shown_height
+        self.images[name] = number
+        self.ops.append(b'q %.2f 0 0 %.2f %.2f %.2f cm /%s Do Q' % (
+            shown_width, shown_height, MARGIN, self.y, name.encode(),
+        ))
+        self.space(10)
+
+    def close(self):
+        self._finish_page()
+
+
+def _chart_jpeg(analysis):
+    """``(jpeg bytes, width, height, colour space)`` of the analysis chart, or None"""
+    fieldfile = analysis.chart_image
+    if not fieldfile:
+        return None
+    name = fieldfile.name
+    variants = analysis.chart_image_variants or {}
+    if variants.get('source') == name and variants.get('fallback') == 'jpg' and variants.get('widths'):
+        fitting = [width for width in variants['widths'] if width <= CHART_WIDTH] or variants['widths'][:1]
+        name = derivative_name(name, fitting[-1], 'jpg')
+    try:
+        with fieldfile.storage.open(name, 'rb') as handle:
+            data = handle.read()
+        with Image.open(io.BytesIO(data)) as image:
+            if image.format != 'JPEG' or image.mode not in ('RGB', 'L'):
+                converted = image.convert('RGB')
+                converted.thumbnail((CHART_WIDTH, CHART_WIDTH * 4))
+                buffer = io.BytesIO()
+                converted.save(buffer, 'JPEG', quality=85)
+                data = buffer.getvalue()
+                image = converted
+            return data, image.width, image.height, 'DeviceGray' if image.mode == 'L' else 'DeviceRGB'
+    except (OSError, Image.DecompressionBombError):
+        return None
+
+
+def _sections(analysis):
+    """Report content, as ``(PageLayout method, keyword arguments)`` pairs"""
+    muted = {'size': 10, 'gray': 0.35}
+    yield 'text', {'text': analysis.title, 'font': 'F2', 'size': 20, 'leading': 26}
+    yield 'text', {'text': (
+        f"{analysis.cryptocurrency} ({analysis.symbol})  |  {analysis.get_analysis_type_display()}  |  "
+        f"{analysis.get_timeframe_display()}"
+    ), **muted}
+    yield 'text', {'text': (
+        f"Recommendation: {analysis.get_recommendation_display()}  |  {analysis.get_risk_level_display()}  |  "
+        f"Score {analysis.overall_score}/10  |  Growth potential {analysis.growth_potential}"
+    ), **muted}
+    yield 'text', {
+        'text': f"By {analysis.analyst}  |  Updated {timezone.localtime(analysis.updated_at):%d %b %Y}",
+        'size': 9, 'gray': 0.5,
+    }
+    yield 'space', {'height': 10}
+
+    chart = _chart_jpeg(analysis)
+    if chart:
+        yield 'chart', {'chart': chart}
+    for title, body in (('Executive Summary', analysis.executive_summary), ('Overview', analysis.description),
+                        ('Analysis', analysis.full_content)):
+        if body:
+            yield 'heading', {'text': title}
+            yield 'text', {'text': body}
+
+    detail = {'size': 9, 'indent': 12, 'gray': 0.3}
+    metrics = list(analysis.metrics.all())
+    if metrics:
+        yield 'heading', {'text': 'Key Metrics'}
+        for metric in metrics:
+            unit = f" {metric.unit}" if metric.unit else ''
+            yield 'text', {'text': f"{metric.name}: {metric.current_value}{unit}", 'font': 'F2'}
+            yield 'text', {'text': (
+                f"Previous {metric.previous_value}{unit}, change {metric.change} ({metric.get_trend_display()})"
+                + (f". {metric.description}" if metric.description else '')
+            ), **detail}
+
+    insights = list(analysis.insights.order_by('created_at'))
+    if insights:
+        yield 'heading', {'text': 'Insights'}
+        for insight in insights:
+            yield 'text', {'text': insight.title, 'font': 'F2'}
+            yield 'text', {
+                'text': f"{insight.get_importance_display()} importance, {insight.get_category_display()}",
+                'size': 8, 'indent': 12, 'gray': 0.45,
+            }
+            yield 'text', {'text': insight.description, 'indent': 12}
+            yield 'space', {'height': 4}
+
+    annotations = list(analysis.chart_annotations.order_by('price_level', 'created_at'))
+    if annotations:
+        yield 'heading', {'text': 'Chart Levels'}
+        for annotation in annotations:
+            level = f" at {annotation.price_level.normalize():f}" if annotation.price_level is not None else ''
+            yield 'text', {'text': f"{annotation.get_type_display()}{level}", 'font': 'F2'}
+            if annotation.description:
+                yield 'text', {'text': annotation.description, **detail}
+
+    if analysis.risk_management_note:
+        yield 'heading', {'text': 'Risk Management'}
+        yield 'text', {'text': analysis.risk_management_note}
+
+
+def render_report(analysis):
+    """Yield the PDF report of ``analysis`` in pieces, a page at a time"""
+    pdf = PDFWriter()
+    pages_number = pdf.reserve()
+    font_numbers = {font: pdf.reserve() for font in FONTS}
+    page_numbers = []
+    yield pdf.header()
+    for font, (base_font, _) in FONTS.items():
+        yield pdf.object(font_numbers[font], (
+            f'<< /Type /Font /Subtype /Type1 /BaseFont /{base_font} /Encoding /WinAnsiEncoding >>'
+        ).encode())
+    fonts = ' '.join(f'/{font} {number} 0 R' for font, number in font_numbers.items())
+
+    def write_pages(layout):
+        for content, images in layout.finished:
+            content_number, page_number = pdf.reserve(), pdf.reserve()
+            compressed = zlib.compress(content)
+            yield pdf.object(content_number, f'<< /Length {len(compressed)} /Filter /FlateDecode >>'.encode(), compressed)
+            xobjects = ' '.join(f'/{name} {number} 0 R' for name, number in images.items())
+            xobjects = f' /XObject << {xobjects} >>' if xobjects else ''
+            yield pdf.object(page_number, (
+                f'<< /Type /Page /Parent {pages_number} 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] '
+                f'/Resources << /Font << {fonts} >>{xobjects} >> /Contents {content_number} 0 R >>'
+            ).encode())
+            page_numbers.append(page_number)
+        layout.finished.clear()
+
+    layout = PageLayout(f'{analysis.title} - {analysis.symbol}')
+    for method, arguments in _sections(analysis):
+        if method == 'chart':
+            data, width, height, colour_space = arguments['chart']
+            image_number = pdf.reserve()
+            yield pdf.object(image_number, (
+                f'<< /Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace /{colour_space} '
+                f'/BitsPerComponent 8 /Filter /DCTDecode /Length {len(data)} >>'
+            ).encode(), data)
+            layout.image('Im1', image_number, width, height)
+        else:
+            getattr(layout, method)(**arguments)
+        yield from write_pages(layout)
+    layout.close()
+    yield from write_pages(layout)
+
+    kids = ' '.join(f'{number} 0 R' for number in page_numbers)
+    yield pdf.object(pages_number, f'<< /Type /Pages /Kids [{kids}] /Count {len(page_numbers)} >>'.encode())
+    catalog, info = pdf.reserve(), pdf.reserve()
+    yield pdf.object(catalog, f'<< /Type /Catalog /Pages {pages_number} 0 R >>'.encode())
+    yield pdf.object(info, b'<< /Title ' + _pdf_string(analysis.title) + b' /Producer (Insight) >>')
+    yield pdf.trailer(catalog, info)
+
+
+# Cache
+
+def report_filename(analysis):
+    return f'{analysis.symbol or "analysis"}_{analysis.pk}.pdf'.replace('/', '_')
+
+
+def _cache_dir():
+    return os.fspath(settings.REPORT_CACHE_DIR)
+
+
+def report_cache_path(analysis_id, updated_at):
+    return os.path.join(_cache_dir(), f'analysis_{analysis_id}_{int(updated_at.timestamp() * 1_000_000)}.pdf')
+
+
+def cached_report(analysis):
+    """Path of the cached report of this version of ``analysis``, or None"""
+    path = report_cache_path(analysis.pk, analysis.updated_at)
+    return path if os.path.exists(path) else None
+
+
+def _drop_other_versions(analysis_id, keep):
+    prefix = f'analysis_{analysis_id}_'
+    for name in os.listdir(_cache_dir()):
+        if name.startswith(prefix) and name.endswith('.pdf') and os.path.join(_cache_dir(), name) != keep:
+            try:
+                os.remove(os.path.join(_cache_dir(), name))
+            except FileNotFoundError:
+                pass
+
+
+def stream_report(analysis):
+    """Yield the report while writing it to the cache, which it joins once complete"""
+    path = report_cache_path(analysis.pk, analysis.updated_at)
+    os.makedirs(_cache_dir(), exist_ok=True)
+    handle, partial = tempfile.mkstemp(dir=_cache_dir(), suffix='.part')
+    try:
+        with os.fdopen(handle, 'wb') as cache_file:
+            for chunk in render_report(analysis):
+                cache_file.write(chunk)
+                yield chunk
+        os.replace(partial, path)
+        _drop_other_versions(analysis.pk, keep=path)
+    finally:
+        # The client went away, or rendering failed
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def render_to_cache(analysis_id):
+    """Render a report into the cache unless it is there already; returns the bytes written"""
+    analysis = CryptoAnalysis.objects.select_related('analyst__user').filter(pk=analysis_id).first()
+    if analysis is None or cached_report(analysis):
+        return 0
+    return sum(len(chunk) for chunk in stream_report(analysis))
+
+
+# Child rows are part of the report, so changing them makes a new version
+
+def _touch_analysis(sender, instance, **kwargs):
+    CryptoAnalysis.objects.filter(pk=instance.analysis_id).update(updated_at=timezone.now())
+
+
+for _model in (AnalysisMetric, AnalysisInsight, ChartAnnotation):
+    post_save.connect(_touch_analysis, sender=_model, dispatch_uid=f'report_touch_save_{_model.__name__}')
+    post_delete.connect(_touch_analysis, sender=_model, dispatch_uid=f'report_touch_delete_{_model.__name__}')
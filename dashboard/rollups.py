@@ -0,0 +1,187 @@
+"""
+Daily revenue and activity rollups.
+
+DailyRollup keeps the count and amount of completed transactions per day,
+transaction type, payment method, analysis and analyst.  A transaction is
+counted when it is saved as ``completed`` and retracted if it later leaves
+that state or is deleted; the bucket is bumped with an F() UPDATE in the
+same database transaction as the ledger write.  Purchases also maintain
+``CryptoAnalysis.total_revenue`` here, so views no longer add to it.
+
+Two first writes to the same new bucket can race and create two rows for
+it; every reader sums over rows, so this only costs a little space until
+``backfill_rollups`` rewrites the range.
+"""
+import datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.db.models import Count, DecimalField, F, Max, Min, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.db.models.signals import post_delete, post_init, post_save
+from django.utils import timezone
+
+from .models import CryptoAnalysis, DailyRollup, Transaction
+
+# Transaction fields that decide which bucket a transaction lands in
+STATE_FIELDS = ('status', 'amount', 'transaction_type', 'payment_method', 'analysis_id', 'created_at')
+
+# Dimensions the admin report can group by
+GROUPINGS = {
+    'date': ('date',),
+    'transaction_type': ('transaction_type',),
+    'payment_method': ('payment_method',),
+    'analysis': ('analysis_id', 'analysis__title'),
+    'analyst': ('analyst_id', 'analyst__user__username'),
+}
+
+MONEY_FIELD = DecimalField(max_digits=15, decimal_places=2)
+
+# Attribute holding the STATE_FIELDS values an instance was loaded with
+_LOADED_ATTR = '_rollup_loaded_state'
+
+
+def _state(instance):
+    values = instance.__dict__
+    if values.get('status') != 'completed':
+        return None
+    if any(values.get(field) is None for field in STATE_FIELDS if field != 'analysis_id'):
+        return None
+    return tuple(values.get(field) for field in STATE_FIELDS)
+
+
+def _bucket_date(created_at):
+    return timezone.localdate(created_at) if timezone.is_aware(created_at) else created_at.date()
+
+
+def apply_transaction(state, sign):
+    """Add (``sign=1``) or retract (``sign=-1``) one completed transaction"""
+    _, amount, transaction_type, payment_method, analysis_id, created_at = state
+    analyst_id = None
+    if analysis_id is not None:
+        analyst_id = CryptoAnalysis.objects.filter(pk=analysis_id).values_list('analyst_id', flat=True).first()
+    bucket = {
+        'date': _bucket_date(created_at),
+        'transaction_type': transaction_type,
+        'payment_method': payment_method,
+        'analysis_id': analysis_id,
+        'analyst_id': analyst_id,
+    }
+    with db_transaction.atomic():
+        pk = DailyRollup.objects.filter(**bucket).select_for_update().values_list('pk', flat=True).first()
+        if pk is None:
+            DailyRollup.objects.create(count=sign, amount=sign * amount, **bucket)
+        else:
+            DailyRollup.objects.filter(pk=pk).update(
+                count=F('count') + sign, amount=F('amount') + sign * amount, updated_at=timezone.now(),
+            )
+        if transaction_type == 'purchase' and analysis_id is not None:
+            CryptoAnalysis.objects.filter(pk=analysis_id).update(total_revenue=F('total_revenue') + sign * amount)
+
+
+def _remember_loaded_state(sender, instance, **kwargs):
+    setattr(instance, _LOADED_ATTR, _state(instance) if instance.pk else None)
+
+
+def _transaction_saved(sender, instance, created, **kwargs):
+    previous = None if created else getattr(instance, _LOADED_ATTR, None)
+    current = _state(instance)
+    if previous != current:
+        if previous is not None:
+            apply_transaction(previous, -1)
+        if current is not None:
+            apply_transaction(current, 1)
+    setattr(instance, _LOADED_ATTR, current)
+
+
+def _transaction_deleted(sender, instance, **kwargs):
+    previous = getattr(instance, _LOADED_ATTR, None)
+    if previous is not None:
+        apply_transaction(previous, -1)
+
+
+post_init.connect(_remember_loaded_state, sender=Transaction, dispatch_uid='rollups_loaded')
+post_save.connect(_transaction_saved, sender=Transaction, dispatch_uid='rollups_saved')
+post_delete.connect(_transaction_deleted, sender=Transaction, dispatch_uid='rollups_deleted')
+
+
+# Backfill
+
+def _day_start(day):
+    start = datetime.datetime.combine(day, datetime.time.min)
+    return timezone.make_aware(start) if settings.USE_TZ else start
+
+
+def backfill_rollups(start=None, end=None, chunk_days=31, batch_size=1000):
+    """
+    Rebuild the rollups for ``start``..``end`` (inclusive dates, defaulting to
+    the whole Transaction history) one chunk of days at a time; returns
+    ``(days, rows)`` written.  A full rebuild also resets total_revenue.
+    """
+    completed = Transaction.objects.filter(status='completed')
+    full = start is None and end is None
+    if start is None or end is None:
+        bounds = completed.order_by().aggregate(first=Min('created_at'), last=Max('created_at'))
+        if bounds['first'] is None:
+            return 0, 0
+        start = start or _bucket_date(bounds['first'])
+        end = end or _bucket_date(bounds['last'])
+
+    days = rows = 0
+    chunk_start = start
+    while chunk_start <= end:
+        chunk_end = min(chunk_start + datetime.timedelta(days=chunk_days - 1), end)
+        grouped = (
+            completed.filter(created_at__gte=_day_start(chunk_start),
+                             created_at__lt=_day_start(chunk_end + datetime.timedelta(days=1)))
+            .annotate(day=TruncDate('created_at'))
+            .values('day', 'transaction_type', 'payment_method', 'analysis_id', 'analysis__analyst_id')
+            .annotate(count=Count('pk'), total=Sum('amount'))
+            .order_by()
+        )
+        chunk = [
+            DailyRollup(
+                date=row['day'], transaction_type=row['transaction_type'], payment_method=row['payment_method'],
+                analysis_id=row['analysis_id'], analyst_id=row['analysis__analyst_id'],
+                count=row['count'], amount=row['total'] or Decimal('0.00'),
+            )
+            for row in grouped
+        ]
+        with db_transaction.atomic():
+            DailyRollup.objects.filter(date__range=(chunk_start, chunk_end)).delete()
+            DailyRollup.objects.bulk_create(chunk, batch_size=batch_size)
+        days += (chunk_end - chunk_start).days + 1
+        rows += len(chunk)
+        chunk_start = chunk_end + datetime.timedelta(days=1)
+
+    if full:
+        revenue = (
+            DailyRollup.objects.filter(analysis=OuterRef('pk'), transaction_type='purchase')
+            .order_by().values('analysis').annotate(total=Sum('amount')).values('total')
+        )
+        CryptoAnalysis.objects.update(
+            total_revenue=Coalesce(Subquery(revenue, output_field=MONEY_FIELD), Value(Decimal('0.00')),
+                                   output_field=MONEY_FIELD),
+        )
+    return days, rows
+
+
+# Reporting
+
+def report(start, end, group='date', transaction_types=None, payment_methods=None, analyst_id=None):
+    """Summed count and amount per ``group`` for the inclusive date range"""
+    fields = GROUPINGS.get(group) or GROUPINGS['date']
+    rollups = DailyRollup.objects.filter(date__range=(start, end))
+    if transaction_types:
+        rollups = rollups.filter(transaction_type__in=transaction_types)
+    if payment_methods:
+        rollups = rollups.filter(payment_method__in=payment_methods)
+    if analyst_id:
+        rollups = rollups.filter(analyst_id=analyst_id)
+    return (
+        rollups.values(*fields)
+        .annotate(count=Sum('count'), amount=Sum('amount'))
+        .filter(count__gt=0)
+        .order_by(fields[0] if group == 'date' else '-amount')
+    )
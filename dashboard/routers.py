@@ -0,0 +1,217 @@
+"""
+Read replicas for the read-heavy views.
+
+REPLICA_DATABASE_URLS adds ``replica_1``, ``replica_2``, ... to DATABASES.
+Writes and migrations always go to the primary (``default``); reads go to it
+too, except inside views decorated with ``@read_from_replica``, whose reads
+are spread over the replicas, one replica per request.
+
+A replica may lag behind the primary, so reads stay on the primary:
+
+* for the rest of a request once it has written anything;
+* inside a transaction on the primary;
+* for REPLICA_PIN_SECONDS after a request of the user wrote, through the
+  ``primary_pin`` cookie set by dashboard.middleware.PrimaryPinMiddleware;
+* for REPLICA_PIN_SECONDS after a wallet, transaction or purchase row of the
+  user was written by someone else, e.g. an M-Pesa callback (``pin_user``).
+
+``pin_user`` keeps the pin in the default cache, so it reaches the other
+workers only because that cache is shared: the file cache covers the
+workers of one host, Redis (REDIS_URL) every host.  With a process-local
+cache a pin would only hold in the worker that wrote, so the dashboard.E002
+system check refuses replicas in that case.
+
+A replica that cannot be connected to is skipped for REPLICA_RETRY_SECONDS.
+If one fails while a view is reading from it, the view is run again on the
+primary, unless it has written meanwhile.
+
+To try it locally with two SQLite files, copy the database and point a
+replica at the copy::
+
+    cp db.sqlite3 replica.sqlite3
+    REPLICA_DATABASE_URLS=sqlite:///$PWD/replica.sqlite3 python manage.py runserver
+"""
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.db.models.signals import post_delete, post_save
+
+from .models import PurchasedAnalysis, Transaction, UserWallet
+
+logger = logging.getLogger(__name__)
+
+PIN_COOKIE = 'primary_pin'
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+# Replica alias -> time.monotonic() until which it is skipped, per process
+_down_until = {}
+
+
+class RequestState:
+    """How the current request reads: whether it may use a replica, which one, and whether it wrote"""
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.replica = False
+        self.alias = None
+        self.wrote = False
+
+
+_state = ContextVar('dashboard_replica_state', default=None)
+
+
+def replica_aliases():
+    return getattr(settings, 'REPLICA_DATABASES', [])
+
+
+def _pin_key(user_id):
+    return f"dashboard:primary_pin:{user_id}"
+
+
+def pin_user(user_id):
+    """Read from the primary for ``user_id`` for the next REPLICA_PIN_SECONDS, in every worker sharing the cache"""
+    if replica_aliases():
+        cache.set(_pin_key(user_id), True, settings.REPLICA_PIN_SECONDS)
+
+
+def mark_down(alias):
+    _down_until[alias] = time.monotonic() + getattr(settings, 'REPLICA_RETRY_SECONDS', 30)
+
+
+def _connects(alias):
+    connection = connections[alias]
+    if connection.connection is not None:
+        return True
+    try:
+        connection.ensure_connection()
+    except DatabaseError as exc:
+        logger.warning("Replica %s is unavailable, reading from the primary: %s", alias, exc)
+        return False
+    return True
+
+
+def choose_replica():
+    """A replica that is up, or None"""
+    now = time.monotonic()
+    candidates = [alias for alias in replica_aliases() if _down_until.get(alias, 0) <= now]
+    random.shuffle(candidates)
+    for alias in candidates:
+        if _connects(alias):
+            return alias
+        mark_down(alias)
+    return None
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or not state.replica or state.wrote:
+            return None
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        if state.alias is None:
+            state.alias = choose_replica()
+            if state.alias is None:
+                state.replica = False
+                return None
+        return state.alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema from the primary
+        if db in replica_aliases():
+            return False
+        return None
+
+
+@contextmanager
+def request_state(pinned=False):
+    """
+    Track how the enclosed request reads and whether it writes; yields its
+    RequestState.  ``pinned`` keeps its reads on the primary.
+    """
+    state = RequestState(pinned)
+    token = _state.set(state)
+    try:
+        with connections[DEFAULT_DB_ALIAS].execute_wrapper(_record_writes):
+            yield state
+    finally:
+        _state.reset(token)
+
+
+def _record_writes(execute, sql, params, many, context):
+    if sql.lstrip()[:7].upper().startswith(WRITE_STATEMENTS):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+    return execute(sql, params, many, context)
+
+
+def read_from_replica(view):
+    """Let ``view`` read from a replica unless the user is pinned to the primary"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        state = _state.get()
+        if state is None or not replica_aliases():
+            return view(request, *args, **kwargs)
+        state.replica = not state.pinned and not (
+            request.user.is_authenticated and cache.get(_pin_key(request.user.pk))
+        )
+        try:
+            response = view(request, *args, **kwargs)
+        except DatabaseError:
+            alias = state.alias
+            if alias is None or state.wrote:
+                raise
+            logger.warning("Replica %s failed during %s, retrying on the primary", alias, request.path, exc_info=True)
+            mark_down(alias)
+            state.replica, state.alias = False, None
+            return view(request, *args, **kwargs)
+        finally:
+            # Middleware running after the view reads from the primary
+            reading, state.replica = state.replica, False
+        if response.streaming and reading:
+            response.streaming_content = _reading(response.streaming_content, state)
+        return response
+    return wrapper
+
+
+def _reading(iterator, state):
+    """Yield from ``iterator`` reading from the replica, for content streamed after the view returned"""
+    iterator = iter(iterator)
+    while True:
+        token = _state.set(state)
+        state.replica = True
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            state.replica = False
+            _state.reset(token)
+        yield chunk
+
+
+def _pin_owner(sender, instance, **kwargs):
+    pin_user(instance.user_id)
+
+
+for _model in (UserWallet, Transaction, PurchasedAnalysis):
+    post_save.connect(_pin_owner, sender=_model, dispatch_uid=f'replica_pin_save_{_model.__name__}')
+    post_delete.connect(_pin_owner, sender=_model, dispatch_uid=f'replica_pin_delete_{_model.__name__}')
@@ -0,0 +1,475 @@
+"""
+Consultation scheduling: analyst availability and conflict-free slot booking.
+
+Analysts publish their availability in ``Analyst.consultation_hours``::
+
+    {
+        "timezone": "Africa/Nairobi",
+        "weekly": {"mon": [["09:00", "17:00"]], "tue": [["09:00", "12:00"], ["14:00", "18:00"]]},
+        "dates": {"2026-12-24": [["09:00", "12:00"]], "2026-12-25": []}
+    }
+
+``weekly`` windows repeat every week and ``dates`` replace them on the days
+listed.  Times are in the analyst's timezone (TIME_ZONE when omitted).
+
+AvailabilityIndex expands the rules into the slots offered over the next
+SCHEDULE_HORIZON_DAYS, starting on a SLOT_STEP_MINUTES grid, and keeps each
+analyst's booked consultations in an IntervalIndex.  For each consultation
+length it holds every offered slot of every analyst in one sorted array, so
+the next N free slots are a bisect plus a short scan past booked ones.  The
+index lives in process memory and follows version tokens kept in the
+default cache, which every worker shares: a booking change syncs the
+consultations modified since the last sync, an availability change rebuilds
+the slots.
+
+The index is advisory.  ``claim_analyst`` (used by dashboard.bookings)
+takes a write lock on the analyst row and re-checks availability and
+overlaps against the database, so concurrent bookings cannot double-book an
+analyst.
+"""
+import datetime
+import re
+import uuid
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction as db_transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_init, post_save
+from django.utils import timezone
+
+from .models import Analyst, Consultation
+
+SLOT_STEP_MINUTES = 30
+SCHEDULE_HORIZON_DAYS = 14
+
+# Consultations in these states hold their analyst's time
+ACTIVE_STATUSES = ('scheduled', 'pending', 'in_progress')
+
+# Bookings modified this long before the last sync are fetched again, to
+# catch transactions that committed after it
+SYNC_MARGIN = datetime.timedelta(seconds=30)
+
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+_TIME_RE = re.compile(r'^([01]\d|2[0-3]):([0-5]\d)$|^24:00$')
+
+Slot = namedtuple('Slot', ['start', 'end', 'analyst_id'])
+
+# Attribute holding the availability fields an Analyst was loaded with
+_LOADED_ATTR = '_schedule_loaded_availability'
+
+
+class SlotUnavailable(ValueError):
+    pass
+
+
+# Availability rules
+
+def _parse_time(value):
+    if not isinstance(value, str) or not _TIME_RE.match(value):
+        raise ValidationError(f"Invalid time {value!r}, expected HH:MM")
+    hours, minutes = map(int, value.split(':'))
+    return hours * 60 + minutes
+
+
+def _parse_windows(windows, label):
+    if not isinstance(windows, list):
+        raise ValidationError(f"{label} must be a list of [start, end] pairs")
+    parsed = []
+    for window in windows:
+        if not isinstance(window, (list, tuple)) or len(window) != 2:
+            raise ValidationError(f"{label} must be a list of [start, end] pairs")
+        start, end = _parse_time(window[0]), _parse_time(window[1])
+        if start >= end:
+            raise ValidationError(f"{label}: {window[0]}-{window[1]} ends before it starts")
+        parsed.append((start, end))
+    return sorted(parsed)
+
+
+def parse_consultation_hours(hours):
+    """
+    Validate ``consultation_hours`` and return ``(tzinfo, weekly, dates)``
+    with windows as ``(start, end)`` minutes since midnight.
+    """
+    hours = hours or {}
+    if not isinstance(hours, dict):
+        raise ValidationError("Consultation hours must be an object")
+    unknown = set(hours) - {'timezone', 'weekly', 'dates'}
+    if unknown:
+        raise ValidationError(f"Unknown consultation hours key(s): {', '.join(sorted(unknown))}")
+    try:
+        tzinfo = ZoneInfo(hours.get('timezone') or settings.TIME_ZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValidationError(f"Unknown timezone {hours.get('timezone')!r}")
+
+    weekly_rules = hours.get('weekly') or {}
+    if not isinstance(weekly_rules, dict) or set(weekly_rules) - set(WEEKDAYS):
+        raise ValidationError(f"weekly must map days ({', '.join(WEEKDAYS)}) to windows")
+    weekly = {WEEKDAYS.index(day): _parse_windows(windows, day) for day, windows in weekly_rules.items()}
+
+    date_rules = hours.get('dates') or {}
+    if not isinstance(date_rules, dict):
+        raise ValidationError("dates must map YYYY-MM-DD to windows")
+    dates = {}
+    for day, windows in date_rules.items():
+        try:
+            dates[datetime.date.fromisoformat(day)] = _parse_windows(windows, day)
+        except ValueError:
+            raise ValidationError(f"Invalid date {day!r}, expected YYYY-MM-DD")
+    return tzinfo, weekly, dates
+
+
+def _epoch_minutes(value):
+    return int(value.timestamp()) // 60
+
+
+def _from_epoch_minutes(minutes):
+    return datetime.datetime.fromtimestamp(minutes * 60, tz=datetime.timezone.utc)
+
+
+def availability_windows(rules, first_day, days):
+    """Sorted ``(start, end)`` epoch minutes offered on ``days`` days from ``first_day``"""
+    tzinfo, weekly, dates = rules
+    windows = []
+    for offset in range(days):
+        day = first_day + datetime.timedelta(days=offset)
+        for start, end in dates.get(day, weekly.get(day.weekday(), [])):
+            midnight = datetime.datetime.combine(day, datetime.time.min, tzinfo=tzinfo)
+            windows.append((
+                _epoch_minutes(midnight + datetime.timedelta(minutes=start)),
+                _epoch_minutes(midnight + datetime.timedelta(minutes=end)),
+            ))
+    return sorted(windows)
+
+
+# Index
+
+class IntervalIndex:
+    """One analyst's booked intervals, sorted by start, with running max ends for overlap tests"""
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.max_ends = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _reindex(self, position):
+        running = self.max_ends[position - 1] if position else None
+        del self.max_ends[position:]
+        for end in self.ends[position:]:
+            running = end if running is None else max(running, end)
+            self.max_ends.append(running)
+
+    def add(self, start, end):
+        position = bisect_right(self.starts, start)
+        self.starts.insert(position, start)
+        self.ends.insert(position, end)
+        self._reindex(position)
+
+    def remove(self, start, end):
+        position = bisect_left(self.starts, start)
+        while position < len(self.starts) and self.starts[position] == start:
+            if self.ends[position] == end:
+                del self.starts[position], self.ends[position]
+                self._reindex(position)
+                return
+            position += 1
+
+    def overlaps(self, start, end):
+        position = bisect_left(self.starts, end)
+        return position > 0 and self.max_ends[position - 1] > start
+
+
+class AvailabilityIndex:
+    def __init__(self, first_day, horizon_days=SCHEDULE_HORIZON_DAYS, step=SLOT_STEP_MINUTES):
+        self.first_day = first_day
+        self.horizon_days = horizon_days
+        self.step = step
+        # analyst id -> sorted availability windows in epoch minutes
+        self.windows = {}
+        # consultation length -> sorted array of (start << 32 | analyst id)
+        self.slots = {}
+        self.bookings = {}
+        self.booked = {}
+        self.synced_at = None
+
+    @classmethod
+    def build(cls, first_day=None, **kwargs):
+        index = cls(first_day or timezone.localdate(), **kwargs)
+        analysts = Analyst.objects.filter(available_for_consultation=True).exclude(consultation_hours={})
+        for analyst_id, hours in analysts.values_list('pk', 'consultation_hours').iterator():
+            try:
+                rules = parse_consultation_hours(hours)
+            except ValidationError:
+                continue
+            windows = availability_windows(rules, index.first_day, index.horizon_days)
+            if windows:
+                index.windows[analyst_id] = windows
+        index.sync()
+        return index
+
+    def covers(self, when):
+        horizon_end = self.first_day + datetime.timedelta(days=self.horizon_days - 1)
+        return timezone.localdate(when) <= horizon_end
+
+    def slots_for(self, duration):
+        """Every offered slot of ``duration`` minutes, booked or not, as packed ints"""
+        if duration not in self.slots:
+            step = self.step
+            packed = []
+            for analyst_id, windows in self.windows.items():
+                for window_start, window_end in windows:
+                    start = -(-window_start // step) * step
+                    while start + duration <= window_end:
+                        packed.append(start << 32 | analyst_id)
+                        start += step
+            packed.sort()
+            self.slots[duration] = array('q', packed)
+        return self.slots[duration]
+
+    def sync(self):
+        """Fold in consultations modified since the last sync"""
+        if self.synced_at is None:
+            horizon_start = datetime.datetime.combine(self.first_day, datetime.time.min, tzinfo=datetime.timezone.utc)
+            consultations = Consultation.objects.filter(
+                analyst__isnull=False,
+                status__in=ACTIVE_STATUSES,
+                scheduled_date__gte=horizon_start - datetime.timedelta(days=1),
+            )
+        else:
+            consultations = Consultation.objects.filter(updated_at__gte=self.synced_at - SYNC_MARGIN)
+        synced_at = timezone.now()
+        rows = consultations.values_list('pk', 'analyst_id', 'scheduled_date', 'duration_minutes', 'status')
+        for pk, analyst_id, scheduled_date, duration, status in rows.iterator():
+            self.discard(pk)
+            if analyst_id is not None and status in ACTIVE_STATUSES:
+                start = _epoch_minutes(scheduled_date)
+                self.book(pk, analyst_id, start, start + duration)
+        self.synced_at = synced_at
+
+    def book(self, pk, analyst_id, start, end):
+        self.discard(pk)
+        self.bookings.setdefault(analyst_id, IntervalIndex()).add(start, end)
+        self.booked[pk] = (analyst_id, start, end)
+
+    def discard(self, pk):
+        if pk in self.booked:
+            analyst_id, start, end = self.booked.pop(pk)
+            self.bookings[analyst_id].remove(start, end)
+
+    def is_free(self, analyst_id, start, end):
+        intervals = self.bookings.get(analyst_id)
+        return not intervals or not intervals.overlaps(start, end)
+
+    def free_slots(self, duration, count=10, after=None, analyst_id=None):
+        """The first ``count`` free slots of ``duration`` minutes starting after ``after``"""
+        after = _epoch_minutes(after or timezone.now())
+        slots = self.slots_for(duration)
+        position = bisect_right(slots, after << 32 | 0xFFFFFFFF)
+        found = []
+        while position < len(slots) and len(found) < count:
+            start, slot_analyst = slots[position] >> 32, slots[position] & 0xFFFFFFFF
+            position += 1
+            if analyst_id is not None and slot_analyst != analyst_id:
+                continue
+            if self.is_free(slot_analyst, start, start + duration):
+                found.append(Slot(_from_epoch_minutes(start), _from_epoch_minutes(start + duration), slot_analyst))
+        return found
+
+    def free_starts(self, duration, count=10, after=None):
+        """The first ``count`` distinct start times at which some analyst is free"""
+        after = _epoch_minutes(after or timezone.now())
+        slots = self.slots_for(duration)
+        position = bisect_right(slots, after << 32 | 0xFFFFFFFF)
+        found = []
+        while position < len(slots) and len(found) < count:
+            start, analyst_id = slots[position] >> 32, slots[position] & 0xFFFFFFFF
+            position += 1
+            if found and found[-1] == start:
+                continue
+            if self.is_free(analyst_id, start, start + duration):
+                found.append(start)
+        return [_from_epoch_minutes(start) for start in found]
+
+    def free_analysts(self, start, duration):
+        """Analysts offering a free slot of ``duration`` minutes at exactly ``start``"""
+        minute = _epoch_minutes(start)
+        slots = self.slots_for(duration)
+        position = bisect_left(slots, minute << 32)
+        analysts = []
+        while position < len(slots) and slots[position] >> 32 == minute:
+            analyst_id = slots[position] & 0xFFFFFFFF
+            if self.is_free(analyst_id, minute, minute + duration):
+                analysts.append(analyst_id)
+            position += 1
+        return analysts
+
+
+# Process-wide index
+
+_AVAILABILITY_VERSION_KEY = 'dashboard:schedule:availability_version'
+_BOOKINGS_VERSION_KEY = 'dashboard:schedule:bookings_version'
+
+_index = None
+_index_versions = None
+
+
+def _bump(key):
+    cache.set(key, uuid.uuid4().hex, None)
+
+
+def _current_versions():
+    """
+    The (availability, bookings) version tokens shared by every process.  A
+    token lost from the cache is replaced by a new one, so every index
+    rebuilds instead of taking it for one it has already seen.
+    """
+    versions = cache.get_many([_AVAILABILITY_VERSION_KEY, _BOOKINGS_VERSION_KEY])
+    for key in (_AVAILABILITY_VERSION_KEY, _BOOKINGS_VERSION_KEY):
+        if key not in versions:
+            cache.add(key, uuid.uuid4().hex, None)
+            versions[key] = cache.get(key) or uuid.uuid4().hex
+    return versions[_AVAILABILITY_VERSION_KEY], versions[_BOOKINGS_VERSION_KEY]
+
+
+def invalidate_availability():
+    db_transaction.on_commit(lambda: _bump(_AVAILABILITY_VERSION_KEY))
+
+
+def invalidate_bookings():
+    db_transaction.on_commit(lambda: _bump(_BOOKINGS_VERSION_KEY))
+
+
+def get_index():
+    """This process's AvailabilityIndex, rebuilt or synced if the data changed"""
+    global _index, _index_versions
+    availability, bookings = _current_versions()
+    if (_index is None or _index_versions[0] != availability
+            or _index.first_day != timezone.localdate()):
+        _index = AvailabilityIndex.build()
+    elif _index_versions[1] != bookings:
+        _index.sync()
+    _index_versions = (availability, bookings)
+    return _index
+
+
+def has_availability():
+    return bool(get_index().windows)
+
+
+def free_slots(duration, count=10, after=None, analyst_id=None):
+    return get_index().free_slots(duration, count, after, analyst_id)
+
+
+def free_starts(duration, count=10, after=None):
+    return get_index().free_starts(duration, count, after)
+
+
+# Booking
+
+def _lock_analyst(analyst_id):
+    # A no-op UPDATE takes the row's write lock on every backend, SQLite included
+    return Analyst.objects.filter(pk=analyst_id).update(
+        available_for_consultation=F('available_for_consultation'),
+    )
+
+
+def _analyst_can_take(analyst_id, starts, duration):
+    """Whether the analyst's hours cover every session and none clashes with a booking or another session"""
+    analyst = Analyst.objects.filter(pk=analyst_id, available_for_consultation=True).values('consultation_hours').first()
+    if analyst is None:
+        return False
+    try:
+        rules = parse_consultation_hours(analyst['consultation_hours'])
+    except ValidationError:
+        return False
+    first, last = min(starts), max(starts) + datetime.timedelta(minutes=duration)
+    first_day = timezone.localtime(first, rules[0]).date() - datetime.timedelta(days=1)
+    windows = availability_windows(rules, first_day, (last - first).days + 3)
+
+    booked = IntervalIndex()
+    nearby = Consultation.objects.filter(
+        analyst_id=analyst_id,
+        status__in=ACTIVE_STATUSES,
+        scheduled_date__lt=last,
+        scheduled_date__gt=first - datetime.timedelta(days=1),
+    ).values_list('scheduled_date', 'duration_minutes')
+    for scheduled_date, length in nearby:
+        booked.add(_epoch_minutes(scheduled_date), _epoch_minutes(scheduled_date) + length)
+
+    for start in starts:
+        start_minute = _epoch_minutes(start)
+        end_minute = start_minute + duration
+        if not any(window_start <= start_minute and end_minute <= window_end for window_start, window_end in windows):
+            return False
+        if booked.overlaps(start_minute, end_minute):
+            return False
+        booked.add(start_minute, end_minute)
+    return True
+
+
+def claim_analyst(starts, duration, analyst_id=None):
+    """
+    Lock and return the id of ``analyst_id``, or of the first analyst the
+    index shows free, if they can take a ``duration`` minute session at every
+    time in ``starts``.  Call inside the transaction that books the sessions,
+    so the lock holds until they are saved.  Takes a constant number of
+    queries per analyst tried; raises SlotUnavailable if nobody can.
+    """
+    if analyst_id is not None:
+        candidates = [analyst_id]
+    else:
+        index = get_index()
+        # Sessions past the index horizon are left to the database check
+        covered = [start for start in starts if index.covers(start)] or starts[:1]
+        candidates = index.free_analysts(covered[0], duration)
+        for start in covered[1:]:
+            free = set(index.free_analysts(start, duration))
+            candidates = [candidate for candidate in candidates if candidate in free]
+    for candidate in candidates:
+        if _lock_analyst(candidate) and _analyst_can_take(candidate, starts, duration):
+            return candidate
+    raise SlotUnavailable("No analyst is available at that time")
+
+
+def _consultation_saved(sender, instance, **kwargs):
+    invalidate_bookings()
+
+
+def _consultation_deleted(sender, instance, **kwargs):
+    # Deletions leave nothing for the incremental sync to find
+    if instance.analyst_id is not None:
+        invalidate_availability()
+
+
+def _availability_state(instance):
+    return (instance.__dict__.get('available_for_consultation'), instance.__dict__.get('consultation_hours'))
+
+
+def _remember_availability(sender, instance, **kwargs):
+    setattr(instance, _LOADED_ATTR, _availability_state(instance) if instance.pk else None)
+
+
+def _analyst_saved(sender, instance, created, **kwargs):
+    if created or getattr(instance, _LOADED_ATTR, None) != _availability_state(instance):
+        invalidate_availability()
+    setattr(instance, _LOADED_ATTR, _availability_state(instance))
+
+
+def _analyst_deleted(sender, instance, **kwargs):
+    invalidate_availability()
+
+
+post_save.connect(_consultation_saved, sender=Consultation, dispatch_uid='schedule_consultation_saved')
+post_delete.connect(_consultation_deleted, sender=Consultation, dispatch_uid='schedule_consultation_deleted')
+post_init.connect(_remember_availability, sender=Analyst, dispatch_uid='schedule_analyst_loaded')
+post_save.connect(_analyst_saved, sender=Analyst, dispatch_uid='schedule_analyst_saved')
+post_delete.connect(_analyst_deleted, sender=Analyst, dispatch_uid='schedule_analyst_deleted')
@@ -0,0 +1,188 @@
+"""
+Serving stored media files from views, with HTTP range support.
+
+``serve_media`` answers conditional requests (ETag / Last-Modified from the
+file's size and mtime) and single ``Range: bytes=`` requests, honouring
+``If-Range``, so a video can be seeked and a download resumed without
+fetching the whole file again.  Multiple ranges are answered with the whole
+file, as RFC 9110 allows.
+
+The file is streamed with FileResponse.  Under a server providing
+``wsgi.file_wrapper`` with sendfile (e.g. gunicorn) the bytes are copied by
+``os.sendfile`` without passing through Python, ranges included: the file is
+left positioned at the range start with Content-Length set to its length.
+
+With MEDIA_OFFLOAD set the view only authorizes the request and hands the
+file to the front-end server, which then also handles ranges:
+
+* ``'x-accel-redirect'`` (nginx): ``X-Accel-Redirect`` to MEDIA_ACCEL_PREFIX
+  plus the path under MEDIA_ROOT, served by an ``internal`` location, e.g.
+  ``location /protected-media/ { internal; alias /srv/insight/media/; }``
+* ``'x-sendfile'`` (Apache mod_xsendfile, lighttpd): ``X-Sendfile`` with the
+  absolute path.
+"""
+import mimetypes
+import os
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def parse_range(header, size):
+    """
+    ``(first, last)`` byte positions requested by the ``Range`` header
+    ``header`` of a ``size`` byte file, or None if it is to be ignored
+    (missing, malformed or several ranges).  Raises RangeNotSatisfiable if
+    the range lies outside the file.
+    """
+    unit, _, ranges = (header or '').partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, sep, last = ranges.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                raise RangeNotSatisfiable(header)
+            return max(size - length, 0), size - 1
+        first = int(first)
+        last = int(last) if last else max(size - 1, first)
+    except ValueError:
+        return None
+    if first > last:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiable(header)
+    return first, min(last, size - 1)
+
+
+def _if_range_matches(request, etag, last_modified):
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        # Weak validators never match for ranges
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+class _RangeFile:
+    """Reads ``length`` bytes of ``file`` from ``start``; exposes fileno() so sendfile still applies"""
+
+    def __init__(self, file, start, length):
+        file.seek(start)
+        self.file = file
+        self.name = file.name
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        data = self.file.read(self.remaining if size is None or size < 0 else min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def tell(self):
+        return self.file.tell()
+
+    def seek(self, *args):
+        return self.file.seek(*args)
+
+    def close(self):
+        self.file.close()
+
+
+def _offload(path, accel_path, content_type):
+    mode = getattr(settings, 'MEDIA_OFFLOAD', '')
+    if not mode or (mode == 'x-accel-redirect' and accel_path is None):
+        return None
+    response = HttpResponse(content_type=content_type)
+    if mode == 'x-accel-redirect':
+        response['X-Accel-Redirect'] = accel_path
+    elif mode == 'x-sendfile':
+        response['X-Sendfile'] = path
+    else:
+        raise ValueError(f"Unknown MEDIA_OFFLOAD {mode!r}")
+    return response
+
+
+def _finish(response, etag, last_modified, cache_control):
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    if cache_control:
+        patch_cache_control(response, **cache_control)
+    return response
+
+
+def serve_media(request, fieldfile, filename=None, as_attachment=False, **cache_control):
+    """
+    Response serving the stored file ``fieldfile``, named ``filename`` (its
+    own name by default).  ``cache_control`` is passed to patch_cache_control.
+    """
+    if not fieldfile:
+        raise Http404
+    path = fieldfile.storage.path(fieldfile.name)
+    relative = os.path.relpath(path, fieldfile.storage.location).replace(os.sep, '/')
+    return serve_path(
+        request, path, filename or os.path.basename(fieldfile.name), as_attachment,
+        accel_path=settings.MEDIA_ACCEL_PREFIX + quote(relative), **cache_control,
+    )
+
+
+def serve_path(request, path, filename, as_attachment=False, accel_path=None, **cache_control):
+    """
+    Response serving the file at ``path`` as ``filename``.  Files outside
+    MEDIA_ROOT have no ``accel_path`` and are not offloaded to nginx.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise Http404
+    size, last_modified = stat.st_size, int(stat.st_mtime)
+    etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        return _finish(response, etag, last_modified, cache_control)
+
+    response = _offload(path, accel_path, content_type)
+    if response is not None:
+        response['Content-Disposition'] = content_disposition_header(as_attachment, filename)
+        return _finish(response, etag, last_modified, cache_control)
+
+    byte_range = None
+    if _if_range_matches(request, etag, last_modified):
+        try:
+            byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return _finish(response, etag, last_modified, cache_control)
+
+    handle = open(path, 'rb')
+    if byte_range is None:
+        response = FileResponse(handle, content_type=content_type, as_attachment=as_attachment, filename=filename)
+    else:
+        first, last = byte_range
+        response = FileResponse(
+            _RangeFile(handle, first, last - first + 1), status=206, content_type=content_type,
+            as_attachment=as_attachment, filename=filename,
+        )
+        response['Content-Length'] = last - first + 1
+        response['Content-Range'] = f'bytes {first}-{last}/{size}'
+    return _finish(response, etag, last_modified, cache_control)
@@ -0,0 +1,218 @@
+"""
+Content-addressed media storage.
+
+ContentAddressedStorage keeps each distinct upload once.  An upload is
+hashed (SHA-256) as it is streamed to a temporary file, which becomes the
+blob ``blobs/<aa>/<bb>/<sha256><ext>`` unless that blob already exists, in
+which case it is dropped.  The name the model field asked for (its
+``upload_to`` path) is recorded as a MediaFile pointing at the MediaBlob,
+so models, ``exists()``, ``open()`` and ``delete()`` keep working with the
+same names as before.  Blobs count their MediaFiles and are removed along
+with the last one.
+
+``url()`` points at the blob itself.  Its URL changes whenever the content
+does, so everything under ``MEDIA_URL + 'blobs/'`` can be cached by
+browsers and CDNs indefinitely.
+
+Files stored before this backend, which have no MediaFile, are still served
+from their own path; ``manage.py dedupe_media`` moves them into blobs.
+"""
+import hashlib
+import os
+import tempfile
+
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction as db_transaction
+from django.db.models import F
+
+from .models import MediaBlob, MediaFile
+
+BLOB_DIR = 'blobs'
+
+# How long a name's blob is remembered by url()/open(), in the default cache
+# shared by every worker; saves and deletes update it once they commit
+MEDIA_NAME_CACHE_TIMEOUT = 60 * 5
+
+
+def _cache_key(name):
+    return f"dashboard:media:{hashlib.sha1(name.encode()).hexdigest()}"
+
+
+def _hash_file(location):
+    """``(sha256 hex digest, size)`` of a file, read through one reused buffer"""
+    digest = hashlib.sha256()
+    buffer = memoryview(bytearray(256 * 1024))
+    size = 0
+    with open(location, 'rb', buffering=0) as handle:
+        while True:
+            read = handle.readinto(buffer)
+            if not read:
+                break
+            digest.update(buffer[:read])
+            size += read
+    return digest.hexdigest(), size
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    def blob_name(self, digest, name):
+        extension = os.path.splitext(name)[1].lower()
+        return f'{BLOB_DIR}/{digest[:2]}/{digest[2:4]}/{digest}{extension}'
+
+    def blob_for(self, name):
+        """Blob path stored under ``name``, or None for an unknown or legacy file"""
+        key = _cache_key(name)
+        path = cache.get(key)
+        if path is None:
+            path = MediaFile.objects.filter(name=name).values_list('blob__path', flat=True).first()
+            if path is not None:
+                cache.set(key, path, MEDIA_NAME_CACHE_TIMEOUT)
+        return path
+
+    def _resolve(self, name):
+        return self.blob_for(name) or name
+
+    def _disk_path(self, path):
+        """Filesystem path of ``path`` itself, not of the blob stored under it"""
+        return super().path(path)
+
+    # Writing
+
+    def _save(self, name, content):
+        spool_dir = self._disk_path(f'{BLOB_DIR}/tmp')
+        os.makedirs(spool_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        handle, spooled = tempfile.mkstemp(dir=spool_dir)
+        try:
+            with os.fdopen(handle, 'wb') as spool:
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    digest.update(chunk)
+                    size += len(chunk)
+                    spool.write(chunk)
+            name = self._store(name, spooled, digest.hexdigest(), size)
+        finally:
+            if os.path.exists(spooled):
+                os.remove(spooled)
+        return name
+
+    def save_file(self, name, location, max_length=None):
+        """
+        Store the file at ``location`` (on the same filesystem as MEDIA_ROOT)
+        under an available name like ``name`` by moving it into its blob,
+        without copying it.  Returns the name; ``location`` is gone after.
+        """
+        name = self.get_available_name(name, max_length=max_length)
+        digest, size = _hash_file(location)
+        try:
+            return self._store(name, location, digest, size)
+        finally:
+            # Left in place when the blob already existed
+            if os.path.exists(location):
+                os.remove(location)
+
+    def _store(self, name, spooled, digest, size):
+        """Map ``name`` to the blob of the spooled file, creating the blob if it is new"""
+        path = self.blob_name(digest, name)
+        while True:
+            try:
+                with db_transaction.atomic():
+                    # Locking the blob keeps a concurrent delete of its last name from removing it under us
+                    blob, created = MediaBlob.objects.select_for_update().get_or_create(
+                        path=path, defaults={'sha256': digest, 'size': size},
+                    )
+                    MediaFile.objects.create(name=name, blob=blob)
+                    MediaBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+                    # Moved last, so a taken name leaves the spooled file for the retry
+                    location = self._disk_path(path)
+                    if created or not os.path.exists(location):
+                        os.makedirs(os.path.dirname(location), exist_ok=True)
+                        os.replace(spooled, location)
+                        if self.file_permissions_mode is not None:
+                            os.chmod(location, self.file_permissions_mode)
+                break
+            except IntegrityError:
+                # Another upload took the name since get_available_name()
+                name = self.get_available_name(name)
+        self._remember(name, path)
+        return name
+
+    # Name cache entries are dropped at once and written again on commit:
+    # until then other workers still read, and may re-cache, the old row
+
+    def _remember(self, name, path):
+        key = _cache_key(name)
+        cache.delete(key)
+        db_transaction.on_commit(lambda: cache.set(key, path, MEDIA_NAME_CACHE_TIMEOUT))
+
+    def _forget(self, name):
+        key = _cache_key(name)
+        cache.delete(key)
+        db_transaction.on_commit(lambda: cache.delete(key))
+
+    def delete(self, name):
+        if not name:
+            raise ValueError("The name must be given to delete().")
+        with db_transaction.atomic():
+            media_file = MediaFile.objects.select_for_update().filter(name=name).first()
+            if media_file is None:
+                return super().delete(name)
+            media_file.delete()
+            blob = MediaBlob.objects.select_for_update().get(pk=media_file.blob_id)
+            if blob.ref_count > 1:
+                MediaBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') - 1)
+            else:
+                blob.delete()
+                db_transaction.on_commit(lambda: self._delete_blob_file(blob.path))
+        self._forget(name)
+
+    def _delete_blob_file(self, path):
+        # The same content may have been stored again since
+        if not MediaBlob.objects.filter(path=path).exists():
+            FileSystemStorage.delete(self, path)
+
+    def adopt(self, name):
+        """
+        Move a file stored under ``name`` before this backend into a blob.
+        Returns the bytes saved on disk: its size if the blob already
+        existed, 0 if it was moved in or is already a MediaFile.
+        """
+        if MediaFile.objects.filter(name=name).exists():
+            return 0
+        location = self._disk_path(name)
+        digest, size = _hash_file(location)
+        existed = MediaBlob.objects.filter(path=self.blob_name(digest, name)).exists()
+        # _store moves the file into a new blob and leaves it in place otherwise
+        self._store(name, location, digest, size)
+        if os.path.exists(location):
+            os.remove(location)
+        return size if existed else 0
+
+    # Reading
+
+    def path(self, name):
+        return super().path(self._resolve(name))
+
+    def exists(self, name):
+        return self.blob_for(name) is not None or os.path.lexists(self._disk_path(name))
+
+    def url(self, name):
+        return super().url(self._resolve(name))
+
+    def listdir(self, path):
+        prefix = path.strip('/') + '/' if path.strip('/') else ''
+        directories, files = set(), set()
+        for name in MediaFile.objects.filter(name__startswith=prefix).values_list('name', flat=True).iterator():
+            head, sep, _ = name[len(prefix):].partition('/')
+            (directories if sep else files).add(head)
+        try:
+            legacy_directories, legacy_files = super().listdir(path)
+        except FileNotFoundError:
+            legacy_directories, legacy_files = [], []
+        directories.update(legacy_directories)
+        files.update(legacy_files)
+        if not prefix:
+            directories.discard(BLOB_DIR)
+        return sorted(directories), sorted(files)
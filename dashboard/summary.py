@@ -0,0 +1,122 @@
+"""
+Per-user summary figures shown on the dashboard, marketplace and
+consultation header cards.
+
+All counts and totals are computed in a single SQL statement: ledger totals
+are read from the user's UserStats row, and consultation status counts are
+correlated subqueries using conditional aggregation (Count with filter=).
+The result is memoized in the default cache and dropped whenever the user's
+purchases, transactions or consultations change.  Invalidation only reaches
+other worker processes because the default cache is shared between them
+(see CACHES in settings).
+"""
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db import transaction as db_transaction
+from django.db.models import (
+    Count, DecimalField, F, IntegerField, OuterRef, Q, Subquery, Value,
+)
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from .models import Consultation, PurchasedAnalysis, Transaction, UserStats
+
+# Upcoming-session counts depend on the clock, so cached summaries also expire
+SUMMARY_CACHE_TIMEOUT = 300
+
+MONEY_FIELD = DecimalField(max_digits=15, decimal_places=2)
+
+
+def user_summary_cache_key(user_id):
+    return f"dashboard:user_summary:{user_id}"
+
+
+def _per_user(queryset, aggregate, output_field):
+    """Correlated subquery returning one aggregate over the outer user's rows"""
+    subquery = (
+        queryset.filter(user=OuterRef('pk'))
+        .order_by()
+        .values('user')
+        .annotate(value=aggregate)
+        .values('value')[:1]
+    )
+    zero = Value(Decimal('0.00') if isinstance(output_field, DecimalField) else 0)
+    return Coalesce(Subquery(subquery, output_field=output_field), zero, output_field=output_field)
+
+
+def _summary_row(user_id):
+    now = timezone.now()
+    count_field = IntegerField()
+
+    return User.objects.filter(pk=user_id).annotate(
+        stats_id=F('stats__pk'),
+        purchased_count=F('stats__purchase_count'),
+        total_spent=F('stats__total_spent'),
+        consultation_spend=F('stats__consultation_spend'),
+        scheduled_count=_per_user(
+            Consultation.objects, Count('pk', filter=Q(status='scheduled')), count_field
+        ),
+        upcoming_count=_per_user(
+            Consultation.objects,
+            Count('pk', filter=Q(status='scheduled', scheduled_date__gte=now)),
+            count_field,
+        ),
+        completed_count=_per_user(
+            Consultation.objects, Count('pk', filter=Q(status='completed')), count_field
+        ),
+        cancelled_count=_per_user(
+            Consultation.objects, Count('pk', filter=Q(status='cancelled')), count_field
+        ),
+    ).values(
+        'stats_id', 'purchased_count', 'total_spent', 'scheduled_count', 'upcoming_count',
+        'completed_count', 'cancelled_count', 'consultation_spend',
+    ).first() or {}
+
+
+def _compute_user_summary(user_id):
+    row = _summary_row(user_id)
+    if row and row['stats_id'] is None:
+        # First visit since stats were introduced: build the row from history
+        UserStats.rebuild(user_ids=[user_id])
+        row = _summary_row(user_id)
+
+    summary = {
+        'purchased_count': row.get('purchased_count') or 0,
+        'total_spent': row.get('total_spent') or Decimal('0.00'),
+        'scheduled_count': row.get('scheduled_count', 0),
+        'upcoming_count': row.get('upcoming_count', 0),
+        'completed_count': row.get('completed_count', 0),
+        'cancelled_count': row.get('cancelled_count', 0),
+        'consultation_spend': row.get('consultation_spend') or Decimal('0.00'),
+    }
+    return summary
+
+
+def get_user_summary(user):
+    """Return the cached summary dict for ``user``, computing it on a miss"""
+    key = user_summary_cache_key(user.pk)
+    summary = cache.get(key)
+    if summary is None:
+        summary = _compute_user_summary(user.pk)
+        cache.set(key, summary, SUMMARY_CACHE_TIMEOUT)
+    return summary
+
+
+def invalidate_user_summary(user_id):
+    """Drop the cached summary now and again once the write is committed"""
+    key = user_summary_cache_key(user_id)
+    cache.delete(key)
+    db_transaction.on_commit(lambda: cache.delete(key))
+
+
+def _invalidate_for_instance(sender, instance, **kwargs):
+    if instance.user_id:
+        invalidate_user_summary(instance.user_id)
+
+
+for _model in (PurchasedAnalysis, Transaction, Consultation):
+    post_save.connect(_invalidate_for_instance, sender=_model, dispatch_uid=f'user_summary_save_{_model.__name__}')
+    post_delete.connect(_invalidate_for_instance, sender=_model, dispatch_uid=f'user_summary_delete_{_model.__name__}')
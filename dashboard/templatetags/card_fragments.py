@@ -0,0 +1,18 @@
+from django import template
+
+from dashboard.fragments import CARD_FRAGMENT_TIMEOUT, card_fragment_token, card_fragment_version
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def card_fragment(context, kind, obj):
+    """Return ``{'token', 'timeout'}`` for caching ``obj``'s card with ``{% cache %}``"""
+    # Look the version up once per render rather than once per card
+    versions = context.render_context.setdefault('card_fragment_versions', {})
+    if kind not in versions:
+        versions[kind] = card_fragment_version(kind)
+    return {
+        'token': card_fragment_token(kind, obj.pk, obj.updated_at, versions[kind]),
+        'timeout': CARD_FRAGMENT_TIMEOUT,
+    }
@@ -0,0 +1,27 @@
+from django import template
+from django.utils.html import format_html
+
+from dashboard.images import srcset
+
+register = template.Library()
+
+
+@register.simple_tag
+def responsive_image(fieldfile, sizes='100vw', alt='', css_class='', style=''):
+    """
+    Render ``fieldfile`` as a ``<picture>`` offering its WebP derivatives
+    and its JPEG/PNG ones, or as a plain ``<img>`` of the original until
+    the derivatives exist.
+    """
+    if not fieldfile:
+        return ''
+    fallback = srcset(fieldfile)
+    if not fallback:
+        return format_html(
+            '<img src="{}" alt="{}" class="{}" style="{}" loading="lazy">', fieldfile.url, alt, css_class, style,
+        )
+    return format_html(
+        '<picture><source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" alt="{}" class="{}" style="{}" loading="lazy"></picture>',
+        srcset(fieldfile, 'webp'), sizes, fieldfile.url, fallback, sizes, alt, css_class, style,
+    )
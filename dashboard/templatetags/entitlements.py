@@ -0,0 +1,11 @@
+from django import template
+
+from dashboard.entitlements import get_owned_analyses
+
+register = template.Library()
+
+@register.filter
+def owned_by(analysis, user):
+    """True if ``user`` has purchased ``analysis`` (an instance or an id)"""
+    analysis_id = getattr(analysis, 'pk', analysis)
+    return analysis_id in get_owned_analyses(user)
@@ -1,3 +1,2106 @@
-from django.test import TestCase
+import datetime
+import io
+import json
+from datetime import timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+
+from .models import (
+    Analyst, AnalysisInsight, AnalysisMetric, AnalysisNeighbors, AnalysisRanking, AnalysisRating,
+    AnalystRanking, AttachmentUpload, Category, ChartAnnotation, Consultation, ConsultationAttachment,
+    ConsultationPackage,
+    ConsultationReminder,
+    CryptoAnalysis, DailyRollup, MarketInsight, MediaBlob, MpesaTransaction, PurchasedAnalysis, SiteSetting,
+    TechnicalIndicatorData, Transaction, UserStats, UserWallet,
+)
+
+
+_cache_dir = None
+_cache_override = None
+
+
+def setUpModule():
+    """Point the file cache at a fresh directory, away from the dev cache and earlier runs"""
+    import tempfile
+
+    from django.conf import settings
+
+    global _cache_dir, _cache_override
+    _cache_dir = tempfile.mkdtemp()
+    _cache_override = override_settings(CACHES={'default': {**settings.CACHES['default'], 'LOCATION': _cache_dir}})
+    _cache_override.enable()
+
+
+def tearDownModule():
+    import shutil
+
+    _cache_override.disable()
+    shutil.rmtree(_cache_dir, ignore_errors=True)
+
+
+class UserSummaryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('reader')
+        analyst = Analyst.objects.create(user=User.objects.create_user('analyst'))
+        self.analysis = CryptoAnalysis.objects.create(
+            analyst=analyst, title='Bitcoin outlook', cryptocurrency='Bitcoin', symbol='BTC', price=Decimal('12.50'),
+            analysis_type='technical', timeframe='short_term', risk_level='low',
+        )
+
+    def test_summary_is_cached(self):
+        from .summary import get_user_summary
+
+        self.assertEqual(get_user_summary(self.user)['scheduled_count'], 0)
+        with self.assertNumQueries(0):
+            get_user_summary(self.user)
+
+    def test_ledger_writes_invalidate_the_summary(self):
+        from .summary import get_user_summary
+
+        get_user_summary(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            PurchasedAnalysis.objects.create(user=self.user, analysis=self.analysis, purchase_price=Decimal('12.50'))
+            UserStats.record(self.user, purchase_count=1, total_spent=Decimal('12.50'))
+        summary = get_user_summary(self.user)
+        self.assertEqual(summary['purchased_count'], 1)
+        self.assertEqual(summary['total_spent'], Decimal('12.50'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Consultation.objects.create(user=self.user, title='Review', scheduled_date=timezone.now() + timedelta(days=1))
+        summary = get_user_summary(self.user)
+        self.assertEqual((summary['scheduled_count'], summary['upcoming_count']), (1, 1))
+
+    def test_default_cache_is_shared_between_processes(self):
+        from django.conf import settings
+
+        self.assertNotIn('locmem', settings.CACHES['default']['BACKEND'])
+
+    def test_incremented_counters_do_not_expire(self):
+        import time
+        from unittest import mock
+
+        cache.add('dashboard:test_counter', 1, None)
+        cache.incr('dashboard:test_counter')
+        with mock.patch('time.time', return_value=time.time() + 3600):
+            self.assertEqual(cache.get('dashboard:test_counter'), 2)
+
+
+class UserStatsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('trader')
+        analyst = Analyst.objects.create(user=User.objects.create_user('analyst'))
+        self.analysis = CryptoAnalysis.objects.create(
+            analyst=analyst, title='Bitcoin outlook', cryptocurrency='Bitcoin', symbol='BTC', price=Decimal('12.50'),
+            analysis_type='technical', timeframe='short_term', risk_level='low',
+        )
+
+    def stats(self):
+        return UserStats.objects.filter(user=self.user).values(*UserStats.STAT_FIELDS).get()
+
+    def test_incremental_updates_match_rebuild(self):
+        self.client.force_login(self.user)
+        self.client.post('/wallet/add-funds/', {'amount': '100.00', 'payment_method': 'card'}, secure=True)
+        response = self.client.post('/instant-purchase/', {'analysis_id': self.analysis.pk}, secure=True)
+        self.assertEqual(response.json()['status'], 'success')
+
+        # As booked by book_consultation, then cancelled with a refund
+        consultation = Consultation.objects.create(
+            user=self.user, title='Review', scheduled_date=timezone.now() + timedelta(days=1),
+            price=Decimal('30.00'), payment_status='paid', payment_method='wallet',
+        )
+        UserStats.record(self.user, consultations_booked=1, consultation_spend=Decimal('30.00'))
+        consultation.cancel_consultation(refund=True)
+        AnalysisRating.objects.create(analysis=self.analysis, user=self.user, rating=4)
+
+        incremental = self.stats()
+        self.assertEqual(incremental['purchase_count'], 1)
+        self.assertEqual(incremental['total_refunded'], Decimal('30.00'))
+        UserStats.objects.filter(user=self.user).delete()
+        UserStats.rebuild(user_ids=[self.user.pk])
+        self.assertEqual(self.stats(), incremental)
+
+    def test_admin_edits_rebuild_the_owner_stats(self):
+        from django.contrib import admin
+        from django.test import RequestFactory
+
+        request = RequestFactory().post('/admin/')
+        request.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        model_admin = admin.site._registry[Transaction]
+        deposit = Transaction(user=self.user, amount=Decimal('40.00'), transaction_type='deposit',
+                              payment_method='card', status='completed')
+        with self.captureOnCommitCallbacks(execute=True):
+            model_admin.save_model(request, deposit, None, change=False)
+        self.assertEqual(self.stats()['total_deposited'], Decimal('40.00'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            model_admin.delete_queryset(request, Transaction.objects.filter(pk=deposit.pk))
+        self.assertEqual(self.stats()['total_deposited'], Decimal('0.00'))
+
+
+class EntitlementTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('buyer')
+        analyst = Analyst.objects.create(user=User.objects.create_user('analyst'))
+        self.analysis = CryptoAnalysis.objects.create(
+            analyst=analyst, title='Bitcoin outlook', cryptocurrency='Bitcoin', symbol='BTC', price=Decimal('12.50'),
+            analysis_type='technical', timeframe='short_term', risk_level='low',
+        )
+
+    def cache_without_purchases(self):
+        """Store the empty set a worker cached before the purchase committed"""
+        from .entitlements import OwnedAnalyses, entitlement_cache_key
+
+        cache.set(entitlement_cache_key(self.user.pk), OwnedAnalyses().to_bytes())
+
+    def test_purchases_drop_the_cached_set(self):
+        from .entitlements import get_owned_analyses
+
+        self.assertNotIn(self.analysis.pk, get_owned_analyses(self.user))
+        with self.captureOnCommitCallbacks(execute=True):
+            PurchasedAnalysis.objects.create(user=self.user, analysis=self.analysis, purchase_price=Decimal('12.50'))
+        self.assertIn(self.analysis.pk, get_owned_analyses(User.objects.get(pk=self.user.pk)))
+
+    def test_stale_cache_falls_back_to_the_database(self):
+        from .entitlements import entitlement_cache_key, user_owns_analysis
+
+        PurchasedAnalysis.objects.create(user=self.user, analysis=self.analysis, purchase_price=Decimal('12.50'))
+        self.cache_without_purchases()
+        self.assertTrue(user_owns_analysis(self.user, self.analysis.pk))
+        self.assertIsNone(cache.get(entitlement_cache_key(self.user.pk)))
+
+    def test_purchase_checks_the_database(self):
+        self.client.force_login(self.user)
+        UserWallet.objects.update_or_create(user=self.user, defaults={'balance': Decimal('100.00')})
+        PurchasedAnalysis.objects.create(user=self.user, analysis=self.analysis, purchase_price=Decimal('12.50'))
+        self.cache_without_purchases()
+        response = self.client.post('/instant-purchase/', {'analysis_id': self.analysis.pk}, secure=True)
+        self.assertEqual(response.json()['status'], 'already_purchased')
+        self.assertEqual(UserWallet.objects.get(user=self.user).balance, Decimal('100.00'))
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_view_analysis_reads_the_purchase_once(self):
+        url = f'/view-analysis/{self.analysis.pk}/'
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(url, secure=True).status_code, 302)
+
+        PurchasedAnalysis.objects.create(user=self.user, analysis=self.analysis, purchase_price=Decimal('12.50'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['purchase'].user, self.user)
+        self.assertEqual(
+            sum('FROM "dashboard_purchasedanalysis"' in query['sql'] for query in queries.captured_queries), 1
+        )
+
+    def test_rebuild_racing_a_purchase_is_not_stored(self):
+        from unittest import mock
+
+        from . import entitlements
+
+        PurchasedAnalysis.objects.create(user=self.user, analysis=self.analysis, purchase_price=Decimal('12.50'))
+        generations = iter([0, 0, 1])
+        with mock.patch.object(entitlements, 'entitlement_generation', lambda user_id: next(generations)):
+            entitlements._load_owned_analyses(self.user.pk)
+        self.assertIsNone(cache.get(entitlements.entitlement_cache_key(self.user.pk)))
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ListingProjectionTests(TestCase):
+    """Listing routes must not load the full report bodies"""
+
+    LISTING_URLS = [
+        '/dashboard/',
+        '/marketplace/',
+        '/portfolio/',
+        '/purchase_analysis/',
+        '/market-insights/',
+    ]
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'password')
+        analyst = Analyst.objects.create(user=User.objects.create_user('analyst'))
+        self.analyses = [
+            CryptoAnalysis.objects.create(
+                title=f'Analysis {i}', cryptocurrency='Bitcoin', symbol='BTC', analyst=analyst,
+                analysis_type='technical', timeframe='short_term', risk_level='low',
+                price=Decimal('10.00'), description='Card description',
+                executive_summary='Summary', preview_content='Preview', full_content='Full report',
+                trading_strategy={'features': ['Entry zones', 'Stop levels']},
+            )
+            for i in range(3)
+        ]
+        PurchasedAnalysis.objects.create(user=self.user, analysis=self.analyses[0], purchase_price=Decimal('10.00'))
+        MarketInsight.objects.create(
+            title='Insight', cryptocurrency='Bitcoin', symbol='BTC', summary='Short summary',
+            full_content='Full insight', is_featured=True,
+        )
+        self.client.force_login(self.user)
+
+    def assertFullContentNotSelected(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, secure=True)
+        self.assertEqual(response.status_code, 200, url)
+        for query in queries.captured_queries:
+            self.assertNotIn('"full_content"', query['sql'], url)
+
+    def test_listing_routes_skip_full_content(self):
+        for url in self.LISTING_URLS:
+            with self.subTest(url=url):
+                self.assertFullContentNotSelected(url)
+
+    def test_analysis_api_skips_full_content(self):
+        self.assertFullContentNotSelected(f'/api/analysis/{self.analyses[1].id}/')
+
+    def test_card_projection_reads_features_without_strategy_blob(self):
+        analysis = CryptoAnalysis.objects.projection('card').get(pk=self.analyses[0].pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(analysis.features_list, ['Entry zones', 'Stop levels'])
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class CardFragmentCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'password')
+        analyst = Analyst.objects.create(user=User.objects.create_user('analyst'))
+        self.analysis = CryptoAnalysis.objects.create(
+            title='Analysis', cryptocurrency='Bitcoin', symbol='BTC', analyst=analyst,
+            analysis_type='technical', timeframe='short_term', risk_level='low',
+            price=Decimal('10.00'), description='Original description',
+            executive_summary='Summary', preview_content='Preview', full_content='Full report',
+        )
+        self.client.force_login(self.user)
+
+    def test_saved_analysis_replaces_cached_card(self):
+        response = self.client.get('/marketplace/', secure=True)
+        self.assertContains(response, 'Original description')
+        self.assertContains(response, f'openPurchaseModal({self.analysis.id})')
+
+        self.analysis.description = 'Revised description'
+        self.analysis.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            PurchasedAnalysis.objects.create(user=self.user, analysis=self.analysis, purchase_price=Decimal('10.00'))
+
+        response = self.client.get('/marketplace/', secure=True)
+        self.assertContains(response, 'Revised description')
+        self.assertNotContains(response, 'Original description')
+        # Ownership is rendered outside the cached fragment
+        self.assertNotContains(response, f'openPurchaseModal({self.analysis.id})')
+
+
+class TemplatePipelineTests(TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+        from pathlib import Path
+
+        self.root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        (self.root / 'templates').mkdir()
+        self.build = self.root / 'build'
+        pipeline = override_settings(
+            BASE_DIR=self.root,
+            ASSET_BUILD_DIR=self.build,
+            TEMPLATES=[{
+                'BACKEND': 'django.template.backends.django.DjangoTemplates',
+                'DIRS': [self.build / 'templates', self.root / 'templates'],
+            }],
+        )
+        pipeline.enable()
+        self.addCleanup(pipeline.disable)
+
+    def write_source(self, name, text):
+        path = self.root / 'templates' / name
+        path.write_text(text, encoding='utf-8')
+        return path
+
+    def test_minify_keeps_whitespace_sensitive_elements(self):
+        from .middleware import minify_html
+
+        html = (
+            '<div>\n    <p>Text</p>\n\n    <pre>  line one\n      line two</pre>\n'
+            '    <textarea>\n  keep\n</textarea>\n    <script>\n  var a = 1;\n\n  var b = 2;\n</script>\n</div>'
+        )
+        self.assertEqual(minify_html(html), (
+            '<div>\n<p>Text</p>\n<pre>  line one\n      line two</pre>\n'
+            '<textarea>\n  keep\n</textarea>\n<script>\n  var a = 1;\n\n  var b = 2;\n</script>\n</div>'
+        ))
+
+    @override_settings(HTML_MINIFY=True)
+    def test_middleware_minifies_only_html(self):
+        from django.http import HttpResponse, JsonResponse
+        from django.test import RequestFactory
+
+        from .middleware import HTMLMinifyMiddleware
+
+        request = RequestFactory().get('/')
+        page = HTMLMinifyMiddleware(lambda request: HttpResponse('<ul>\n    <li>One</li>\n</ul>'))(request)
+        self.assertEqual(page.content, b'<ul>\n<li>One</li>\n</ul>')
+        data = HTMLMinifyMiddleware(lambda request: JsonResponse({'text': 'a\n    b'}))(request)
+        self.assertEqual(json.loads(data.content), {'text': 'a\n    b'})
+
+    def test_extraction_round_trips(self):
+        import re
+
+        from django.core.management import call_command
+
+        css = 'body {\n  color: #222;\n}\n' * 40
+        js = 'console.log("ready");\n' * 40
+        original = (
+            '{% extends "base.html" %}\n{% block content %}\n<style>\n' + css + '</style>\n'
+            '<script>var small = 1;</script>\n<script>var user = "{{ user }}";' + ' ' * 600 + '</script>\n'
+            '<script type="text/javascript">\n' + js + '</script>\n{% endblock %}\n'
+        )
+        self.write_source('page.html', original)
+        call_command('extract_inline_assets', stdout=io.StringIO())
+
+        built = (self.build / 'templates' / 'page.html').read_text(encoding='utf-8')
+        self.assertTrue(built.startswith('{% extends "base.html" %}\n{% load static %}\n'))
+        self.assertIn('<script>var small = 1;</script>', built)
+        self.assertIn('"{{ user }}"', built)
+
+        def inline(match):
+            body = (self.build / 'static' / match.group(2)).read_text(encoding='utf-8')
+            return f"<style>\n{body}</style>" if match.group(1) == 'link' else f'<script type="text/javascript">\n{body}</script>'
+
+        restored = re.sub(r'<(link|script) (?:rel="stylesheet" href|src)="{% static \'([^\']+)\' %}">(?:</script>)?',
+                          inline, built.replace('{% load static %}\n', ''))
+        self.assertEqual(restored, original)
+
+    def test_stale_build_template_fails_the_checks(self):
+        import os
+
+        from django.core.management import call_command
+
+        from .checks import check_asset_build
+
+        source = self.write_source('page.html', '<style>\n' + 'p { margin: 0; }\n' * 60 + '</style>\n')
+        call_command('extract_inline_assets', stdout=io.StringIO())
+        self.assertEqual(check_asset_build(None), [])
+
+        built = self.build / 'templates' / 'page.html'
+        os.utime(source, (built.stat().st_mtime + 10,) * 2)
+        self.assertEqual([error.id for error in check_asset_build(None)], ['dashboard.E001'])
+
+        # Rebuilding without the inline block drops the build copy instead of leaving it to shadow the source
+        source.write_text('<p>Plain</p>\n', encoding='utf-8')
+        call_command('extract_inline_assets', stdout=io.StringIO())
+        self.assertFalse(built.exists())
+        self.assertEqual(check_asset_build(None), [])
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'password')
+        analyst = Analyst.objects.create(user=User.objects.create_user('analyst'))
+        self.analysis = CryptoAnalysis.objects.create(
+            title='Analysis', cryptocurrency='Bitcoin', symbol='BTC', analyst=analyst,
+            analysis_type='technical', timeframe='short_term', risk_level='low',
+            price=Decimal('10.00'), description='Description',
+            executive_summary='Summary', preview_content='Preview', full_content='Full report',
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            PurchasedAnalysis.objects.create(user=self.user, analysis=self.analysis, purchase_price=Decimal('10.00'))
+        self.client.force_login(self.user)
+
+    def test_unchanged_analysis_returns_not_modified(self):
+        for url in [f'/view-analysis/{self.analysis.id}/', f'/api/analysis/{self.analysis.id}/']:
+            with self.subTest(url=url):
+                response = self.client.get(url, secure=True)
+                self.assertEqual(response.status_code, 200)
+                etag = response['ETag']
+
+                response = self.client.get(url, secure=True, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.content, b'')
+
+    def test_updated_analysis_sends_new_body(self):
+        url = f'/api/analysis/{self.analysis.id}/'
+        etag = self.client.get(url, secure=True)['ETag']
+
+        self.analysis.title = 'Revised'
+        self.analysis.save()
+
+        response = self.client.get(url, secure=True, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class AnalysisBatchApiTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'password')
+        analyst = Analyst.objects.create(user=User.objects.create_user('analyst'))
+        self.analyses = [
+            CryptoAnalysis.objects.create(
+                title=f'Analysis {i}', cryptocurrency='Bitcoin', symbol='BTC', analyst=analyst,
+                analysis_type='technical', timeframe='short_term', risk_level='low',
+                price=Decimal('10.00'), description='Description',
+                executive_summary='Summary', preview_content='Preview', full_content='Full report',
+            )
+            for i in range(3)
+        ]
+        self.client.force_login(self.user)
+
+    def test_batch_returns_requested_analyses_in_one_query(self):
+        ids = [self.analyses[2].id, self.analyses[0].id, 999999]
+        url = '/api/analyses/?ids=' + ','.join(map(str, ids))
+        self.client.get(url, secure=True)  # warm the session and auth lookups
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, secure=True)
+        data = response.json()
+        self.assertEqual([item['id'] for item in data['analyses']], ids[:2])
+        self.assertEqual(data['missing'], [999999])
+        self.assertEqual(
+            sum('dashboard_cryptoanalysis' in query['sql'] for query in queries.captured_queries), 1
+        )
+
+    def test_sparse_fieldset(self):
+        response = self.client.get(f'/api/analyses/?ids={self.analyses[0].id}&fields=id,price', secure=True)
+        self.assertEqual(response.json()['analyses'], [{'id': self.analyses[0].id, 'price': 10.0}])
+        response = self.client.get(f'/api/analyses/?ids={self.analyses[0].id}&fields=full_content', secure=True)
+        self.assertEqual(response.status_code, 400)
+
+    def test_large_batches_stream(self):
+        ids = [analysis.id for analysis in self.analyses] + list(range(100000, 100060))
+        response = self.client.get('/api/analyses/?ids=' + ','.join(map(str, ids)), secure=True)
+        self.assertTrue(response.streaming)
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(data['analyses']), 3)
+        self.assertEqual(len(data['missing']), 60)
+
+    def test_streamed_batches_keep_request_order(self):
+        first, second, third = (analysis.id for analysis in self.analyses)
+        ids = [third] + list(range(100000, 100060)) + [first, 100060, second]
+        response = self.client.get('/api/analyses/?ids=' + ','.join(map(str, ids)), secure=True)
+        self.assertTrue(response.streaming)
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([item['id'] for item in data['analyses']], [third, first, second])
+        self.assertEqual(data['missing'], list(range(100000, 100061)))
+
+    def test_single_endpoint_matches_batch_item(self):
+        analysis_id = self.analyses[1].id
+        single = self.client.get(f'/api/analysis/{analysis_id}/', secure=True).json()
+        batch = self.client.get(f'/api/analyses/?ids={analysis_id}', secure=True).json()
+        self.assertEqual(single, batch['analyses'][0])
+        self.assertEqual(self.client.get('/api/analysis/999999/', secure=True).status_code, 404)
+
+
+class RecommendationTests(TestCase):
+    def setUp(self):
+        analyst = Analyst.objects.create(user=User.objects.create_user('analyst'))
+
+        def make(symbol, analysis_type='technical'):
+            return CryptoAnalysis.objects.create(
+                title=symbol, cryptocurrency=symbol, symbol=symbol, analyst=analyst,
+                analysis_type=analysis_type, timeframe='short_term', risk_level='low',
+                price=Decimal('10.00'), description='Description',
+                executive_summary='Summary', preview_content='Preview', full_content='Full report',
+            )
+        self.btc, self.eth, self.sol, self.btc_fund = make('BTC'), make('ETH'), make('SOL'), make('BTC', 'fundamental')
+        self.users = [User.objects.create_user(f'buyer{i}') for i in range(3)]
+
+    def purchase(self, user, analysis):
+        with self.captureOnCommitCallbacks(execute=True):
+            PurchasedAnalysis.objects.create(user=user, analysis=analysis, purchase_price=Decimal('10.00'))
+
+    def test_incremental_updates_match_full_build(self):
+        from .recommendations import build_recommendations, get_similar_analysis_ids
+
+        for user in self.users:
+            self.purchase(user, self.btc)
+            self.purchase(user, self.eth)
+        self.purchase(self.users[0], self.sol)
+
+        incremental = {row.pk: row.neighbor_ids for row in AnalysisNeighbors.objects.all()}
+        self.assertEqual(incremental[self.btc.id][0], self.eth.id)
+        self.assertIn(self.btc_fund.id, incremental[self.btc.id])
+
+        build_recommendations()
+        rebuilt = {row.pk: row.neighbor_ids for row in AnalysisNeighbors.objects.all()}
+        for pk in (self.btc.id, self.eth.id, self.sol.id):
+            self.assertEqual(incremental[pk], rebuilt[pk])
+        self.assertEqual(get_similar_analysis_ids(self.btc.id), rebuilt[self.btc.id])
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class RankingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'password')
+        self.analyst = Analyst.objects.create(user=User.objects.create_user('analyst'))
+        self.analyses = [
+            CryptoAnalysis.objects.create(
+                title=f'Analysis {i}', cryptocurrency='Bitcoin', symbol='BTC', analyst=self.analyst,
+                analysis_type='technical', timeframe='short_term', risk_level='low',
+                price=Decimal('10.00'), description='Description',
+                executive_summary='Summary', preview_content='Preview', full_content='Full report',
+            )
+            for i in range(5)
+        ]
+        # Analysis i is bought by i users
+        for i, analysis in enumerate(self.analyses):
+            for buyer in range(i):
+                with self.captureOnCommitCallbacks(execute=True):
+                    PurchasedAnalysis.objects.create(
+                        user=User.objects.get_or_create(username=f'buyer{buyer}')[0],
+                        analysis=analysis, purchase_price=Decimal('10.00'),
+                    )
+        self.client.force_login(self.user)
+
+    def ranking_state(self):
+        return (
+            sorted(AnalysisRanking.objects.values_list('analysis_id', 'window', 'sales_count', 'revenue')),
+            list(AnalystRanking.objects.values_list('analyst_id', 'total_sales', 'revenue')),
+        )
+
+    def test_incremental_counters_match_refresh(self):
+        from .rankings import refresh_rankings
+
+        incremental = self.ranking_state()
+        self.assertEqual(AnalystRanking.objects.get(analyst=self.analyst).total_sales, 10)
+        refresh_rankings()
+        self.assertEqual(self.ranking_state(), incremental)
+
+    def test_best_selling_keyset_pages(self):
+        from .rankings import sorted_page
+
+        queryset = CryptoAnalysis.objects.filter(is_active=True)
+        first, cursor = sorted_page(queryset, 'best_selling', 'all', page_size=2)
+        self.assertEqual(first, [self.analyses[4], self.analyses[3]])
+        second, cursor = sorted_page(queryset, 'best_selling', 'all', cursor, page_size=2)
+        self.assertEqual(second, [self.analyses[2], self.analyses[1]])
+        third, cursor = sorted_page(queryset, 'best_selling', 'all', cursor, page_size=2)
+        self.assertEqual(third, [self.analyses[0]])
+        self.assertIsNone(cursor)
+
+    def test_windowed_pages_walk_the_ranking_index(self):
+        from django.db import connection
+
+        from .rankings import MARKETPLACE_SORTS, sorted_page
+
+        self.assertEqual(AnalysisRanking.objects.count(), len(self.analyses) * len(AnalysisRanking.WINDOW_DAYS))
+        queryset = CryptoAnalysis.objects.filter(is_active=True)
+        for sort, order in MARKETPLACE_SORTS.items():
+            if not order.windowed:
+                continue
+            with CaptureQueriesContext(connection) as queries:
+                sorted_page(queryset, sort, '30d', f'1|{self.analyses[1].pk}', page_size=2)
+            ranking_sql = next(q['sql'] for q in queries.captured_queries if 'dashboard_analysisranking' in q['sql'])
+            self.assertNotIn('COALESCE', ranking_sql)
+            with connection.cursor() as c:
+                c.execute(f'EXPLAIN QUERY PLAN {ranking_sql}')
+                plan = ' '.join(str(row) for row in c.fetchall())
+            self.assertIn(f'ranking_{order.field.split("_")[0]}_idx', plan, sort)
+            self.assertNotIn('TEMP B-TREE', plan, sort)
+
+    def test_marketplace_sort_renders(self):
+        response = self.client.get('/marketplace/?sort=top_revenue&window=7d', secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['analyses'][0], self.analyses[4])
+
+
+class RatingAggregationTests(TestCase):
+    def setUp(self):
+        self.analyst = Analyst.objects.create(user=User.objects.create_user('analyst'))
+        self.analyses = [
+            CryptoAnalysis.objects.create(
+                title=f'Analysis {i}', cryptocurrency='Bitcoin', symbol='BTC', analyst=self.analyst,
+                analysis_type='technical', timeframe='short_term', risk_level='low',
+                price=Decimal('10.00'), description='Description',
+                executive_summary='Summary', preview_content='Preview', full_content='Full report',
+            )
+            for i in range(2)
+        ]
+        self.users = [User.objects.create_user(f'rater{i}') for i in range(3)]
+
+    def totals(self, model, pk):
+        obj = model.objects.get(pk=pk)
+        return obj.rating_sum, obj.rating_count, Decimal(str(obj.rating))
+
+    def test_create_update_delete_keep_totals(self):
+        first, second = self.analyses
+        AnalysisRating.objects.create(analysis=first, user=self.users[0], rating=5)
+        rating = AnalysisRating.objects.create(analysis=first, user=self.users[1], rating=2)
+        AnalysisRating.objects.create(analysis=second, user=self.users[2], rating=4)
+        self.assertEqual(self.totals(CryptoAnalysis, first.pk), (7, 2, Decimal('3.5')))
+        self.assertEqual(self.totals(Analyst, self.analyst.pk), (11, 3, Decimal('3.67')))
+
+        rating = AnalysisRating.objects.get(pk=rating.pk)
+        rating.rating = 3
+        rating.save()
+        self.assertEqual(self.totals(CryptoAnalysis, first.pk), (8, 2, Decimal('4')))
+
+        rating.analysis = second
+        rating.save()
+        self.assertEqual(self.totals(CryptoAnalysis, first.pk), (5, 1, Decimal('5')))
+        self.assertEqual(self.totals(CryptoAnalysis, second.pk), (7, 2, Decimal('3.5')))
+
+        rating.delete()
+        self.assertEqual(self.totals(CryptoAnalysis, second.pk), (4, 1, Decimal('4')))
+        self.assertEqual(self.totals(Analyst, self.analyst.pk), (9, 2, Decimal('4.5')))
+        stats = UserStats.for_user(self.users[1])
+        self.assertEqual((stats.ratings_given, stats.rating_given_total), (0, 0))
+        self.assertEqual(UserStats.for_user(self.users[0]).average_rating_given, Decimal('5'))
+
+    def test_deleting_a_rater_retracts_their_ratings(self):
+        first, second = self.analyses
+        rater = self.users[0]
+        AnalysisRating.objects.create(analysis=first, user=rater, rating=5)
+        AnalysisRating.objects.create(analysis=second, user=rater, rating=3)
+        AnalysisRating.objects.create(analysis=first, user=self.users[1], rating=2)
+        self.assertEqual(UserStats.for_user(rater).ratings_given, 2)
+
+        rater.delete()
+        self.assertFalse(UserStats.objects.filter(user_id=rater.pk).exists())
+        self.assertEqual(self.totals(CryptoAnalysis, first.pk), (2, 1, Decimal('2')))
+        self.assertEqual(self.totals(CryptoAnalysis, second.pk), (0, 0, Decimal('0')))
+        self.assertEqual(self.totals(Analyst, self.analyst.pk), (2, 1, Decimal('2')))
+
+    def test_reconcile_repairs_drift(self):
+        from .ratings import reconcile_ratings
+
+        first, second = self.analyses
+        AnalysisRating.objects.create(analysis=first, user=self.users[0], rating=4)
+        AnalysisRating.objects.create(analysis=first, user=self.users[1], rating=1)
+        CryptoAnalysis.objects.filter(pk=first.pk).update(rating_sum=9, rating_count=1, rating=9)
+        Analyst.objects.filter(pk=self.analyst.pk).update(rating_count=7)
+
+        self.assertEqual(reconcile_ratings(), (1, 1))
+        self.assertEqual(self.totals(CryptoAnalysis, first.pk), (5, 2, Decimal('2.5')))
+        self.assertEqual(self.totals(CryptoAnalysis, second.pk), (0, 0, Decimal('0')))
+        self.assertEqual(self.totals(Analyst, self.analyst.pk), (5, 2, Decimal('2.5')))
+        self.assertEqual(reconcile_ratings(), (0, 0))
+
+    def test_reconcile_repairs_a_drifted_mean(self):
+        from .ratings import reconcile_ratings
+
+        first, second = self.analyses
+        for user, rating in zip(self.users, (5, 4, 4)):
+            AnalysisRating.objects.create(analysis=first, user=user, rating=rating)
+        # Totals are right, only the stored means are off
+        CryptoAnalysis.objects.filter(pk=first.pk).update(rating=Decimal('1.00'))
+        CryptoAnalysis.objects.filter(pk=second.pk).update(rating=Decimal('4.50'))
+
+        self.assertEqual(reconcile_ratings(), (2, 0))
+        self.assertEqual(self.totals(CryptoAnalysis, first.pk), (13, 3, Decimal('4.33')))
+        self.assertEqual(self.totals(CryptoAnalysis, second.pk), (0, 0, Decimal('0')))
+        self.assertEqual(reconcile_ratings(), (0, 0))
+
+    def test_backfill_sets_the_mean(self):
+        from importlib import import_module
+
+        from django.apps import apps
+
+        first, second = self.analyses
+        for user, rating in zip(self.users, (5, 4, 4)):
+            AnalysisRating.objects.create(analysis=first, user=user, rating=rating)
+        CryptoAnalysis.objects.update(rating_sum=0, rating_count=0, rating=Decimal('4.80'))
+
+        import_module('dashboard.migrations.0019_rating_totals').backfill_rating_totals(apps, None)
+        self.assertEqual(self.totals(CryptoAnalysis, first.pk), (13, 3, Decimal('4.33')))
+        self.assertEqual(self.totals(CryptoAnalysis, second.pk), (0, 0, Decimal('0')))
+        self.assertEqual(self.totals(Analyst, self.analyst.pk), (13, 3, Decimal('4.33')))
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class DailyRollupTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer')
+        self.analyst = Analyst.objects.create(user=User.objects.create_user('analyst'))
+        self.analysis = CryptoAnalysis.objects.create(
+            title='Analysis', cryptocurrency='Bitcoin', symbol='BTC', analyst=self.analyst,
+            analysis_type='technical', timeframe='short_term', risk_level='low',
+            price=Decimal('10.00'), description='Description',
+            executive_summary='Summary', preview_content='Preview', full_content='Full report',
+        )
+
+    def transaction(self, **kwargs):
+        fields = {'user': self.user, 'amount': Decimal('10.00'), 'transaction_type': 'purchase',
+                  'payment_method': 'wallet', 'status': 'completed', 'analysis': self.analysis}
+        fields.update(kwargs)
+        return Transaction.objects.create(**fields)
+
+    def rollup_state(self):
+        return sorted(
+            (row['date'], row['transaction_type'], row['payment_method'], row['analysis'], row['analyst'],
+             row['count'], row['amount'])
+            for row in DailyRollup.objects.values(
+                'date', 'transaction_type', 'payment_method', 'analysis', 'analyst',
+            ).annotate(count=Sum('count'), amount=Sum('amount')).filter(count__gt=0)
+        )
+
+    def test_incremental_rollups_match_backfill(self):
+        from .rollups import backfill_rollups
+
+        self.transaction()
+        self.transaction(amount=Decimal('15.00'))
+        self.transaction(transaction_type='deposit', payment_method='mpesa', amount=Decimal('50.00'), analysis=None)
+        pending = self.transaction(payment_method='mpesa', status='pending')
+        self.transaction(status='failed')
+        refunded = self.transaction(amount=Decimal('7.00'))
+
+        pending = Transaction.objects.get(pk=pending.pk)
+        pending.status = 'completed'
+        pending.save()
+        refunded = Transaction.objects.get(pk=refunded.pk)
+        refunded.status = 'cancelled'
+        refunded.save()
+
+        incremental = self.rollup_state()
+        self.assertEqual(CryptoAnalysis.objects.get(pk=self.analysis.pk).total_revenue, Decimal('35.00'))
+        purchases = [row for row in incremental if row[1] == 'purchase']
+        self.assertEqual(sum(row[5] for row in purchases), 3)
+        self.assertTrue(all(row[4] == self.analyst.pk for row in purchases))
+
+        CryptoAnalysis.objects.filter(pk=self.analysis.pk).update(total_revenue=0)
+        backfill_rollups(chunk_days=1)
+        self.assertEqual(self.rollup_state(), incremental)
+        self.assertEqual(CryptoAnalysis.objects.get(pk=self.analysis.pk).total_revenue, Decimal('35.00'))
+
+    def test_delete_retracts(self):
+        transaction = self.transaction()
+        Transaction.objects.get(pk=transaction.pk).delete()
+        self.assertEqual(self.rollup_state(), [])
+        self.assertEqual(CryptoAnalysis.objects.get(pk=self.analysis.pk).total_revenue, Decimal('0.00'))
+
+    def test_admin_report_and_csv(self):
+        self.transaction()
+        self.transaction(transaction_type='deposit', payment_method='mpesa', amount=Decimal('50.00'), analysis=None)
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin)
+
+        response = self.client.get('/admin/dashboard/dailyrollup/report/?group=payment_method', secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total_amount'], Decimal('60.00'))
+
+        response = self.client.get('/admin/dashboard/dailyrollup/report/?group=analyst&type=purchase&format=csv', secure=True)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response.content.decode().splitlines(), ['analyst,count,amount', 'analyst,1,10.00'])
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class AdminChangelistQueryTests(TestCase):
+    """Changelist query counts must not grow with the number of rows shown"""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(self.admin)
+
+    def add_rows(self, i):
+        user = User.objects.create_user(f'user{i}')
+        analyst = Analyst.objects.create(user=User.objects.create_user(f'analyst{i}'), bio='Bio')
+        analysis = CryptoAnalysis.objects.create(
+            title=f'Analysis {i}', cryptocurrency='Bitcoin', symbol='BTC', analyst=analyst,
+            analysis_type='technical', timeframe='short_term', risk_level='low',
+            price=Decimal('10.00'), description='Description', executive_summary='Summary',
+            preview_content='Preview', full_content='Full report', chart_data={'prices': [1, 2, 3]} if i % 2 else {},
+        )
+        ChartAnnotation.objects.create(analysis=analysis, type='support', description='Floor')
+        TechnicalIndicatorData.objects.create(analysis=analysis, indicator_type='rsi', parameters={'period': 14})
+        AnalysisInsight.objects.create(analysis=analysis, title='Insight', description='Details')
+        AnalysisMetric.objects.create(analysis=analysis, name='RSI', current_value=50, previous_value=40, change=10)
+        PurchasedAnalysis.objects.create(user=user, analysis=analysis, purchase_price=Decimal('10.00'))
+        AnalysisRating.objects.create(analysis=analysis, user=user, rating=4, review='Good' if i % 2 else '')
+        Transaction.objects.create(user=user, amount=Decimal('10.00'), transaction_type='purchase',
+                                   payment_method='wallet', status='completed', analysis=analysis)
+        MpesaTransaction.objects.create(user=user, transaction_type='deposit', amount=Decimal('100.00'),
+                                        phone_number='254700000000')
+        MarketInsight.objects.create(title=f'Insight {i}', summary='Summary', full_content='Full')
+        ConsultationPackage.objects.create(title=f'Package {i}', description='Description',
+                                           price=Decimal('50.00'), features='One\nTwo')
+        consultation = Consultation.objects.create(
+            user=user, title=f'Session {i}', scheduled_date=timezone.now() + timezone.timedelta(days=2),
+        )
+        ConsultationAttachment.objects.create(consultation=consultation, file='notes.pdf', file_name='notes.pdf',
+                                              file_type='pdf', uploaded_by=user)
+        SiteSetting.objects.create(name=f'Setting {i}', is_active=False)
+        Category.objects.create(name=f'Category {i}')
+        UserStats.for_user(user)
+
+    def changelist_queries(self):
+        from django.contrib import admin
+
+        counts = {}
+        for model, model_admin in admin.site._registry.items():
+            url = f'/admin/{model._meta.app_label}/{model._meta.model_name}/'
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, secure=True)
+            self.assertEqual(response.status_code, 200, url)
+            counts[url] = len(queries)
+        return counts
+
+    def test_changelist_query_counts_are_constant(self):
+        from .recommendations import build_recommendations
+        from .rollups import backfill_rollups
+
+        for i in range(2):
+            self.add_rows(i)
+        build_recommendations()
+        backfill_rollups()
+        few = self.changelist_queries()
+
+        for i in range(2, 7):
+            self.add_rows(i)
+        build_recommendations()
+        backfill_rollups()
+        self.maxDiff = None
+        self.assertEqual(self.changelist_queries(), few)
+
+    def test_chart_flag_matches_property(self):
+        for i in range(2):
+            self.add_rows(i)
+        bare = CryptoAnalysis.objects.create(
+            title='Bare', cryptocurrency='Ether', symbol='ETH', analyst=Analyst.objects.first(),
+            analysis_type='technical', timeframe='short_term', risk_level='low', description='Description',
+            executive_summary='Summary', preview_content='Preview', full_content='Full report',
+        )
+        flags = dict(CryptoAnalysis.objects.with_chart_flag().values_list('pk', 'has_charts_flag'))
+        expected = {analysis.pk: analysis.has_interactive_charts for analysis in CryptoAnalysis.objects.all()}
+        self.assertEqual(flags, expected)
+        self.assertFalse(flags[bare.pk])
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class LedgerExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('payer')
+        self.transactions = [
+            Transaction.objects.create(
+                user=self.user, amount=Decimal(f'{i}.25'), transaction_type='deposit', payment_method='mpesa',
+                status='completed' if i % 2 else 'pending', description=f'Deposit "{i}", ü' if i % 3 else '',
+                reference=None if i % 2 else f'REF{i}',
+            )
+            for i in range(7)
+        ]
+
+    def test_csv_and_dxcol_round_trip(self):
+        import csv
+        import io
+
+        from .exports import read_dxcol, stream_csv, stream_dxcol
+
+        queryset = Transaction.objects.order_by('pk')
+        chunks = list(stream_csv(queryset, chunk_size=3))
+        self.assertEqual(len(chunks), 3)
+        rows = list(csv.DictReader(io.StringIO(b''.join(chunks).decode('utf-8'))))
+        self.assertEqual([row['amount'] for row in rows], [str(t.amount) for t in self.transactions])
+        self.assertEqual(rows[1]['description'], 'Deposit "1", ü')
+
+        exported = list(read_dxcol(io.BytesIO(b''.join(stream_dxcol(queryset, chunk_size=3)))))
+        self.assertEqual(len(exported), 7)
+        for row, transaction in zip(exported, self.transactions):
+            self.assertEqual(row['amount'], transaction.amount)
+            self.assertEqual(row['created_at'], transaction.created_at)
+            self.assertEqual(row['transaction_id'], str(transaction.transaction_id))
+            self.assertEqual(row['reference'], transaction.reference)
+            self.assertEqual(row['description'], transaction.description)
+            self.assertIsNone(row['analysis_id'])
+
+    def test_admin_action_exports_filtered_changelist(self):
+        from django.contrib.admin import helpers
+
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.post('/admin/dashboard/transaction/?status__exact=completed', {
+            'action': 'export_csv',
+            helpers.ACTION_CHECKBOX_NAME: [self.transactions[0].pk],
+            'select_across': '1',
+        }, secure=True)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 1 + 3)
+
+    def test_export_command_writes_file(self):
+        import io
+        import tempfile
+        from pathlib import Path
+
+        from django.core.management import call_command
+
+        from .exports import read_dxcol
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'ledger.dxcol'
+            out = io.StringIO()
+            call_command('export_ledger', 'transactions', format='dxcol', output=str(path),
+                         status=['pending'], chunk_size=2, stdout=out)
+            with path.open('rb') as handle:
+                rows = list(read_dxcol(handle))
+        self.assertEqual(len(rows), 4)
+        self.assertIn('Exported 4 rows', out.getvalue())
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ContentImportTests(TestCase):
+    def setUp(self):
+        self.analyst = Analyst.objects.create(user=User.objects.create_user('jane'))
+
+    def analysis_record(self, i, **overrides):
+        record = {
+            'type': 'analysis', 'analyst': 'jane', 'title': f'Analysis {i}', 'cryptocurrency': 'Bitcoin',
+            'symbol': 'BTC', 'analysis_type': 'technical', 'timeframe': 'short_term', 'risk_level': 'low',
+            'price': '12.50', 'description': 'Description', 'executive_summary': 'Summary',
+            'preview_content': 'Preview', 'full_content': 'Full report',
+            'chart_data': {'prices': [1, 2, 3]},
+            'chart_annotations': [{'type': 'support', 'price_level': '25000.5', 'description': 'Floor'}],
+            'metrics': [{'name': 'RSI', 'current_value': '55', 'previous_value': '50', 'change': '+5'}],
+            'insights': [{'title': 'Breakout', 'description': 'Above range'}],
+        }
+        record.update(overrides)
+        return record
+
+    def bundle(self, records):
+        import io
+
+        return io.BytesIO(''.join(json.dumps(record) + '\n' for record in records).encode('utf-8'))
+
+    def test_zip_bundle_imports_parents_and_children(self):
+        import io
+        import zipfile
+
+        from .imports import import_bundle
+
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as bundle:
+            bundle.writestr('a.jsonl', self.bundle([self.analysis_record(i) for i in range(5)]).getvalue())
+            bundle.writestr('b.jsonl', self.bundle([
+                {'type': 'insight', 'title': 'ETF news', 'summary': 'Summary', 'full_content': 'Full',
+                 'verified_by': 'jane'},
+            ]).getvalue())
+        result = import_bundle(archive, 'content.zip', batch_size=2)
+
+        self.assertEqual((result.analyses, result.insights), (5, 1))
+        self.assertEqual(result.children['chart_annotations'], 5)
+        self.assertEqual(ChartAnnotation.objects.filter(analysis__analyst=self.analyst).count(), 5)
+        self.assertEqual(AnalysisInsight.objects.count(), 5)
+        self.assertEqual(MarketInsight.objects.get().verified_by, self.analyst)
+        self.assertEqual(AnalysisRanking.objects.filter(window='all').count(), 5)
+
+    def test_invalid_record_rejects_whole_bundle(self):
+        from .imports import ContentImportError, import_bundle
+
+        records = [self.analysis_record(i) for i in range(4)]
+        records.append(self.analysis_record(4, analyst='nobody', risk_level='extreme'))
+        records.append(self.analysis_record(5, metrics=[{'name': 'RSI'}], colour='red'))
+        with self.assertRaises(ContentImportError) as caught:
+            import_bundle(self.bundle(records), batch_size=2)
+
+        locations = [location for location, _ in caught.exception.errors]
+        self.assertEqual(locations, ['bundle:5', 'bundle:5', 'bundle:6', 'bundle:6 metrics[0]'])
+        self.assertIn('colour', caught.exception.errors[2][1])
+        self.assertFalse(CryptoAnalysis.objects.exists())
+        self.assertFalse(ChartAnnotation.objects.exists())
+
+    def test_admin_upload(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        upload = SimpleUploadedFile('content.jsonl', self.bundle([self.analysis_record(1)]).getvalue())
+        response = self.client.post('/admin/dashboard/cryptoanalysis/import/', {'bundle': upload}, secure=True)
+        self.assertRedirects(response, '/admin/dashboard/cryptoanalysis/', fetch_redirect_response=False)
+        self.assertEqual(CryptoAnalysis.objects.get().metrics.count(), 1)
+
+        upload = SimpleUploadedFile('bad.jsonl', b'{"type": "analysis"}\n')
+        response = self.client.post('/admin/dashboard/cryptoanalysis/import/', {'bundle': upload}, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['errors'])
+
+
+@override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+)
+class ReminderDispatchTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now().replace(microsecond=0)
+        self.user = User.objects.create_user('sam', 'sam@example.com')
+        self.consultation = Consultation.objects.create(
+            user=self.user, title='Portfolio review', scheduled_date=self.now + timedelta(days=2),
+        )
+
+    def test_sends_due_reminders_once(self):
+        from django.core import mail
+
+        from .reminders import ReminderDispatcher
+
+        dispatcher = ReminderDispatcher(batch_size=1)
+        due = self.consultation.scheduled_date - timedelta(hours=12)
+        self.assertEqual(dispatcher.dispatch_due(due), (1, 0))
+        self.assertEqual(dispatcher.dispatch_due(due), (0, 0))
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('Portfolio review', mail.outbox[0].subject)
+        self.assertIn(self.consultation.join_url, mail.outbox[0].body)
+        reminder = ConsultationReminder.objects.get(is_sent=True)
+        self.assertEqual(reminder.scheduled_time, self.consultation.scheduled_date - timedelta(hours=24))
+        self.assertIsNotNone(reminder.sent_time)
+        self.assertTrue(Consultation.objects.get().reminder_sent)
+
+    def test_cancelled_consultations_are_skipped(self):
+        from .reminders import ReminderDispatcher
+
+        Consultation.objects.filter(pk=self.consultation.pk).update(status='cancelled')
+        self.assertEqual(ReminderDispatcher().dispatch_due(self.consultation.scheduled_date - timedelta(minutes=5)), (0, 0))
+
+    def test_failed_delivery_is_retried_with_backoff(self):
+        import io
+
+        from .reminders import ConsoleBackend, MAX_ATTEMPTS, RETRY_DELAY, ReminderDispatcher
+
+        class FailingBackend:
+            def send_messages(self, reminders):
+                return {reminder.pk: 'gateway down' for reminder in reminders}
+
+        due = self.consultation.scheduled_date - timedelta(hours=2)
+        self.assertEqual(ReminderDispatcher({'email': FailingBackend()}).dispatch_due(due), (0, 1))
+        reminder = ConsultationReminder.objects.get(attempts=1)
+        self.assertEqual((reminder.last_error, reminder.scheduled_time), ('gateway down', due + RETRY_DELAY))
+        self.assertFalse(reminder.is_sent)
+
+        stream = io.StringIO()
+        dispatcher = ReminderDispatcher({'email': ConsoleBackend(stream)})
+        self.assertEqual(dispatcher.dispatch_due(due + RETRY_DELAY), (1, 0))
+        self.assertIn('[email] to sam@example.com: Reminder: Portfolio review', stream.getvalue())
+
+        ConsultationReminder.objects.update(is_sent=False, attempts=MAX_ATTEMPTS)
+        self.assertEqual(dispatcher.dispatch_due(due + RETRY_DELAY), (0, 0))
+
+    def test_heap_wakes_for_next_due_reminder(self):
+        from .reminders import ReminderDispatcher
+
+        dispatcher = ReminderDispatcher(max_sleep=7200)
+        start = self.consultation.scheduled_date - timedelta(hours=25)
+        dispatcher.refresh(start)
+        self.assertEqual(len(dispatcher.heap), 2)
+        self.assertEqual(dispatcher.seconds_until_next(start), 3600)
+
+        dispatcher.dispatch_due(start + timedelta(hours=1))
+        self.assertEqual(len(dispatcher.heap), 1)
+        self.assertEqual(dispatcher.seconds_until_next(start + timedelta(hours=1)), 7200)
+
+    def test_command_sends_due_reminders(self):
+        from io import StringIO
+
+        from django.core import mail
+        from django.core.management import call_command
+
+        ConsultationReminder.objects.update(scheduled_time=self.now - timedelta(minutes=1))
+        out = StringIO()
+        call_command('dispatch_reminders', '--once', stdout=out)
+        self.assertIn('Sent 2 reminders (0 failed)', out.getvalue())
+        self.assertEqual(len(mail.outbox), 2)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class SchedulingTests(TestCase):
+    WEEK = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+    def setUp(self):
+        from . import scheduling
+
+        scheduling._index = None
+        self.first = self.make_analyst('first', [['09:00', '12:00']])
+        self.second = self.make_analyst('second', [['10:00', '11:00']])
+        self.day = datetime.datetime.combine(
+            timezone.localdate() + timedelta(days=1), datetime.time.min, tzinfo=datetime.timezone.utc,
+        )
+        self.client_user = User.objects.create_user('client')
+
+    def make_analyst(self, username, windows):
+        return Analyst.objects.create(
+            user=User.objects.create_user(username),
+            consultation_hours={'timezone': 'UTC', 'weekly': {day: windows for day in self.WEEK}},
+        )
+
+    def at(self, hour, minute=0):
+        return self.day + timedelta(hours=hour, minutes=minute)
+
+    def slots(self, **kwargs):
+        from .scheduling import AvailabilityIndex
+
+        index = AvailabilityIndex.build()
+        return [(slot.start, slot.analyst_id) for slot in index.free_slots(60, after=self.day, **kwargs)]
+
+    def test_hours_are_validated(self):
+        from django.core.exceptions import ValidationError
+
+        self.first.consultation_hours = {'weekly': {'mon': [['10:00', '09:00']]}}
+        with self.assertRaises(ValidationError):
+            self.first.clean()
+        self.first.consultation_hours = {'timezone': 'Mars/Olympus'}
+        with self.assertRaises(ValidationError):
+            self.first.clean()
+
+    def test_free_slots_skip_bookings(self):
+        from .bookings import allocate_slot
+
+        first, second = self.first.pk, self.second.pk
+        self.assertEqual(self.slots(count=4), [
+            (self.at(9), first), (self.at(9, 30), first), (self.at(10), first), (self.at(10), second),
+        ])
+        consultation = allocate_slot(self.at(9), 60, user=self.client_user, title='Session')
+        self.assertEqual(consultation.analyst, self.first)
+        self.assertEqual(self.slots(count=3), [(self.at(10), first), (self.at(10), second), (self.at(10, 30), first)])
+        self.assertEqual(self.slots(count=1, analyst_id=second), [(self.at(10), second)])
+
+    def test_allocation_never_double_books(self):
+        from .bookings import allocate_slot
+        from .scheduling import SlotUnavailable
+
+        allocate_slot(self.at(10), 60, analyst_id=self.first.pk, user=self.client_user, title='Session')
+        with self.assertRaises(SlotUnavailable):
+            allocate_slot(self.at(10, 30), 60, analyst_id=self.first.pk, user=self.client_user, title='Clash')
+        with self.assertRaises(SlotUnavailable):
+            allocate_slot(self.at(11, 30), 60, analyst_id=self.first.pk, user=self.client_user, title='Too late')
+
+        # Without an analyst the next free one is picked, until nobody is left
+        self.assertEqual(allocate_slot(self.at(10), 60, user=self.client_user, title='Second').analyst, self.second)
+        with self.assertRaises(SlotUnavailable):
+            allocate_slot(self.at(10), 60, user=self.client_user, title='Full')
+        self.assertEqual(Consultation.objects.filter(scheduled_date=self.at(10)).count(), 2)
+
+    def test_sync_picks_up_cancellations(self):
+        from .bookings import allocate_slot
+        from .scheduling import AvailabilityIndex
+
+        consultation = allocate_slot(self.at(10), 60, analyst_id=self.second.pk, user=self.client_user, title='Session')
+        index = AvailabilityIndex.build()
+        self.assertEqual(index.free_analysts(self.at(10), 60), [self.first.pk])
+
+        consultation.status = 'cancelled'
+        consultation.save()
+        index.sync()
+        self.assertEqual(index.free_analysts(self.at(10), 60), [self.first.pk, self.second.pk])
+
+    def test_index_follows_changes_from_other_processes(self):
+        from . import scheduling
+
+        index = scheduling.get_index()
+        self.assertIs(scheduling.get_index(), index)
+        # Another worker edits availability: only the shared token changes here
+        scheduling._bump(scheduling._AVAILABILITY_VERSION_KEY)
+        rebuilt = scheduling.get_index()
+        self.assertIsNot(rebuilt, index)
+
+        # A token lost from the cache reads as a change, never as the old version
+        cache.delete(scheduling._AVAILABILITY_VERSION_KEY)
+        self.assertIsNot(scheduling.get_index(), rebuilt)
+
+    def test_booking_page_allocates_analyst(self):
+        from .models import UserWallet
+
+        package = ConsultationPackage.objects.create(
+            title='Starter', description='Intro', price=Decimal('10.00'), features='Chat', duration_minutes=60,
+        )
+        # Logging in saves the user, and with it the cached wallet, so top up afterwards
+        self.client.force_login(self.client_user)
+        UserWallet.objects.filter(user=self.client_user).update(balance=Decimal('100.00'))
+
+        response = self.client.get('/book_consultation/', secure=True)
+        slots = response.context['consultation_packages'][0]['available_slots']
+        self.assertIn(self.at(10), slots)
+
+        data = {'package_id': package.pk, 'scheduled_date': self.at(11).strftime('%Y-%m-%dT%H:%M')}
+        self.client.post('/book_consultation/', data, secure=True)
+        self.assertEqual(Consultation.objects.get().analyst, self.first)
+
+        self.client.post('/book_consultation/', data, secure=True)
+        self.assertEqual(Consultation.objects.count(), 1)
+        self.assertEqual(UserWallet.objects.get(user=self.client_user).balance, Decimal('90.00'))
+
+
+    def test_dashboard_lists_package_slots(self):
+        ConsultationPackage.objects.create(
+            title='Starter', description='Intro', price=Decimal('10.00'), features='Chat', duration_minutes=60,
+        )
+        self.client.force_login(self.client_user)
+        response = self.client.get('/dashboard/', secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(self.at(10), response.context['consultation_packages'][0]['available_slots'])
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class BookingServiceTests(TestCase):
+    def setUp(self):
+        from . import scheduling
+
+        scheduling._index = None
+        self.user = User.objects.create_user('client')
+        self.analyst = Analyst.objects.create(
+            user=User.objects.create_user('analyst'),
+            consultation_hours={'timezone': 'UTC', 'weekly': {day: [['08:00', '18:00']] for day in SchedulingTests.WEEK}},
+        )
+        self.first = datetime.datetime.combine(
+            timezone.localdate() + timedelta(days=2), datetime.time(9), tzinfo=datetime.timezone.utc,
+        )
+
+    def test_series_takes_constant_queries(self):
+        from .bookings import book_series
+
+        def queries_for(sessions, first):
+            with CaptureQueriesContext(connection) as queries:
+                booked = book_series(first, sessions, 60, analyst_id=self.analyst.pk, user=self.user, title='Coaching')
+            self.assertEqual(len(booked), sessions)
+            return len(queries)
+
+        self.assertEqual(queries_for(2, self.first), queries_for(12, self.first + timedelta(hours=2)))
+        self.assertEqual(Consultation.objects.count(), 14)
+        self.assertEqual(ConsultationReminder.objects.count(), 28)
+        consultation = Consultation.objects.get(scheduled_date=self.first + timedelta(weeks=1))
+        self.assertTrue(consultation.join_url.endswith(consultation.meeting_id))
+        self.assertEqual(
+            sorted(consultation.consultationreminder_set.values_list('scheduled_time', flat=True)),
+            [consultation.scheduled_date - timedelta(hours=24), consultation.scheduled_date - timedelta(hours=1)],
+        )
+
+    def test_clash_anywhere_in_series_books_nothing(self):
+        from .bookings import allocate_slot, book_series
+        from .scheduling import SlotUnavailable
+
+        allocate_slot(self.first + timedelta(weeks=1, minutes=30), 60, user=self.user, title='Existing')
+        book_series(self.first, 3, 60, every=timedelta(weeks=3), user=self.user, title='Beyond the index')
+        with self.assertRaises(SlotUnavailable):
+            book_series(self.first, 4, 60, user=self.user, title='Coaching')
+        with self.assertRaises(SlotUnavailable):
+            book_series(self.first + timedelta(days=1), 2, 60, every=timedelta(minutes=30), user=self.user, title='Overlapping')
+        self.assertEqual(Consultation.objects.count(), 4)
+
+    def test_signal_fallback_still_prepares_other_creations(self):
+        consultation = Consultation.objects.create(user=self.user, title='Manual', scheduled_date=self.first)
+        consultation.refresh_from_db()
+        self.assertTrue(consultation.meeting_id.startswith('CONS'))
+        self.assertEqual(consultation.meeting_link, consultation.join_url)
+        self.assertEqual(consultation.consultationreminder_set.count(), 2)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class LifecycleSweepTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('client')
+        self.now = timezone.now()
+
+    def consultation(self, starts_in, status='scheduled', **fields):
+        consultation = Consultation.objects.create(
+            user=self.user, title='Session', scheduled_date=self.now + starts_in, duration_minutes=60, **fields,
+        )
+        Consultation.objects.filter(pk=consultation.pk).update(status=status)
+        return consultation
+
+    def test_overdue_consultations_are_closed(self):
+        from .lifecycle import sweep
+
+        missed = self.consultation(timedelta(hours=-3))
+        finished = self.consultation(timedelta(hours=-2), status='in_progress')
+        in_grace = self.consultation(timedelta(minutes=-70))
+        upcoming = self.consultation(timedelta(hours=2))
+        cancelled = self.consultation(timedelta(hours=-5), status='cancelled')
+        self.assertEqual(missed.ends_at, missed.scheduled_date + timedelta(hours=1))
+
+        with self.assertNumQueries(6):
+            result = sweep(self.now)
+        self.assertEqual(result, (1, 1, 0))
+        statuses = dict(Consultation.objects.values_list('pk', 'status'))
+        self.assertEqual(
+            [statuses[c.pk] for c in (missed, finished, in_grace, upcoming, cancelled)],
+            ['no_show', 'completed', 'scheduled', 'scheduled', 'cancelled'],
+        )
+        self.assertEqual(Consultation.objects.get(pk=finished.pk).session_ended, finished.ends_at)
+        self.assertEqual(sweep(self.now), (0, 0, 0))
+
+    def test_rescheduling_moves_ends_at(self):
+        consultation = self.consultation(timedelta(hours=1))
+        consultation.scheduled_date += timedelta(days=1)
+        consultation.save(update_fields=['scheduled_date'])
+        self.assertEqual(Consultation.objects.get().ends_at, consultation.scheduled_date + timedelta(hours=1))
+
+    def test_expired_access_is_flagged(self):
+        from io import StringIO
+
+        from django.core.management import call_command
+
+        analyst = Analyst.objects.create(user=User.objects.create_user('analyst'))
+        analyses = [CryptoAnalysis.objects.create(analyst=analyst, title=f'A{i}', price=5) for i in range(2)]
+        expired, active = [
+            PurchasedAnalysis.objects.create(user=self.user, analysis=analysis, purchase_price=5) for analysis in analyses
+        ]
+        PurchasedAnalysis.objects.filter(pk=expired.pk).update(access_expires=self.now - timedelta(days=1))
+
+        out = StringIO()
+        call_command('sweep_lifecycle', stdout=out)
+        self.assertIn('1 expired purchases', out.getvalue())
+        self.assertEqual(list(PurchasedAnalysis.objects.filter(access_expired=True)), [expired])
+
+        # Extending access through save() clears the flag again
+        expired.refresh_from_db()
+        expired.access_expires = self.now + timedelta(days=30)
+        expired.save(update_fields=['access_expires'])
+        self.assertFalse(PurchasedAnalysis.objects.filter(access_expired=True).exists())
+
+
+@override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+    IMAGE_DERIVATIVE_WORKERS=0,
+)
+class ImageDerivativeTests(TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.media_root = media_root
+        self.user = User.objects.create_user('pictured', password='pw')
+
+    def upload(self, size, mode='RGB', name='me.jpg'):
+        from io import BytesIO
+
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from PIL import Image
+
+        buffer = BytesIO()
+        Image.new(mode, size, (200, 30, 30, 128) if mode == 'RGBA' else (200, 30, 30)).save(
+            buffer, 'PNG' if mode == 'RGBA' else 'JPEG',
+        )
+        return SimpleUploadedFile(name, buffer.getvalue())
+
+    def stored(self, name):
+        from django.core.files.storage import default_storage
+
+        return default_storage.exists(name)
+
+    def test_upload_generates_derivatives_after_commit(self):
+        from PIL import Image
+
+        from .images import derivative_name
+
+        profile = self.user.userprofile
+        profile.profile_picture = self.upload((300, 200))
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.save()
+        profile.refresh_from_db()
+
+        name = profile.profile_picture.name
+        self.assertEqual(profile.profile_picture_variants, {'source': name, 'widths': [64, 128], 'fallback': 'jpg'})
+        for width in (64, 128):
+            for extension in ('webp', 'jpg'):
+                self.assertTrue(self.stored(derivative_name(name, width, extension)))
+        with Image.open(profile.profile_picture.storage.path(derivative_name(name, 128, 'webp'))) as image:
+            self.assertEqual(image.size, (128, 128))
+
+        storage = profile.profile_picture.storage
+        self.assertIn(f"{storage.url(derivative_name(name, 64, 'jpg'))} 64w", profile.profile_picture_srcset)
+        self.assertEqual(profile.profile_picture_thumbnail_url, storage.url(derivative_name(name, 64, 'jpg')))
+
+        # Saving other fields does not regenerate anything
+        with self.captureOnCommitCallbacks() as callbacks:
+            profile.phone_number = '0700000000'
+            profile.save()
+        self.assertEqual(callbacks, [])
+
+    def test_replaced_image_falls_back_to_original_and_drops_old_files(self):
+        from .images import derivative_name
+
+        profile = self.user.userprofile
+        profile.profile_picture = self.upload((300, 300))
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.save()
+        old_name = profile.profile_picture.name
+
+        profile.profile_picture = self.upload((300, 300), 'RGBA', 'me.png')
+        with self.captureOnCommitCallbacks() as callbacks:
+            profile.save()
+        # Until the worker runs, the stale record is ignored
+        self.assertEqual(profile.profile_picture_srcset, '')
+        self.assertEqual(profile.profile_picture_thumbnail_url, profile.profile_picture.url)
+        for callback in callbacks:
+            callback()
+
+        profile.refresh_from_db()
+        self.assertEqual(profile.profile_picture_variants['fallback'], 'png')
+        self.assertEqual(profile.profile_picture_variants['widths'], [64, 128, 256])
+        self.assertFalse(self.stored(derivative_name(old_name, 64, 'jpg')))
+        self.assertTrue(self.stored(derivative_name(profile.profile_picture.name, 256, 'png')))
+
+    def test_responsive_image_tag(self):
+        from django.template import Context, Template
+
+        template = Template('{% load dashboard_images %}{% responsive_image picture sizes="100px" alt="Me" %}')
+        profile = self.user.userprofile
+        self.assertEqual(template.render(Context({'picture': profile.profile_picture})), '')
+
+        profile.profile_picture = self.upload((100, 100))
+        profile.save()
+        html = template.render(Context({'picture': profile.profile_picture}))
+        self.assertNotIn('<picture>', html)
+        self.assertIn(profile.profile_picture.url, html)
+
+        from .images import derivative_name, generate_derivatives
+        generate_derivatives('dashboard.UserProfile', profile.pk, 'profile_picture')
+        profile.refresh_from_db()
+        html = template.render(Context({'picture': profile.profile_picture}))
+        webp_url = profile.profile_picture.storage.url(derivative_name(profile.profile_picture.name, 64, 'webp'))
+        self.assertIn(f'<source type="image/webp" srcset="{webp_url} 64w"', html)
+        self.assertIn('sizes="100px"', html)
+
+    def test_regenerate_command(self):
+        from io import StringIO
+
+        from django.core.management import call_command
+
+        analyst = Analyst.objects.create(user=User.objects.create_user('analyst'))
+        analysis = CryptoAnalysis.objects.create(analyst=analyst, title='Charted', price=5)
+        CryptoAnalysis.objects.filter(pk=analysis.pk).update(chart_image='')
+        analysis.chart_image = self.upload((1000, 500), name='chart.jpg')
+        with self.captureOnCommitCallbacks():
+            analysis.save()
+        self.assertEqual(CryptoAnalysis.objects.get(pk=analysis.pk).chart_image_variants, {})
+
+        out = StringIO()
+        call_command('regenerate_images', '--workers', '0', '--missing-only', stdout=out)
+        self.assertIn('Regenerated 1 of 1 images (4 files)', out.getvalue())
+        analysis.refresh_from_db()
+        self.assertEqual(analysis.chart_image_variants['widths'], [480, 960])
+        from .images import derivative_name
+        webp_url = analysis.chart_image.storage.url(derivative_name(analysis.chart_image.name, 960, 'webp'))
+        self.assertIn(f'{webp_url} 960w', analysis.chart_image_webp_srcset)
+
+        out = StringIO()
+        call_command('regenerate_images', '--workers', '0', '--missing-only', stdout=out)
+        self.assertIn('Regenerated 0 of 0 images', out.getvalue())
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ContentAddressedStorageTests(TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+
+        from django.core.files.storage import default_storage
+
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.media_root = media_root
+        self.storage = default_storage
+        cache.clear()
+
+    def blob_files(self):
+        import os
+
+        return sorted(
+            os.path.relpath(os.path.join(directory, name), self.media_root)
+            for directory, _, names in os.walk(os.path.join(self.media_root, 'blobs'))
+            for name in names
+        )
+
+    def test_identical_uploads_share_one_blob(self):
+        from django.core.files.base import ContentFile
+
+        first = self.storage.save('analysis_charts/usd-coin.png', ContentFile(b'coin' * 1000))
+        second = self.storage.save('analysis_charts/usd-coin.png', ContentFile(b'coin' * 1000))
+        other = self.storage.save('analysis_charts/btc.png', ContentFile(b'btc'))
+
+        self.assertEqual(first, 'analysis_charts/usd-coin.png')
+        self.assertNotEqual(second, first)
+        self.assertEqual(len(self.blob_files()), 2)
+        self.assertEqual(MediaBlob.objects.get(files__name=first).ref_count, 2)
+        self.assertEqual(self.storage.url(first), self.storage.url(second))
+        self.assertTrue(self.storage.url(first).startswith('/media/blobs/'))
+        self.assertTrue(self.storage.url(first).endswith('.png'))
+        with self.storage.open(second) as handle:
+            self.assertEqual(handle.read(), b'coin' * 1000)
+        self.assertEqual(self.storage.size(first), 4000)
+        self.assertEqual(
+            self.storage.listdir('analysis_charts'), ([], sorted(name.split('/')[1] for name in (first, second, other))),
+        )
+        self.assertEqual(self.storage.listdir(''), (['analysis_charts'], []))
+
+    def test_blob_outlives_all_but_its_last_name(self):
+        from django.core.files.base import ContentFile
+
+        first = self.storage.save('videos/intro.mp4', ContentFile(b'video'))
+        second = self.storage.save('videos/intro.mp4', ContentFile(b'video'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.storage.delete(first)
+        self.assertFalse(self.storage.exists(first))
+        self.assertTrue(self.storage.exists(second))
+        self.assertEqual(len(self.blob_files()), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.storage.delete(second)
+        self.assertEqual(self.blob_files(), [])
+        self.assertFalse(MediaBlob.objects.exists())
+        # The name is free again
+        self.assertEqual(self.storage.save('videos/intro.mp4', ContentFile(b'other')), 'videos/intro.mp4')
+
+    def test_taken_name_is_retried_without_orphaning_the_blob(self):
+        from unittest import mock
+
+        from django.core.files.base import ContentFile
+
+        from .storage import ContentAddressedStorage
+
+        taken = self.storage.save('docs/notes.txt', ContentFile(b'first'))
+        available = ContentAddressedStorage.get_available_name
+        answers = iter([taken])
+
+        def racing_get_available_name(storage, name, max_length=None):
+            # The first answer was free when checked but was taken before the insert
+            return next(answers, None) or available(storage, name, max_length)
+
+        with mock.patch.object(ContentAddressedStorage, 'get_available_name', racing_get_available_name):
+            name = self.storage.save('docs/notes.txt', ContentFile(b'second'))
+
+        self.assertNotEqual(name, taken)
+        with self.storage.open(name) as handle:
+            self.assertEqual(handle.read(), b'second')
+        self.assertEqual(len(self.blob_files()), MediaBlob.objects.count())
+        self.assertEqual(MediaBlob.objects.get(files__name=name).ref_count, 1)
+
+    def test_name_cache_is_updated_on_commit(self):
+        from django.core.files.base import ContentFile
+
+        from .storage import _cache_key
+
+        with self.captureOnCommitCallbacks(execute=True):
+            name = self.storage.save('docs/notes.txt', ContentFile(b'first'))
+        self.assertEqual(cache.get(_cache_key(name)), MediaBlob.objects.get().path)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.storage.delete(name)
+        self.assertIsNone(cache.get(_cache_key(name)))
+        self.assertFalse(self.storage.exists(name))
+
+    def test_legacy_files_are_served_and_adopted(self):
+        import os
+        from io import StringIO
+
+        from django.core.management import call_command
+
+        os.makedirs(os.path.join(self.media_root, 'analysis_charts'))
+        for name in ('usd-coin.png', 'usd-coin_xARFCln.png'):
+            with open(os.path.join(self.media_root, 'analysis_charts', name), 'wb') as handle:
+                handle.write(b'coin' * 1000)
+        self.assertTrue(self.storage.exists('analysis_charts/usd-coin.png'))
+        self.assertEqual(self.storage.url('analysis_charts/usd-coin.png'), '/media/analysis_charts/usd-coin.png')
+
+        out = StringIO()
+        call_command('dedupe_media', stdout=out)
+        self.assertIn('Adopted 2 files into blobs, freeing 3.9KB', out.getvalue())
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'analysis_charts')), [])
+        self.assertEqual(len(self.blob_files()), 1)
+        with self.storage.open('analysis_charts/usd-coin_xARFCln.png') as handle:
+            self.assertEqual(handle.read(), b'coin' * 1000)
+        self.assertEqual(
+            self.storage.url('analysis_charts/usd-coin.png'), self.storage.url('analysis_charts/usd-coin_xARFCln.png'),
+        )
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class MediaServingTests(TestCase):
+    VIDEO = bytes(range(256)) * 40
+
+    def setUp(self):
+        import shutil
+        import tempfile
+
+        from django.core.files.base import ContentFile
+
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.site_setting = SiteSetting(name='Home')
+        self.site_setting.hero_video.save('intro.mp4', ContentFile(self.VIDEO))
+        self.url = f'/site-media/hero-video/{self.site_setting.pk}/'
+
+    def get(self, url=None, **headers):
+        return self.client.get(url or self.url, secure=True, **headers)
+
+    def test_whole_file(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.VIDEO)
+        self.assertEqual(response['Content-Type'], 'video/mp4')
+        self.assertEqual(response['Content-Length'], str(len(self.VIDEO)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('public', response['Cache-Control'])
+
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_ranges(self):
+        response = self.get(HTTP_RANGE='bytes=1000-1099')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.VIDEO[1000:1100])
+        self.assertEqual(response['Content-Range'], f'bytes 1000-1099/{len(self.VIDEO)}')
+        self.assertEqual(response['Content-Length'], '100')
+
+        response = self.get(HTTP_RANGE='bytes=-10')
+        self.assertEqual(b''.join(response.streaming_content), self.VIDEO[-10:])
+        response = self.get(HTTP_RANGE='bytes=10000-')
+        self.assertEqual(b''.join(response.streaming_content), self.VIDEO[10000:])
+
+        response = self.get(HTTP_RANGE=f'bytes={len(self.VIDEO)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.VIDEO)}')
+
+        # Several ranges, or a range of a different version of the file, get the whole file
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-1,5-6').status_code, 200)
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"').status_code, 200)
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag).status_code, 206)
+
+    def test_offload(self):
+        with self.settings(MEDIA_OFFLOAD='x-accel-redirect'):
+            response = self.get(HTTP_RANGE='bytes=0-9')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(
+            response['X-Accel-Redirect'], '/protected-media/' + self.site_setting.hero_video.storage.blob_for(
+                self.site_setting.hero_video.name),
+        )
+        self.assertEqual(response['Content-Type'], 'video/mp4')
+
+        with self.settings(MEDIA_OFFLOAD='x-sendfile'):
+            response = self.get()
+        self.assertEqual(response['X-Sendfile'], self.site_setting.hero_video.path)
+
+    def test_attachment_access_follows_the_consultation(self):
+        from django.core.files.base import ContentFile
+
+        client = User.objects.create_user('client', password='pw')
+        analyst_user = User.objects.create_user('analyst', password='pw')
+        stranger = User.objects.create_user('stranger', password='pw')
+        consultation = Consultation.objects.create(
+            user=client, analyst=Analyst.objects.create(user=analyst_user), title='Review',
+            scheduled_date=timezone.now() + timedelta(days=1), duration_minutes=60, price=10,
+        )
+        attachment = ConsultationAttachment(
+            consultation=consultation, file_name='Notes 1.pdf', file_type='pdf', uploaded_by=analyst_user,
+        )
+        attachment.file.save('notes.pdf', ContentFile(b'%PDF-1.4 notes'))
+        url = attachment.get_absolute_url()
+
+        self.assertEqual(self.get(url).status_code, 302)
+        for user, status in ((stranger, 404), (client, 200), (analyst_user, 200)):
+            self.client.force_login(user)
+            response = self.get(url, HTTP_RANGE='bytes=0-7')
+            self.assertEqual(response.status_code, 206 if status == 200 else status)
+            if status == 200:
+                self.assertEqual(b''.join(response.streaming_content), b'%PDF-1.4')
+                self.assertEqual(response['Content-Disposition'], 'attachment; filename="Notes 1.pdf"')
+                self.assertIn('private', response['Cache-Control'])
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.client_user = User.objects.create_user('client', password='pw')
+        self.consultation = Consultation.objects.create(
+            user=self.client_user, title='Review', scheduled_date=timezone.now() + timedelta(days=1),
+            duration_minutes=60, price=10,
+        )
+        self.data = os.urandom(600 * 1024)
+        self.client.force_login(self.client_user)
+
+    def start(self, **fields):
+        payload = {'file_name': 'recording.mp4', 'size': len(self.data), 'chunk_size': 1, **fields}
+        return self.client.post(
+            f'/api/consultations/{self.consultation.pk}/uploads/', json.dumps(payload),
+            content_type='application/json', secure=True,
+        )
+
+    def put_chunk(self, upload, index, data=None, sha256=None):
+        import hashlib
+
+        size = upload['chunk_size']
+        data = self.data[index * size:(index + 1) * size] if data is None else data
+        return self.client.put(
+            f"/api/uploads/{upload['upload_id']}/chunks/{index}/", data, content_type='application/octet-stream',
+            secure=True, HTTP_X_CHUNK_SHA256=sha256 or hashlib.sha256(data).hexdigest(),
+        )
+
+    def test_resumable_upload(self):
+        import os
+
+        from .uploads import staging_path
+
+        response = self.start()
+        self.assertEqual(response.status_code, 201)
+        upload = response.json()
+        # Chunk sizes are clamped to the minimum
+        self.assertEqual((upload['chunk_size'], upload['total_chunks'], upload['received']), (256 * 1024, 3, []))
+
+        self.assertEqual(self.put_chunk(upload, 2).status_code, 200)
+        self.assertEqual(self.put_chunk(upload, 0).status_code, 200)
+        corrupted = self.put_chunk(upload, 1, sha256='0' * 64)
+        self.assertEqual(corrupted.status_code, 400)
+        self.assertIn('SHA-256', corrupted.json()['error'])
+        self.assertEqual(self.put_chunk(upload, 1, data=b'short').status_code, 400)
+        self.assertEqual(self.put_chunk(upload, 3).status_code, 400)
+
+        # After a dropped connection the client asks what arrived
+        state = self.client.get(f"/api/uploads/{upload['upload_id']}/", secure=True).json()
+        self.assertEqual(state['received'], [0, 2])
+        finalize_url = f"/api/uploads/{upload['upload_id']}/finalize/"
+        self.assertEqual(self.client.post(finalize_url, secure=True).status_code, 409)
+
+        self.assertEqual(self.put_chunk(upload, 1).status_code, 200)
+        response = self.client.post(finalize_url, secure=True)
+        self.assertEqual(response.status_code, 201)
+
+        attachment = ConsultationAttachment.objects.get(pk=response.json()['attachment_id'])
+        self.assertEqual((attachment.file_name, attachment.file_type, attachment.uploaded_by), (
+            'recording.mp4', 'mp4', self.client_user,
+        ))
+        with attachment.file.open('rb') as handle:
+            self.assertEqual(handle.read(), self.data)
+        self.assertFalse(AttachmentUpload.objects.exists())
+        self.assertFalse(os.listdir(os.path.dirname(staging_path(AttachmentUpload(upload_id=upload['upload_id'])))))
+
+        download = self.client.get(response.json()['url'], secure=True)
+        self.assertEqual(b''.join(download.streaming_content), self.data)
+
+    def test_corrupted_resend_drops_the_accepted_chunk(self):
+        import hashlib
+
+        upload = self.start().json()
+        for index in range(upload['total_chunks']):
+            self.assertEqual(self.put_chunk(upload, index).status_code, 200)
+
+        # Resend chunk 1, damaged on the way but claiming the original hash
+        good = self.data[upload['chunk_size']:2 * upload['chunk_size']]
+        damaged = b'\0' * len(good)
+        response = self.put_chunk(upload, 1, data=damaged, sha256=hashlib.sha256(good).hexdigest())
+        self.assertEqual(response.status_code, 400)
+        state = self.client.get(f"/api/uploads/{upload['upload_id']}/", secure=True).json()
+        self.assertEqual(state['received'], [0, 2])
+
+        finalize_url = f"/api/uploads/{upload['upload_id']}/finalize/"
+        self.assertEqual(self.client.post(finalize_url, secure=True).status_code, 409)
+        self.assertEqual(self.put_chunk(upload, 1).status_code, 200)
+        response = self.client.post(finalize_url, secure=True)
+        self.assertEqual(response.status_code, 201)
+        with ConsultationAttachment.objects.get().file.open('rb') as handle:
+            self.assertEqual(handle.read(), self.data)
+
+    def test_finalize_rejects_chunks_changed_on_disk(self):
+        from .uploads import staging_path
+
+        upload = self.start().json()
+        for index in range(upload['total_chunks']):
+            self.put_chunk(upload, index)
+        with open(staging_path(AttachmentUpload.objects.get()), 'r+b') as handle:
+            handle.seek(upload['chunk_size'] * 2 + 10)
+            handle.write(b'corrupt')
+
+        finalize_url = f"/api/uploads/{upload['upload_id']}/finalize/"
+        response = self.client.post(finalize_url, secure=True)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['received'], [0, 1])
+        self.assertFalse(ConsultationAttachment.objects.exists())
+
+        self.put_chunk(upload, 2)
+        self.assertEqual(self.client.post(finalize_url, secure=True).status_code, 201)
+
+    def test_uploads_are_limited_to_participants(self):
+        stranger = User.objects.create_user('stranger', password='pw')
+        upload = self.start().json()
+
+        self.client.force_login(stranger)
+        self.assertEqual(self.start().status_code, 404)
+        self.assertEqual(self.put_chunk(upload, 0).status_code, 404)
+        self.assertEqual(self.client.get(f"/api/uploads/{upload['upload_id']}/", secure=True).status_code, 404)
+
+    def test_bad_and_abandoned_uploads(self):
+        import os
+
+        from .uploads import discard_stale_uploads, staging_path
+
+        self.assertEqual(self.start(size=0).status_code, 400)
+        self.assertEqual(self.start(file_name='').status_code, 400)
+
+        upload = AttachmentUpload.objects.get(upload_id=self.start().json()['upload_id'])
+        self.assertTrue(os.path.exists(staging_path(upload)))
+        self.assertEqual(discard_stale_uploads(), 0)
+        self.assertEqual(discard_stale_uploads(now=timezone.now() + timedelta(days=2)), 1)
+        self.assertFalse(os.path.exists(staging_path(upload)))
+
+
+def _pdf_text(pdf):
+    """The inflated content streams of ``pdf``, joined"""
+    import re
+    import zlib
+
+    return b''.join(
+        zlib.decompress(stream)
+        for stream in re.findall(rb'/FlateDecode >>\nstream\n(.*?)\nendstream', pdf, re.S)
+    )
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class AnalysisReportTests(TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        settings_override = override_settings(REPORT_CACHE_DIR=cache_dir, MEDIA_ROOT=cache_dir + '/media')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.cache_dir = cache_dir
+
+        self.user = User.objects.create_user('reader', password='pw')
+        analyst = Analyst.objects.create(user=User.objects.create_user('analyst'))
+        self.analysis = CryptoAnalysis.objects.create(
+            analyst=analyst, title='Bitcoin (BTC) outlook', cryptocurrency='Bitcoin', symbol='BTC', price=5,
+            analysis_type='technical', timeframe='short_term', risk_level='low', is_featured=True,
+            executive_summary='Momentum is building.', description='Weekly view.',
+            full_content='\n'.join(f'Paragraph {i}: ' + 'support holds above the range ' * 12 for i in range(60)),
+        )
+        AnalysisMetric.objects.create(analysis=self.analysis, name='RSI', current_value='61', previous_value='55',
+                                      change='+6', trend='up')
+        AnalysisInsight.objects.create(analysis=self.analysis, title='Breakout', description='Above 70k.')
+        ChartAnnotation.objects.create(analysis=self.analysis, type='support', price_level=Decimal('64000'))
+        self.analysis.refresh_from_db()
+        PurchasedAnalysis.objects.create(user=self.user, analysis=self.analysis, purchase_price=5)
+
+    def test_rendered_pdf_is_well_formed(self):
+        import re
+
+        from .reports import render_report
+
+        pdf = b''.join(render_report(self.analysis))
+        self.assertTrue(pdf.startswith(b'%PDF-1.4'))
+        self.assertTrue(pdf.endswith(b'%%EOF\n'))
+        # Every xref entry points at its object
+        xref_at = int(re.search(rb'startxref\n(\d+)', pdf).group(1))
+        entries = re.findall(rb'(\d{10}) 00000 n', pdf[xref_at:])
+        for number, offset in enumerate(entries, start=1):
+            self.assertTrue(pdf[int(offset):].startswith(f'{number} 0 obj'.encode()))
+        pages = int(re.search(rb'/Type /Pages /Kids \[[^\]]*\] /Count (\d+)', pdf).group(1))
+        self.assertGreater(pages, 1)
+        self.assertIn(b'/BaseFont /Helvetica-Bold', pdf)
+        self.assertIn(b'(RSI: 61', _pdf_text(pdf))
+
+    def test_chart_image_is_embedded(self):
+        from io import BytesIO
+
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from PIL import Image
+
+        from .reports import render_report
+
+        buffer = BytesIO()
+        Image.new('RGBA', (300, 150), (10, 200, 30, 255)).save(buffer, 'PNG')
+        self.analysis.chart_image = SimpleUploadedFile('chart.png', buffer.getvalue())
+        with self.captureOnCommitCallbacks():
+            self.analysis.save()
+        pdf = b''.join(render_report(self.analysis))
+        self.assertIn(b'/Subtype /Image /Width 300 /Height 150 /ColorSpace /DeviceRGB', pdf)
+        self.assertIn(b'/XObject << /Im1 ', pdf)
+        self.assertIn(b'/Im1 Do', _pdf_text(pdf))
+
+    def test_download_streams_then_serves_from_cache(self):
+        import os
+
+        self.client.force_login(self.user)
+        url = f'/download-analysis/{self.analysis.pk}/'
+        first = self.client.get(url, secure=True)
+        self.assertEqual(first['Content-Type'], 'application/pdf')
+        self.assertEqual(first['Content-Disposition'], f'attachment; filename="BTC_{self.analysis.pk}.pdf"')
+        self.assertNotIn('Content-Length', first)
+        streamed = b''.join(first.streaming_content)
+        self.assertEqual(len([name for name in os.listdir(self.cache_dir) if name.endswith('.pdf')]), 1)
+
+        second = self.client.get(url, secure=True)
+        self.assertEqual(second['Content-Length'], str(len(streamed)))
+        self.assertEqual(b''.join(second.streaming_content), streamed)
+        self.assertEqual(self.client.get(url, secure=True, HTTP_RANGE='bytes=0-7').status_code, 206)
+
+        # A new insight is a new version, which replaces the old file once rendered
+        AnalysisInsight.objects.create(analysis=self.analysis, title='Retest', description='Watch 68k.')
+        third = self.client.get(url, secure=True)
+        self.assertNotIn('Content-Length', third)
+        self.assertIn(b'Retest', _pdf_text(b''.join(third.streaming_content)))
+        self.assertEqual(len([name for name in os.listdir(self.cache_dir) if name.endswith('.pdf')]), 1)
+
+    def test_a_sale_keeps_the_cached_report(self):
+        from .reports import cached_report
+
+        self.client.force_login(self.user)
+        b''.join(self.client.get(f'/download-analysis/{self.analysis.pk}/', secure=True).streaming_content)
+        self.client.force_login(User.objects.create_user('buyer'))
+        self.client.post('/wallet/add-funds/', {'amount': '100.00', 'payment_method': 'card'}, secure=True)
+        response = self.client.post('/instant-purchase/', {'analysis_id': self.analysis.pk}, secure=True)
+        self.assertEqual(response.json()['status'], 'success')
+
+        sold = CryptoAnalysis.objects.get(pk=self.analysis.pk)
+        self.assertEqual(sold.sales_count, self.analysis.sales_count + 1)
+        self.assertEqual(sold.updated_at, self.analysis.updated_at)
+        self.assertTrue(cached_report(sold))
+
+    def test_prerender_command(self):
+        from io import StringIO
+
+        from django.core.management import call_command
+
+        from .reports import cached_report
+
+        out = StringIO()
+        call_command('prerender_reports', '--workers', '0', stdout=out)
+        self.assertIn('Rendered 1 reports', out.getvalue())
+        self.assertTrue(cached_report(self.analysis))
+        out = StringIO()
+        call_command('prerender_reports', '--workers', '0', stdout=out)
+        self.assertIn('Rendered 0 reports', out.getvalue())
+        self.assertIn('1 already cached', out.getvalue())
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ReplicaRoutingTests(TransactionTestCase):
+    """TransactionTestCase, since reads inside a transaction always stay on the primary"""
+
+    def setUp(self):
+        from . import routers
+
+        # The primary doubles as the replica: the router names it when it picks a replica and returns None
+        # otherwise.  Lifted before the flush after each test, which would skip it as a replica.
+        replicas = override_settings(REPLICA_DATABASES=['default'])
+        replicas.enable()
+        self.addCleanup(replicas.disable)
+        routers._down_until.clear()
+        self.addCleanup(routers._down_until.clear)
+        self.user = User.objects.create_user('reader', password='pw')
+        self.other = User.objects.create_user('other')
+        # Forget the pins from creating their wallets
+        cache.clear()
+
+    def route(self, pinned=False, user=None, before=None, atomic=False):
+        """Where a read in a replica view goes, after calling ``before``"""
+        from contextlib import nullcontext
+
+        from django.contrib.auth.models import AnonymousUser
+        from django.db import transaction as db_transaction
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+
+        from .routers import ReplicaRouter, read_from_replica, request_state
+
+        seen = []
+
+        @read_from_replica
+        def view(request):
+            if before:
+                before()
+            with db_transaction.atomic() if atomic else nullcontext():
+                seen.append(ReplicaRouter().db_for_read(CryptoAnalysis))
+            return HttpResponse()
+
+        request = RequestFactory().get('/')
+        request.user = user or AnonymousUser()
+        with request_state(pinned):
+            view(request)
+        return seen[0]
+
+    def test_reads_in_replica_views_use_a_replica(self):
+        from .routers import ReplicaRouter, request_state
+
+        self.assertEqual(self.route(), 'default')
+        with request_state():
+            self.assertIsNone(ReplicaRouter().db_for_read(CryptoAnalysis))
+        self.assertEqual(ReplicaRouter().db_for_write(CryptoAnalysis), 'default')
+
+    def test_reads_stay_on_the_primary_after_a_write_or_in_a_transaction(self):
+        self.assertIsNone(self.route(before=lambda: User.objects.filter(pk=self.user.pk).update(first_name='R')))
+        self.assertIsNone(self.route(atomic=True))
+
+    def test_replicas_need_a_shared_cache(self):
+        from .checks import check_replica_pins
+
+        self.assertEqual(check_replica_pins(None), [])
+        local = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with override_settings(CACHES=local):
+            self.assertEqual([error.id for error in check_replica_pins(None)], ['dashboard.E002'])
+        with override_settings(CACHES=local, REPLICA_DATABASES=[]):
+            self.assertEqual(check_replica_pins(None), [])
+
+    def test_pinned_users_read_from_the_primary(self):
+        self.assertIsNone(self.route(pinned=True))
+        self.assertEqual(self.route(user=self.user), 'default')
+        Transaction.objects.create(user=self.user, transaction_type='deposit', amount=5, description='Deposit')
+        self.assertIsNone(self.route(user=self.user))
+        self.assertEqual(self.route(user=self.other), 'default')
+
+    def test_writing_request_sets_the_pin_cookie(self):
+        self.client.force_login(self.user)
+        # The first visit creates the wallet
+        response = self.client.get('/portfolio/', secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.cookies['primary_pin']['max-age'], 15)
+        self.client.cookies.pop('primary_pin')
+        response = self.client.get('/portfolio/', secure=True)
+        self.assertNotIn('primary_pin', response.cookies)
+
+    def test_unavailable_replica_falls_back_to_the_primary(self):
+        from .routers import mark_down
+
+        mark_down('default')
+        self.assertIsNone(self.route())
+        with override_settings(REPLICA_RETRY_SECONDS=0):
+            mark_down('default')
+            self.assertEqual(self.route(), 'default')
+
+    def test_view_is_retried_on_the_primary_when_the_replica_fails(self):
+        from django.contrib.auth.models import AnonymousUser
+        from django.db import OperationalError
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+
+        from .routers import _down_until, read_from_replica, request_state
+
+        calls = []
+
+        @read_from_replica
+        def view(request):
+            calls.append(list(CryptoAnalysis.objects.values_list('pk', flat=True)))
+            if len(calls) == 1:
+                raise OperationalError('replica went away')
+            return HttpResponse('ok')
+
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        with request_state():
+            self.assertEqual(view(request).content, b'ok')
+        self.assertEqual(len(calls), 2)
+        self.assertIn('default', _down_until)
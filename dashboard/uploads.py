@@ -0,0 +1,198 @@
+"""
+Resumable, chunked uploads of consultation attachments.
+
+A client starts an upload with the file's name and size and is given a
+chunk size.  It then PUTs the chunks, in any order and as often as needed,
+each with the SHA-256 of its bytes, and finally asks for the upload to be
+finalized.  After a dropped connection it asks which chunks arrived and
+sends only the rest.
+
+The file is staged at its full size when the upload starts.  Each chunk is
+streamed from the request straight to its offset with ``os.pwrite`` in
+READ_SIZE pieces while being hashed, so a server process holds at most
+READ_SIZE bytes of an upload whatever the file size.  A chunk stops
+counting as received before its range is written, so one whose hash does
+not match, even a failed resend of an accepted chunk, is missing until it
+is sent again.  Chunks arriving in parallel write to disjoint ranges of the
+same file.  Finalizing hashes every chunk again against the SHA-256 it was
+accepted with, then hands the staged file to the storage, which moves it
+into place instead of copying it (see ContentAddressedStorage.save_file).
+
+Staging files live under MEDIA_ROOT so the final move stays on one
+filesystem.  Uploads left unfinished for UPLOAD_EXPIRY are discarded by
+``discard_stale_uploads`` (run by the sweep_lifecycle command).
+"""
+import hashlib
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction as db_transaction
+from django.utils import timezone
+
+from .models import AttachmentUpload, AttachmentUploadChunk, ConsultationAttachment
+from .storage import BLOB_DIR
+
+DEFAULT_CHUNK_SIZE = 5 * 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+MAX_UPLOAD_SIZE = 4 * 1024 * 1024 * 1024
+
+# Bytes read from the request and written to disk at a time
+READ_SIZE = 64 * 1024
+
+UPLOAD_EXPIRY = timedelta(days=1)
+
+
+class UploadError(ValueError):
+    pass
+
+
+def staging_path(upload):
+    return os.path.join(settings.MEDIA_ROOT, BLOB_DIR, 'uploads', f'{upload.upload_id}.part')
+
+
+def start_upload(consultation, user, file_name, size, file_type='', description=None, chunk_size=None):
+    """Create an upload of a ``size`` byte file and its staging file"""
+    file_name = os.path.basename(file_name or '').strip()
+    if not file_name:
+        raise UploadError("file_name is required")
+    if not isinstance(size, int) or size <= 0:
+        raise UploadError("size must be a positive integer")
+    if size > MAX_UPLOAD_SIZE:
+        raise UploadError(f"Files are limited to {MAX_UPLOAD_SIZE} bytes")
+    chunk_size = min(max(int(chunk_size or DEFAULT_CHUNK_SIZE), MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+
+    upload = AttachmentUpload.objects.create(
+        consultation=consultation, uploaded_by=user, file_name=file_name[:255],
+        file_type=(file_type or os.path.splitext(file_name)[1].lstrip('.') or 'file')[:50],
+        description=description, size=size, chunk_size=chunk_size,
+    )
+    path = staging_path(upload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as handle:
+        # Sparse on most filesystems; chunks fill it in
+        handle.truncate(size)
+    return upload
+
+
+def received_chunks(upload):
+    return sorted(upload.chunks.values_list('index', flat=True))
+
+
+def write_chunk(upload, index, stream, sha256):
+    """
+    Write chunk ``index`` read from ``stream`` (e.g. the request) to the
+    staging file and record it if its bytes hash to ``sha256``.
+    """
+    if not 0 <= index < upload.total_chunks:
+        raise UploadError(f"Chunk {index} is out of range 0-{upload.total_chunks - 1}")
+    if not sha256:
+        raise UploadError("The chunk's SHA-256 is required")
+    expected = upload.chunk_length(index)
+    offset = index * upload.chunk_size
+    digest = hashlib.sha256()
+    written = 0
+    try:
+        fd = os.open(staging_path(upload), os.O_WRONLY)
+    except FileNotFoundError:
+        raise UploadError("This upload is no longer available")
+    # The range is about to be overwritten: until these bytes verify, the chunk has not arrived
+    AttachmentUploadChunk.objects.filter(upload=upload, index=index).delete()
+    try:
+        while written < expected:
+            data = stream.read(min(READ_SIZE, expected - written))
+            if not data:
+                break
+            os.pwrite(fd, data, offset + written)
+            digest.update(data)
+            written += len(data)
+    finally:
+        os.close(fd)
+    if written != expected or stream.read(1):
+        raise UploadError(f"Chunk {index} must be {expected} bytes")
+    if digest.hexdigest() != sha256.strip().lower():
+        raise UploadError(f"Chunk {index} does not match its SHA-256")
+
+    AttachmentUploadChunk.objects.update_or_create(upload=upload, index=index, defaults={'sha256': digest.hexdigest()})
+    AttachmentUpload.objects.filter(pk=upload.pk).update(updated_at=timezone.now())
+
+
+def _corrupt_chunks(upload, recorded):
+    """Indexes of the staged chunks whose bytes no longer hash to ``recorded[index]``"""
+    corrupt = []
+    buffer = memoryview(bytearray(READ_SIZE))
+    with open(staging_path(upload), 'rb', buffering=0) as handle:
+        for index in range(upload.total_chunks):
+            digest = hashlib.sha256()
+            remaining = upload.chunk_length(index)
+            handle.seek(index * upload.chunk_size)
+            while remaining:
+                read = handle.readinto(buffer[:min(READ_SIZE, remaining)])
+                if not read:
+                    break
+                digest.update(buffer[:read])
+                remaining -= read
+            if remaining or digest.hexdigest() != recorded[index]:
+                corrupt.append(index)
+    return corrupt
+
+
+def finalize_upload(upload):
+    """
+    Turn a fully received upload into its ConsultationAttachment.  Every
+    chunk is hashed again first; chunks that no longer match are dropped so
+    the client sends them again.
+    """
+    with db_transaction.atomic():
+        upload = AttachmentUpload.objects.select_for_update().get(pk=upload.pk)
+        recorded = dict(upload.chunks.values_list('index', 'sha256'))
+        missing = sorted(set(range(upload.total_chunks)) - set(recorded))
+        if missing:
+            raise UploadError(f"{len(missing)} chunks are missing, first {missing[0]}")
+        try:
+            corrupt = _corrupt_chunks(upload, recorded)
+        except FileNotFoundError:
+            raise UploadError("This upload is no longer available")
+
+        if corrupt:
+            # Committed before the error is raised, so they are reported as missing
+            upload.chunks.filter(index__in=corrupt).delete()
+        else:
+            attachment = ConsultationAttachment(
+                consultation=upload.consultation, uploaded_by=upload.uploaded_by, file_name=upload.file_name,
+                file_type=upload.file_type, description=upload.description,
+            )
+            field = attachment.file.field
+            name = field.generate_filename(attachment, upload.file_name)
+            path = staging_path(upload)
+            if hasattr(field.storage, 'save_file'):
+                attachment.file.name = field.storage.save_file(name, path, max_length=field.max_length)
+            else:
+                with open(path, 'rb') as handle:
+                    attachment.file.name = field.storage.save(name, File(handle), max_length=field.max_length)
+                os.remove(path)
+            attachment.save()
+            upload.delete()
+    if corrupt:
+        raise UploadError(f"{len(corrupt)} chunks do not match their SHA-256, first {corrupt[0]}")
+    return attachment
+
+
+def discard_upload(upload):
+    upload.delete()
+    try:
+        os.remove(staging_path(upload))
+    except FileNotFoundError:
+        pass
+
+
+def discard_stale_uploads(now=None, expiry=UPLOAD_EXPIRY):
+    """Discard uploads untouched for ``expiry``; returns how many"""
+    now = now or timezone.now()
+    stale = list(AttachmentUpload.objects.filter(updated_at__lt=now - expiry))
+    for upload in stale:
+        discard_upload(upload)
+    return len(stale)
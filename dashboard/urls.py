@@ -51,5 +51,12 @@ urlpatterns = [
     path('debug-wallet/', views.debug_wallet, name='debug_wallet'),
     path('debug/withdrawal/', views.debug_withdrawal, name='debug_withdrawal'),
     path('api/analysis/<int:analysis_id>/', views.analysis_detail_api, name='analysis_detail_api'),
+    path('api/analyses/', views.analyses_batch_api, name='analyses_batch_api'),
+    path('site-media/hero-video/<int:setting_id>/', views.hero_video, name='hero_video'),
+    path('consultation-attachments/<int:attachment_id>/', views.consultation_attachment, name='consultation_attachment'),
+    path('api/consultations/<int:consultation_id>/uploads/', views.start_attachment_upload, name='start_attachment_upload'),
+    path('api/uploads/<uuid:upload_id>/', views.attachment_upload, name='attachment_upload'),
+    path('api/uploads/<uuid:upload_id>/chunks/<int:index>/', views.attachment_upload_chunk, name='attachment_upload_chunk'),
+    path('api/uploads/<uuid:upload_id>/finalize/', views.finalize_attachment_upload, name='finalize_attachment_upload'),
 
 ]
\ No newline at end of file
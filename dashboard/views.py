@@ -8,21 +8,37 @@ from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import redirect, render, get_object_or_404
 from django.db import transaction as db_transaction
-from django.db.models import Sum, Avg, Q
+from django.db.models import F, Q
 from django.utils import timezone
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
+from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import csrf_exempt
+from operator import attrgetter, methodcaller
 import random
 import time
 import threading
 import logging
 from .models import (
     SiteSetting, UserWallet, UserProfile, Transaction, 
-    CryptoAnalysis, PurchasedAnalysis, Analyst, Consultation, 
-    ConsultationPackage, MarketInsight, ChartAnnotation, 
-    TechnicalIndicatorData, AnalysisInsight, AnalysisMetric, MpesaTransaction
+    CryptoAnalysis, PurchasedAnalysis, Analyst, Consultation, ConsultationAttachment,
+    AttachmentUpload, ConsultationPackage, MarketInsight, ChartAnnotation, 
+    TechnicalIndicatorData, AnalysisInsight, AnalysisMetric, MpesaTransaction,
+    UserStats, AnalysisRanking
 )
 from .forms import UserUpdateForm, UserProfileForm, PaymentMethodForm, DepositForm, WithdrawalForm
+from .summary import get_user_summary
+from .entitlements import get_owned_analyses, has_purchased, user_owns_analysis
+from .conditional import analysis_api_conditional, analysis_conditional, insight_conditional
+from .recommendations import get_similar_analysis_ids
+from .rankings import DEFAULT_SORT, DEFAULT_WINDOW, MARKETPLACE_SORTS, sorted_page, top_analysts
+from .bookings import allocate_slot, create_consultations
+from .scheduling import SlotUnavailable, free_starts, has_availability
+from .reports import cached_report, report_filename, stream_report
+from .routers import read_from_replica
+from .serving import serve_media, serve_path
+from .uploads import (
+    UploadError, discard_upload, finalize_upload, received_chunks, start_upload, write_chunk,
+)
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -41,6 +57,9 @@ MPESA_INITIATOR_PASSWORD = 'Safaricom2018'
 # Exchange rate (you might want to fetch this from an API in production)
 USD_TO_KES_RATE = Decimal('150.00')  # 1 USD = 150 KES
 
+# Free start times offered per package on the booking page
+BOOKING_SLOT_CHOICES = 12
+
 def get_mpesa_base_url():
     """Get M-Pesa API base URL based on environment"""
     if MPESA_ENVIRONMENT == 'production':
@@ -213,15 +232,16 @@ def mpesa_callback(request):
             if result_code == 0:
                 # Payment successful
                 try:
-                    transaction = Transaction.objects.get(reference=checkout_request_id, status='pending')
-                    transaction.status = 'completed'
-                    transaction.save()
-                    
-                    # Update wallet balance (already in USD)
-                    wallet = UserWallet.objects.get(user=transaction.user)
-                    wallet.balance += transaction.amount  # USD amount
-                    wallet.total_deposited += transaction.amount
-                    wallet.save()
+                    with db_transaction.atomic():
+                        transaction = Transaction.objects.get(reference=checkout_request_id, status='pending')
+                        transaction.status = 'completed'
+                        transaction.save()
+                        
+                        # Update wallet balance (already in USD)
+                        wallet = UserWallet.objects.get(user=transaction.user)
+                        wallet.balance += transaction.amount  # USD amount
+                        wallet.save()
+                        UserStats.record(transaction.user_id, total_deposited=transaction.amount)
                     
                     logger.info(f"Deposit completed for user {transaction.user}: ${transaction.amount}")
                     
@@ -335,8 +355,8 @@ def initiate_mpesa_withdrawal(request):
                     
                     # Temporarily hold the amount (USD)
                     user_wallet.balance -= amount_usd
-                    user_wallet.total_withdrawn += amount_usd
                     user_wallet.save()
+                    UserStats.record(request.user, total_withdrawn=amount_usd)
                 
                 # Update user's M-Pesa number if different
                 if user_wallet.mpesa_number != phone_number:
@@ -392,20 +412,21 @@ def mpesa_withdrawal_callback(request):
                 else:
                     # Withdrawal failed - refund the amount
                     try:
-                        transaction = Transaction.objects.get(
-                            reference=conversation_id, 
-                            transaction_type='withdrawal',
-                            status='pending'
-                        )
-                        transaction.status = 'failed'
-                        transaction.description = f'{transaction.description} - Failed: {result_desc}'
-                        transaction.save()
-                        
-                        # Refund the amount to user's wallet
-                        wallet = UserWallet.objects.get(user=transaction.user)
-                        wallet.balance += transaction.amount  # USD amount
-                        wallet.total_withdrawn -= transaction.amount
-                        wallet.save()
+                        with db_transaction.atomic():
+                            transaction = Transaction.objects.get(
+                                reference=conversation_id, 
+                                transaction_type='withdrawal',
+                                status='pending'
+                            )
+                            transaction.status = 'failed'
+                            transaction.description = f'{transaction.description} - Failed: {result_desc}'
+                            transaction.save()
+                            
+                            # Refund the amount to user's wallet
+                            wallet = UserWallet.objects.get(user=transaction.user)
+                            wallet.balance += transaction.amount  # USD amount
+                            wallet.save()
+                            UserStats.record(transaction.user_id, total_withdrawn=-transaction.amount)
                         
                         logger.info(f"Withdrawal failed for user {transaction.user}: {result_desc}. Amount refunded.")
                         
@@ -429,7 +450,7 @@ def debug_withdrawal(request):
         'mpesa_number': user_wallet.mpesa_number,
         'can_withdraw_1000_kes': user_wallet.can_withdraw(kes_to_usd(1000)),
         'daily_withdrawal_limit': str(user_wallet.daily_withdrawal_limit),
-        'total_withdrawn': str(user_wallet.total_withdrawn),
+        'total_withdrawn': str(UserStats.for_user(request.user).total_withdrawn),
         'pending_withdrawals': Transaction.objects.filter(
             user=request.user, 
             transaction_type='withdrawal',
@@ -609,8 +630,8 @@ def deposit_funds(request):
                         transaction.status = 'completed'
                         transaction.save()
                         user_wallet.balance += amount_usd
-                        user_wallet.total_deposited += amount_usd
                         user_wallet.save()
+                        UserStats.record(transaction.user_id, total_deposited=amount_usd)
                 
                 thread = threading.Thread(target=process_paypal_deposit)
                 thread.daemon = True
@@ -684,8 +705,8 @@ def withdraw_funds(request):
                         transaction.status = 'completed'
                         transaction.save()
                         user_wallet.balance -= amount_usd
-                        user_wallet.total_withdrawn += amount_usd
                         user_wallet.save()
+                        UserStats.record(transaction.user_id, total_withdrawn=amount_usd)
                 
                 thread = threading.Thread(target=process_paypal_withdrawal)
                 thread.daemon = True
@@ -709,12 +730,14 @@ def withdraw_funds(request):
 def wallet(request):
     user_wallet, created = UserWallet.objects.get_or_create(user=request.user)
     transactions = Transaction.objects.filter(user=request.user).order_by('-created_at')[:20]
+    user_stats = UserStats.for_user(request.user)
     
     # Convert wallet balance to KES for display
     balance_kes = usd_to_kes(user_wallet.balance)
     
     context = {
         'user_wallet': user_wallet,
+        'user_stats': user_stats,
         'transactions': transactions,
         'balance_kes': balance_kes,
         'exchange_rate': USD_TO_KES_RATE,
@@ -739,20 +762,21 @@ def add_funds(request):
         
         user_wallet, created = UserWallet.objects.get_or_create(user=request.user)
         
-        # Add funds to wallet
-        user_wallet.balance += amount_usd
-        user_wallet.total_deposited += amount_usd
-        user_wallet.save()
-        
-        # Create transaction record
-        transaction = Transaction.objects.create(
-            user=request.user,
-            amount=amount_usd,
-            transaction_type='deposit',
-            payment_method=payment_method,
-            status='completed',
-            description=f'Added funds via {payment_method}'
-        )
+        with db_transaction.atomic():
+            # Add funds to wallet
+            user_wallet.balance += amount_usd
+            user_wallet.save()
+            
+            # Create transaction record
+            transaction = Transaction.objects.create(
+                user=request.user,
+                amount=amount_usd,
+                transaction_type='deposit',
+                payment_method=payment_method,
+                status='completed',
+                description=f'Added funds via {payment_method}'
+            )
+            UserStats.record(request.user, total_deposited=amount_usd)
         
         logger.info(f"Created transaction: {transaction.id} for user {request.user}")
         
@@ -787,6 +811,7 @@ def debug_wallet(request):
     """Debug view to check wallet and transaction status"""
     user_wallet, created = UserWallet.objects.get_or_create(user=request.user)
     all_transactions = Transaction.objects.filter(user=request.user).order_by('-created_at')
+    user_stats = UserStats.for_user(request.user)
     balance_kes = usd_to_kes(user_wallet.balance)
     
     debug_info = {
@@ -794,28 +819,25 @@ def debug_wallet(request):
         'wallet_created': created,
         'wallet_balance': str(user_wallet.balance),
         'wallet_balance_kes': str(balance_kes),
-        'total_deposited': str(user_wallet.total_deposited),
-        'total_withdrawn': str(user_wallet.total_withdrawn),
+        'total_deposited': str(user_stats.total_deposited),
+        'total_withdrawn': str(user_stats.total_withdrawn),
         'total_transactions': all_transactions.count(),
         'transactions': list(all_transactions.values('id', 'transaction_type', 'amount', 'description', 'status', 'created_at')),
-        'purchased_analyses': PurchasedAnalysis.objects.filter(user=request.user).count(),
+        'purchased_analyses': user_stats.purchase_count,
         'exchange_rate': str(USD_TO_KES_RATE),
     }
     
     return JsonResponse(debug_info)
 
 @login_required
+@read_from_replica
 def dashboard(request):
     user_wallet, created = UserWallet.objects.get_or_create(user=request.user)
     
-    # Get user stats
-    purchased_count = PurchasedAnalysis.objects.filter(user=request.user).count()
-    
-    # Calculate total spent on analyses
-    total_spent_result = PurchasedAnalysis.objects.filter(user=request.user).aggregate(
-        total=Sum('purchase_price')
-    )
-    total_spent = total_spent_result['total'] or Decimal('0.00')
+    # Get user stats (single cached aggregate query)
+    summary = get_user_summary(request.user)
+    purchased_count = summary['purchased_count']
+    total_spent = summary['total_spent']
     
     # Convert to KES for display
     total_spent_kes = usd_to_kes(total_spent)
@@ -826,12 +848,12 @@ def dashboard(request):
     recent_transactions = Transaction.objects.filter(user=request.user).order_by('-created_at')[:5]
     
     # Consultation count
-    consultation_count = Consultation.objects.filter(user=request.user, status='scheduled').count()
+    consultation_count = summary['scheduled_count']
     
     # Get purchased analyses for the user
     purchased_analyses = PurchasedAnalysis.objects.filter(
         user=request.user
-    ).select_related('analysis').order_by('-purchased_at')[:3]
+    ).with_analysis(analyst=True).order_by('-purchased_at')[:3]
     
     # Get user consultations
     user_consultations = Consultation.objects.filter(
@@ -841,6 +863,7 @@ def dashboard(request):
     
     # Get consultation packages from database
     consultation_packages = ConsultationPackage.objects.filter(is_active=True)
+    scheduled = has_availability()
     
     # Convert to list of dicts for template compatibility
     packages_data = []
@@ -856,23 +879,20 @@ def dashboard(request):
             'features': package.get_features_list(),
             'icon_class': package.icon_class,
             'get_level_display': package.get_level_display,
+            'available_slots': free_starts(package.duration_minutes, count=BOOKING_SLOT_CHOICES) if scheduled else [],
         })
     
     # GET MARKET INSIGHTS FROM DATABASE
-    market_insights = MarketInsight.objects.filter(
+    market_insights = MarketInsight.objects.projection('card').filter(
         is_active=True,
         is_featured=True
     ).order_by('-published_at', '-created_at')[:6]
     
     if not market_insights:
-        market_insights = MarketInsight.objects.filter(
+        market_insights = MarketInsight.objects.projection('card').filter(
             is_active=True
         ).order_by('-published_at', '-created_at')[:6]
     
-    purchased_analysis_ids = PurchasedAnalysis.objects.filter(
-        user=request.user
-    ).values_list('analysis_id', flat=True)
-    
     context = {
         'user_wallet': user_wallet,
         'purchased_count': purchased_count,
@@ -886,13 +906,14 @@ def dashboard(request):
         'user_consultations': user_consultations,
         'consultation_packages': packages_data,
         'market_insights': market_insights,
-        'purchased_analysis_ids': list(purchased_analysis_ids),
+        'purchased_analysis_ids': get_owned_analyses(request.user),
         'exchange_rate': USD_TO_KES_RATE,
     }
     return render(request, 'dashboard/dashboard.html', context)
 
 
 @login_required
+@read_from_replica
 def marketplace(request):
     user_wallet, created = UserWallet.objects.get_or_create(user=request.user)
     
@@ -901,9 +922,11 @@ def marketplace(request):
     analysis_type = request.GET.get('type', '')
     risk_level = request.GET.get('risk', '')
     recommendation = request.GET.get('recommendation', '')
+    sort = request.GET.get('sort', DEFAULT_SORT)
+    window = request.GET.get('window', DEFAULT_WINDOW)
     
     # Build query
-    analyses = CryptoAnalysis.objects.filter(is_active=True).select_related('analyst', 'analyst__user')
+    analyses = CryptoAnalysis.objects.projection('card').filter(is_active=True).select_related('analyst', 'analyst__user')
     
     if search_query:
         analyses = analyses.filter(
@@ -922,22 +945,23 @@ def marketplace(request):
     if recommendation:
         analyses = analyses.filter(recommendation=recommendation)
     
-    # Get purchased analyses for the current user
-    purchased_analysis_ids = PurchasedAnalysis.objects.filter(
-        user=request.user
-    ).values_list('analysis_id', flat=True)
+    # Sorted, keyset-paginated page of analyses
+    analyses, next_cursor = sorted_page(analyses, sort, window, request.GET.get('after'))
+    next_page_query = None
+    if next_cursor:
+        params = request.GET.copy()
+        params['after'] = next_cursor
+        next_page_query = params.urlencode()
     
     # Get user's purchased analyses for display
     purchased_analyses = PurchasedAnalysis.objects.filter(
         user=request.user
-    ).select_related('analysis').order_by('-purchased_at')[:6]
+    ).with_analysis().order_by('-purchased_at')[:6]
     
-    # Calculate stats
-    purchased_count = PurchasedAnalysis.objects.filter(user=request.user).count()
-    total_spent_result = PurchasedAnalysis.objects.filter(user=request.user).aggregate(
-        total=Sum('purchase_price')
-    )
-    total_spent = total_spent_result['total'] or Decimal('0.00')
+    # Calculate stats (single cached aggregate query)
+    summary = get_user_summary(request.user)
+    purchased_count = summary['purchased_count']
+    total_spent = summary['total_spent']
     total_spent_kes = usd_to_kes(total_spent)
     balance_kes = usd_to_kes(user_wallet.balance)
     
@@ -952,7 +976,13 @@ def marketplace(request):
         'selected_type': analysis_type,
         'selected_risk': risk_level,
         'selected_recommendation': recommendation,
-        'purchased_analysis_ids': list(purchased_analysis_ids),
+        'selected_sort': sort,
+        'selected_window': window,
+        'sort_options': [(key, order.label) for key, order in MARKETPLACE_SORTS.items()],
+        'window_options': AnalysisRanking.WINDOWS,
+        'next_page_query': next_page_query,
+        'top_analysts': top_analysts(),
+        'purchased_analysis_ids': get_owned_analyses(request.user),
         'purchased_analyses': purchased_analyses,
         'exchange_rate': USD_TO_KES_RATE,
     }
@@ -988,7 +1018,7 @@ def purchase_analysis(request):
         user_wallet, created = UserWallet.objects.get_or_create(user=request.user)
         
         # Check if already purchased
-        if PurchasedAnalysis.objects.filter(user=request.user, analysis=analysis).exists():
+        if has_purchased(request.user, analysis.id):
             if request.headers.get('x-requested-with') == 'XMLHttpRequest':
                 return JsonResponse({
                     'status': 'already_purchased',
@@ -1034,22 +1064,11 @@ def purchase_analysis(request):
                         description=f'Purchase: {analysis.cryptocurrency} Analysis',
                         analysis=analysis
                     )
+                    UserStats.record(request.user, purchase_count=1, total_spent=analysis.price)
                     
-                    # Update analysis sales count - handle missing total_revenue field
-                    analysis.sales_count += 1
-                    
-                    # Safely update total_revenue if the field exists
-                    try:
-                        # Check if total_revenue field exists
-                        if hasattr(analysis, 'total_revenue'):
-                            analysis.total_revenue += analysis.price
-                        else:
-                            # If field doesn't exist, create it dynamically or skip
-                            logger.warning(f"total_revenue field not found for analysis {analysis.id}")
-                    except AttributeError:
-                        logger.warning(f"total_revenue field not found for analysis {analysis.id}")
-                    
-                    analysis.save()
+                    # Update analysis sales count; total_revenue follows the transaction (dashboard.rollups).
+                    # updated_at is left alone: reports, card fragments and ETags key on it
+                    CryptoAnalysis.objects.filter(pk=analysis.pk).update(sales_count=F('sales_count') + 1)
                     
                     logger.info(f"Purchase successful: {analysis.cryptocurrency} for ${analysis.price}")
                     logger.info(f"New balance: ${user_wallet.balance}")
@@ -1114,15 +1133,15 @@ def purchase_analysis(request):
     user_wallet, created = UserWallet.objects.get_or_create(user=request.user)
     purchased_analyses = PurchasedAnalysis.objects.filter(
         user=request.user
-    ).select_related('analysis', 'analysis__analyst', 'analysis__analyst__user').order_by('-purchased_at')
+    ).with_analysis(analyst=True).order_by('-purchased_at')
     balance_kes = usd_to_kes(user_wallet.balance)
     
     # Calculate stats
-    total_investment = sum(p.purchase_price for p in purchased_analyses)
+    user_stats = UserStats.for_user(request.user)
+    total_investment = user_stats.total_spent
     total_investment_kes = usd_to_kes(total_investment)
-    active_analyses = purchased_analyses.filter(access_expires__isnull=True).count()
-    average_rating_result = purchased_analyses.aggregate(avg_rating=Avg('rating_given'))
-    average_rating = average_rating_result['avg_rating'] or Decimal('4.5')
+    active_analyses = purchased_analyses.filter(access_expired=False).count()
+    average_rating = user_stats.average_rating_given or Decimal('4.5')
     
     context = {
         'purchased_analyses': purchased_analyses,
@@ -1161,7 +1180,7 @@ def instant_purchase(request):
         user_wallet, created = UserWallet.objects.get_or_create(user=request.user)
         
         # Check if already purchased
-        if PurchasedAnalysis.objects.filter(user=request.user, analysis=analysis).exists():
+        if has_purchased(request.user, analysis.id):
             return JsonResponse({
                 'status': 'already_purchased',
                 'message': 'You already own this analysis.',
@@ -1199,18 +1218,10 @@ def instant_purchase(request):
                     description=f'Instant Purchase: {analysis.cryptocurrency} Analysis',
                     analysis=analysis
                 )
+                UserStats.record(request.user, purchase_count=1, total_spent=analysis.price)
                 
-                # Update analysis sales count - handle missing total_revenue field
-                analysis.sales_count += 1
-                
-                # Safely update total_revenue if the field exists
-                try:
-                    if hasattr(analysis, 'total_revenue'):
-                        analysis.total_revenue += analysis.price
-                except AttributeError:
-                    logger.warning(f"total_revenue field not found for analysis {analysis.id}")
-                
-                analysis.save()
+                # Update analysis sales count; total_revenue follows the transaction (dashboard.rollups)
+                CryptoAnalysis.objects.filter(pk=analysis.pk).update(sales_count=F('sales_count') + 1)
                 
                 logger.info(f"Instant purchase successful: {analysis.cryptocurrency}")
             
@@ -1256,21 +1267,25 @@ def check_wallet_balance(request):
     })
 
 @login_required
+@read_from_replica
 def portfolio(request):
     user_wallet, created = UserWallet.objects.get_or_create(user=request.user)
     purchased_analyses = PurchasedAnalysis.objects.filter(
         user=request.user
-    ).select_related('analysis').order_by('-purchased_at')
+    ).with_analysis(analyst=True).order_by('-purchased_at')
     balance_kes = usd_to_kes(user_wallet.balance)
+    user_stats = UserStats.for_user(request.user)
     
     # Calculate portfolio stats
-    total_investment = sum(p.purchase_price for p in purchased_analyses)
+    total_investment = user_stats.total_spent
     total_investment_kes = usd_to_kes(total_investment)
-    active_analyses = purchased_analyses.filter(access_expires__isnull=True).count()
-    completed_analyses = purchased_analyses.filter(access_expires__isnull=False).count()
+    active_analyses = purchased_analyses.filter(access_expired=False).count()
+    completed_analyses = purchased_analyses.filter(access_expired=True).count()
     
     context = {
         'user_wallet': user_wallet,
+        'user_stats': user_stats,
+        'average_rating': user_stats.average_rating_given,
         'purchased_analyses': purchased_analyses,
         'total_investment': total_investment,
         'total_investment_kes': total_investment_kes,
@@ -1317,41 +1332,55 @@ def book_consultation(request):
                 messages.error(request, 'Please select a future date and time for your consultation.')
                 return redirect('book_consultation')
             
-            # Create consultation
-            consultation = Consultation.objects.create(
-                user=request.user,
-                title=package.title,
-                level=package.level,
-                description=f"{package.title} - Scheduled session",
-                price=package.price,
-                scheduled_date=scheduled_datetime,
-                status='scheduled'
-            )
-            
-            # Deduct from wallet
-            user_wallet.balance -= package.price
-            user_wallet.save()
-            
-            # Create transaction
-            Transaction.objects.create(
-                user=request.user,
-                amount=package.price,
-                transaction_type='payment',
-                payment_method='wallet',
-                status='completed',
-                description=f"Consultation: {package.title}",
-                consultation=consultation
-            )
+            with db_transaction.atomic():
+                # Create consultation
+                consultation_fields = {
+                    'user': request.user,
+                    'title': package.title,
+                    'level': package.level,
+                    'description': f"{package.title} - Scheduled session",
+                    'price': package.price,
+                    'status': 'scheduled',
+                }
+                if has_availability():
+                    consultation = allocate_slot(scheduled_datetime, package.duration_minutes, **consultation_fields)
+                else:
+                    # No analyst publishes consultation hours yet: take the booking unassigned
+                    consultation, = create_consultations([Consultation(
+                        scheduled_date=scheduled_datetime,
+                        duration_minutes=package.duration_minutes,
+                        **consultation_fields
+                    )])
+                
+                # Deduct from wallet
+                user_wallet.balance -= package.price
+                user_wallet.save()
+                
+                # Create transaction
+                Transaction.objects.create(
+                    user=request.user,
+                    amount=package.price,
+                    transaction_type='payment',
+                    payment_method='wallet',
+                    status='completed',
+                    description=f"Consultation: {package.title}",
+                    consultation=consultation
+                )
+                UserStats.record(request.user, consultations_booked=1, consultation_spend=package.price)
             
             messages.success(request, f"Successfully booked {package.title} for {scheduled_datetime.strftime('%B %d, %Y at %I:%M %p')}!")
             return redirect('dashboard')
             
+        except SlotUnavailable:
+            messages.error(request, 'That time is no longer available. Please pick another slot.')
+            return redirect('book_consultation')
         except ValueError:
             messages.error(request, 'Invalid date format. Please try again.')
             return redirect('book_consultation')
     
     # GET request - show consultation booking page
     consultation_packages = ConsultationPackage.objects.filter(is_active=True)
+    scheduled = has_availability()
     
     # Convert to list of dicts for template compatibility
     packages_data = []
@@ -1367,6 +1396,7 @@ def book_consultation(request):
             'features': package.get_features_list(),
             'icon_class': package.icon_class,
             'get_level_display': package.get_level_display,
+            'available_slots': free_starts(package.duration_minutes, count=BOOKING_SLOT_CHOICES) if scheduled else [],
         })
     
     context = {
@@ -1395,14 +1425,14 @@ def my_consultations(request):
     completed_consultations = all_consultations.filter(status='completed')
     cancelled_consultations = all_consultations.filter(status='cancelled')
     
-    # Calculate stats
-    scheduled_count = upcoming_consultations.count()
-    completed_count = completed_consultations.count()
-    cancelled_count = cancelled_consultations.count()
+    # Calculate stats (single cached aggregate query)
+    summary = get_user_summary(request.user)
+    scheduled_count = summary['upcoming_count']
+    completed_count = summary['completed_count']
+    cancelled_count = summary['cancelled_count']
     
     # Calculate total invested
-    total_invested_result = all_consultations.aggregate(total=Sum('price'))
-    total_invested = total_invested_result['total'] or Decimal('0.00')
+    total_invested = summary['consultation_spend']
     total_invested_kes = usd_to_kes(total_invested)
     
     # Get next consultation
@@ -1426,6 +1456,8 @@ def my_consultations(request):
     return render(request, 'dashboard/my_consultations.html', context)
 
 @login_required
+@cache_control(private=True, no_cache=True)
+@analysis_conditional
 def view_analysis(request, analysis_id):
     """View for users to view a specific purchased analysis"""
     user_wallet, created = UserWallet.objects.get_or_create(user=request.user)
@@ -1443,18 +1475,25 @@ def view_analysis(request, analysis_id):
         messages.error(request, 'Analysis not found or no longer available.')
         return redirect('marketplace')
     
-    # Check if user has purchased this analysis
-    try:
-        purchase = PurchasedAnalysis.objects.get(user=request.user, analysis=analysis)
-    except PurchasedAnalysis.DoesNotExist:
+    # The purchase row is the ownership check and feeds the access details panel
+    purchase = PurchasedAnalysis.objects.filter(user=request.user, analysis=analysis).first()
+    if purchase is None:
         messages.error(request, 'You have not purchased this analysis.')
         return redirect('marketplace')
     
     # Get similar analyses for recommendation
-    similar_analyses = CryptoAnalysis.objects.filter(
-        is_active=True,
-        cryptocurrency=analysis.cryptocurrency
-    ).exclude(id=analysis_id).select_related('analyst')[:3]
+    similar_ids = get_similar_analysis_ids(analysis.id)[:3]
+    if similar_ids:
+        similar_by_id = CryptoAnalysis.objects.projection('card').filter(
+            is_active=True
+        ).select_related('analyst').in_bulk(similar_ids)
+        similar_analyses = [similar_by_id[pk] for pk in similar_ids if pk in similar_by_id]
+    else:
+        # Recommendations not built yet for this analysis
+        similar_analyses = CryptoAnalysis.objects.projection('card').filter(
+            is_active=True,
+            cryptocurrency=analysis.cryptocurrency
+        ).exclude(id=analysis_id).select_related('analyst')[:3]
     
     # Add KES prices to similar analyses
     for similar_analysis in similar_analyses:
@@ -1487,6 +1526,7 @@ def view_analysis(request, analysis_id):
     return render(request, 'dashboard/view_analysis.html', context)
 
 @login_required
+@read_from_replica
 def market_insights(request):
     """View for all market insights"""
     user_wallet, created = UserWallet.objects.get_or_create(user=request.user)
@@ -1498,7 +1538,7 @@ def market_insights(request):
     cryptocurrency = request.GET.get('crypto', '')
     
     # Build query
-    market_insights = MarketInsight.objects.filter(is_active=True)
+    market_insights = MarketInsight.objects.projection('card').filter(is_active=True)
     
     if insight_type:
         market_insights = market_insights.filter(insight_type=insight_type)
@@ -1513,13 +1553,13 @@ def market_insights(request):
     market_insights = market_insights.order_by('-published_at', '-created_at')
     
     # Get featured insights for sidebar
-    featured_insights = MarketInsight.objects.filter(
+    featured_insights = MarketInsight.objects.projection('card').filter(
         is_active=True,
         is_featured=True
     ).order_by('-published_at')[:5]
     
     # Get recent insights for sidebar
-    recent_insights = MarketInsight.objects.filter(
+    recent_insights = MarketInsight.objects.projection('card').filter(
         is_active=True
     ).order_by('-published_at')[:5]
     
@@ -1537,6 +1577,8 @@ def market_insights(request):
     return render(request, 'dashboard/market_insights.html', context)
 
 @login_required
+@cache_control(private=True, no_cache=True)
+@insight_conditional
 def view_market_insight(request, insight_id):
     """View for a single market insight"""
     user_wallet, created = UserWallet.objects.get_or_create(user=request.user)
@@ -1544,24 +1586,24 @@ def view_market_insight(request, insight_id):
     
     # Get the insight - MarketInsight doesn't have author field, it has verified_by
     insight = get_object_or_404(
-        MarketInsight.objects.select_related('verified_by', 'verified_by__user'), 
+        MarketInsight.objects.projection('detail'), 
         id=insight_id, 
         is_active=True
     )
     
-    # Increment view count
+    # Increment view count without touching updated_at (keeps its cached card valid)
+    MarketInsight.objects.filter(pk=insight.pk).update(views_count=F('views_count') + 1)
     insight.views_count += 1
-    insight.save()
     
     # Get related insights
-    related_insights = MarketInsight.objects.filter(
+    related_insights = MarketInsight.objects.projection('card').filter(
         is_active=True,
         cryptocurrency=insight.cryptocurrency
     ).exclude(id=insight_id).order_by('-published_at')[:3]
     
     # If no related insights by cryptocurrency, get by type
     if not related_insights:
-        related_insights = MarketInsight.objects.filter(
+        related_insights = MarketInsight.objects.projection('card').filter(
             is_active=True,
             insight_type=insight.insight_type
         ).exclude(id=insight_id).order_by('-published_at')[:3]
@@ -1594,28 +1636,24 @@ def view_market_insight(request, insight_id):
     return render(request, 'dashboard/view_market_insight.html', context)
 
 @login_required
+@cache_control(private=True)
 def download_analysis(request, analysis_id):
-    """Handle analysis PDF download"""
+    """Download the analysis as a PDF, rendered on the fly the first time and from the report cache after"""
     try:
-        analysis = CryptoAnalysis.objects.get(id=analysis_id, is_active=True)
+        analysis = CryptoAnalysis.objects.select_related('analyst__user').get(id=analysis_id, is_active=True)
         
         # Check if user has purchased this analysis
-        if not PurchasedAnalysis.objects.filter(user=request.user, analysis=analysis).exists():
+        if not user_owns_analysis(request.user, analysis.id):
             messages.error(request, "You don't have access to this analysis.")
             return redirect('marketplace')
         
-        # For now, return a simple response - you can implement PDF generation later
-        response = HttpResponse(content_type='application/pdf')
-        response['Content-Disposition'] = f'attachment; filename="analysis_{analysis_id}.pdf"'
-        
-        # Simple PDF content - you can replace this with actual PDF generation
-        response.write(f"Analysis Report #{analysis_id}\n")
-        response.write(f"Cryptocurrency: {analysis.cryptocurrency}\n")
-        response.write(f"Description: {analysis.description}\n")
-        response.write(f"Price: ${analysis.price}\n")
-        response.write(f"Price (KES): {usd_to_kes(analysis.price)}\n")
-        response.write(f"Risk Level: {analysis.get_risk_level_display()}\n")
-        
+        filename = report_filename(analysis)
+        cached = cached_report(analysis)
+        if cached:
+            return serve_path(request, cached, filename, as_attachment=True)
+
+        response = StreamingHttpResponse(stream_report(analysis), content_type='application/pdf')
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
         return response
         
     except CryptoAnalysis.DoesNotExist:
@@ -1630,7 +1668,7 @@ def refresh_analysis(request, analysis_id):
             analysis = CryptoAnalysis.objects.get(id=analysis_id, is_active=True)
             
             # Check if user has purchased this analysis
-            if not PurchasedAnalysis.objects.filter(user=request.user, analysis=analysis).exists():
+            if not user_owns_analysis(request.user, analysis.id):
                 return JsonResponse({
                     'status': 'error',
                     'message': 'You do not have access to this analysis.'
@@ -1716,7 +1754,7 @@ def purchase_analysis_mpesa(request):
             })
         
         # Check if already purchased
-        if PurchasedAnalysis.objects.filter(user=request.user, analysis=analysis).exists():
+        if has_purchased(request.user, analysis.id):
             return JsonResponse({
                 'status': 'already_purchased',
                 'message': 'You have already purchased this analysis.',
@@ -1889,20 +1927,20 @@ def mpesa_analysis_purchase_callback(request):
                     if mpesa_receipt:
                         transaction.mpesa_code = mpesa_receipt
                     
-                    transaction.save()
-                    
-                    # Create purchase record
-                    purchase = PurchasedAnalysis.objects.create(
-                        user=transaction.user,
-                        analysis=transaction.analysis,
-                        purchase_price=transaction.amount
-                    )
-                    
-                    # Update analysis sales count
-                    analysis = transaction.analysis
-                    analysis.sales_count += 1
-                    analysis.total_revenue += transaction.amount
-                    analysis.save()
+                    with db_transaction.atomic():
+                        transaction.save()
+                        
+                        # Create purchase record
+                        purchase = PurchasedAnalysis.objects.create(
+                            user=transaction.user,
+                            analysis=transaction.analysis,
+                            purchase_price=transaction.amount
+                        )
+                        
+                        # Update analysis sales count
+                        analysis = transaction.analysis
+                        CryptoAnalysis.objects.filter(pk=analysis.pk).update(sales_count=F('sales_count') + 1)
+                        UserStats.record(transaction.user_id, purchase_count=1, total_spent=transaction.amount)
                     
                     # Update MpesaTransaction record
                     try:
@@ -1970,17 +2008,17 @@ def check_mpesa_payment_status(request, checkout_request_id):
             
             # Double-check if purchase record exists
             if not PurchasedAnalysis.objects.filter(user=request.user, analysis=analysis).exists():
-                # Create purchase record if it doesn't exist
-                PurchasedAnalysis.objects.create(
-                    user=request.user,
-                    analysis=analysis,
-                    purchase_price=transaction.amount
-                )
-                
-                # Update analysis sales count
-                analysis.sales_count += 1
-                analysis.total_revenue += transaction.amount
-                analysis.save()
+                with db_transaction.atomic():
+                    # Create purchase record if it doesn't exist
+                    PurchasedAnalysis.objects.create(
+                        user=request.user,
+                        analysis=analysis,
+                        purchase_price=transaction.amount
+                    )
+                    
+                    # Update analysis sales count
+                    CryptoAnalysis.objects.filter(pk=analysis.pk).update(sales_count=F('sales_count') + 1)
+                    UserStats.record(request.user, purchase_count=1, total_spent=transaction.amount)
             
             return JsonResponse({
                 'status': 'success',
@@ -2018,7 +2056,7 @@ def purchase_analysis_mpesa_view(request, analysis_id):
         balance_kes = usd_to_kes(user_wallet.balance)
         
         # Check if already purchased
-        if PurchasedAnalysis.objects.filter(user=request.user, analysis=analysis).exists():
+        if has_purchased(request.user, analysis.id):
             messages.warning(request, 'You have already purchased this analysis.')
             return redirect('view_analysis', analysis_id=analysis.id)
         
@@ -2037,36 +2075,224 @@ def purchase_analysis_mpesa_view(request, analysis_id):
 
 
 
+# Fields served by the analysis APIs, in output order
+ANALYSIS_API_FIELDS = (
+    ('id', attrgetter('id')),
+    ('cryptocurrency', attrgetter('cryptocurrency')),
+    ('symbol', attrgetter('symbol')),
+    ('title', attrgetter('title')),
+    ('description', attrgetter('description')),
+    ('price', lambda analysis: float(analysis.price)),
+    ('analysis_type', attrgetter('analysis_type')),
+    ('analysis_type_display', methodcaller('get_analysis_type_display')),
+    ('risk_level', attrgetter('risk_level')),
+    ('risk_level_display', methodcaller('get_risk_level_display')),
+    ('recommendation', attrgetter('recommendation')),
+    ('recommendation_display', methodcaller('get_recommendation_display')),
+    ('timeframe', attrgetter('timeframe')),
+    ('timeframe_display', methodcaller('get_timeframe_display')),
+    ('overall_score', lambda analysis: float(analysis.overall_score)),
+    ('growth_potential', attrgetter('growth_potential')),
+    ('features_list', attrgetter('features_list')),
+    ('is_featured', attrgetter('is_featured')),
+    ('sales_count', attrgetter('sales_count')),
+    ('rating', lambda analysis: float(analysis.rating)),
+)
+ANALYSIS_API_FIELD_NAMES = frozenset(name for name, _ in ANALYSIS_API_FIELDS)
+
+ANALYSIS_BATCH_MAX_IDS = 500
+# Batches with more ids than this are streamed rather than built in memory
+ANALYSIS_BATCH_STREAM_THRESHOLD = 50
+
+
+def _analysis_api_serializer(fields=None):
+    """Build a function turning an analysis into a dict of the selected fields"""
+    selected = [(name, getter) for name, getter in ANALYSIS_API_FIELDS if fields is None or name in fields]
+    names = tuple(name for name, _ in selected)
+    getters = tuple(getter for _, getter in selected)
+
+    def serialize(analysis):
+        return dict(zip(names, [getter(analysis) for getter in getters]))
+    return serialize
+
+
+def _parse_api_fields(request):
+    """Return the requested sparse fieldset, or None for all fields"""
+    raw = request.GET.get('fields', '').strip()
+    if not raw:
+        return None
+    fields = {name.strip() for name in raw.split(',') if name.strip()}
+    unknown = fields - ANALYSIS_API_FIELD_NAMES
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return fields
+
+
+def _analysis_api_queryset(ids):
+    """Active analyses with the given ids, in one query with the 'api' projection"""
+    return CryptoAnalysis.objects.projection('api').filter(id__in=ids, is_active=True).order_by('id')
+
+
+def _stream_analysis_batch(ids, serialize):
+    """Stream the analyses in request order, one query per ANALYSIS_BATCH_STREAM_THRESHOLD ids"""
+    yield '{"status": "success", "analyses": ['
+    missing = []
+    separator = ''
+    for start in range(0, len(ids), ANALYSIS_BATCH_STREAM_THRESHOLD):
+        chunk = ids[start:start + ANALYSIS_BATCH_STREAM_THRESHOLD]
+        analyses = {analysis.id: analysis for analysis in _analysis_api_queryset(chunk)}
+        for analysis_id in chunk:
+            if analysis_id not in analyses:
+                missing.append(analysis_id)
+                continue
+            yield separator + json.dumps(serialize(analyses[analysis_id]))
+            separator = ','
+    yield '], "missing": ' + json.dumps(missing) + '}'
+
+
 @login_required
+@read_from_replica
+def analyses_batch_api(request):
+    """API endpoint returning several analyses in one query: ?ids=1,2,3&fields=id,price"""
+    try:
+        ids = list(dict.fromkeys(int(value) for value in request.GET.get('ids', '').split(',') if value.strip()))
+        fields = _parse_api_fields(request)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e) or 'Invalid ids'}, status=400)
+
+    if not ids:
+        return JsonResponse({'status': 'error', 'message': 'No analysis ids given'}, status=400)
+    if len(ids) > ANALYSIS_BATCH_MAX_IDS:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'At most {ANALYSIS_BATCH_MAX_IDS} analyses can be requested at once',
+        }, status=400)
+
+    serialize = _analysis_api_serializer(fields)
+
+    if len(ids) > ANALYSIS_BATCH_STREAM_THRESHOLD:
+        return StreamingHttpResponse(_stream_analysis_batch(ids, serialize), content_type='application/json')
+
+    analyses = {analysis.id: analysis for analysis in _analysis_api_queryset(ids)}
+    return JsonResponse({
+        'status': 'success',
+        'analyses': [serialize(analyses[analysis_id]) for analysis_id in ids if analysis_id in analyses],
+        'missing': [analysis_id for analysis_id in ids if analysis_id not in analyses],
+    })
+
+
+@login_required
+@read_from_replica
+@cache_control(private=True, no_cache=True)
+@analysis_api_conditional
 def analysis_detail_api(request, analysis_id):
     """API endpoint to get analysis details"""
     try:
-        analysis = CryptoAnalysis.objects.get(id=analysis_id, is_active=True)
-        
-        data = {
-            'id': analysis.id,
-            'cryptocurrency': analysis.cryptocurrency,
-            'symbol': analysis.symbol,
-            'title': analysis.title,
-            'description': analysis.description,
-            'price': float(analysis.price),
-            'analysis_type': analysis.analysis_type,
-            'analysis_type_display': analysis.get_analysis_type_display(),
-            'risk_level': analysis.risk_level,
-            'risk_level_display': analysis.get_risk_level_display(),
-            'recommendation': analysis.recommendation,
-            'recommendation_display': analysis.get_recommendation_display(),
-            'timeframe': analysis.timeframe,
-            'timeframe_display': analysis.get_timeframe_display(),
-            'overall_score': float(analysis.overall_score),
-            'growth_potential': analysis.growth_potential,
-            'features_list': analysis.features_list,
-            'is_featured': analysis.is_featured,
-            'sales_count': analysis.sales_count,
-            'rating': float(analysis.rating),
-        }
-        
-        return JsonResponse(data)
-        
-    except CryptoAnalysis.DoesNotExist:
-        return JsonResponse({'error': 'Analysis not found'}, status=404)
\ No newline at end of file
+        fields = _parse_api_fields(request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    analyses = list(_analysis_api_queryset([analysis_id]))
+    if not analyses:
+        return JsonResponse({'error': 'Analysis not found'}, status=404)
+    return JsonResponse(_analysis_api_serializer(fields)(analyses[0]))
+
+
+# Media served through Django, with range requests and X-Accel-Redirect/X-Sendfile offload
+
+HERO_VIDEO_MAX_AGE = 60 * 60 * 24
+
+
+def hero_video(request, setting_id):
+    """Hero video of a SiteSetting; public, so it may be cached by shared caches"""
+    site_setting = get_object_or_404(SiteSetting.objects.exclude(hero_video=''), pk=setting_id)
+    return serve_media(request, site_setting.hero_video, public=True, max_age=HERO_VIDEO_MAX_AGE)
+
+
+@login_required
+def consultation_attachment(request, attachment_id):
+    """Download an attachment; only the consultation's client, its analyst, the uploader and staff may"""
+    attachments = ConsultationAttachment.objects.all()
+    if not request.user.is_staff:
+        attachments = attachments.filter(
+            Q(consultation__user=request.user)
+            | Q(consultation__analyst__user=request.user)
+            | Q(uploaded_by=request.user)
+        )
+    # Someone else's attachment is indistinguishable from a missing one
+    attachment = get_object_or_404(attachments, pk=attachment_id)
+    return serve_media(request, attachment.file, filename=attachment.file_name, as_attachment=True, private=True)
+
+
+# Resumable attachment uploads (dashboard.uploads)
+
+def _upload_state(upload):
+    return {
+        'upload_id': str(upload.upload_id),
+        'file_name': upload.file_name,
+        'size': upload.size,
+        'chunk_size': upload.chunk_size,
+        'total_chunks': upload.total_chunks,
+        'received': received_chunks(upload),
+    }
+
+
+@login_required
+def start_attachment_upload(request, consultation_id):
+    """Start a chunked upload of an attachment to a consultation the user takes part in"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    consultations = Consultation.objects.all()
+    if not request.user.is_staff:
+        consultations = consultations.filter(Q(user=request.user) | Q(analyst__user=request.user))
+    consultation = get_object_or_404(consultations, pk=consultation_id)
+    try:
+        data = json.loads(request.body)
+        upload = start_upload(
+            consultation, request.user, data.get('file_name'), data.get('size'),
+            file_type=data.get('file_type', ''), description=data.get('description'),
+            chunk_size=data.get('chunk_size'),
+        )
+    except (ValueError, TypeError, AttributeError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(_upload_state(upload), status=201)
+
+
+@login_required
+def attachment_upload(request, upload_id):
+    """GET the chunks received so far, to resume; DELETE to abandon the upload"""
+    upload = get_object_or_404(AttachmentUpload, upload_id=upload_id, uploaded_by=request.user)
+    if request.method == 'DELETE':
+        discard_upload(upload)
+        return JsonResponse({'status': 'success'})
+    return JsonResponse(_upload_state(upload))
+
+
+@login_required
+def attachment_upload_chunk(request, upload_id, index):
+    """PUT one chunk as the raw request body, with its SHA-256 in X-Chunk-SHA256"""
+    if request.method != 'PUT':
+        return JsonResponse({'error': 'PUT required'}, status=405)
+    upload = get_object_or_404(AttachmentUpload, upload_id=upload_id, uploaded_by=request.user)
+    try:
+        # Streamed from the request; request.body would buffer the whole chunk
+        write_chunk(upload, index, request, request.headers.get('X-Chunk-SHA256', ''))
+    except UploadError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'status': 'success', 'index': index})
+
+
+@login_required
+def finalize_attachment_upload(request, upload_id):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    upload = get_object_or_404(AttachmentUpload, upload_id=upload_id, uploaded_by=request.user)
+    try:
+        attachment = finalize_upload(upload)
+    except UploadError as e:
+        return JsonResponse({'error': str(e), **_upload_state(upload)}, status=409)
+    return JsonResponse({
+        'status': 'success',
+        'attachment_id': attachment.pk,
+        'url': attachment.get_absolute_url(),
+    }, status=201)